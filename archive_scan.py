@@ -1,8 +1,5 @@
 import argparse
-import numpy as np
-from obspy import read
 import sys
-from obspy.core.utcdatetime import UTCDateTime
 
 # Silence tensorflow warnings
 import os
@@ -11,11 +8,6 @@ os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 
 if __name__ == '__main__':
 
-    # Default weights for models
-    default_weights = {'favor': 'WEIGHTS/w_model_performer_v2.0.h5',
-                       'cnn': 'WEIGHTS/w_model_cnn_v2.0.h5',
-                       'gpd': 'WEIGHTS/w_gpd_scsn_2000_2017.h5'}
-
     # Command line arguments parsing
     parser = argparse.ArgumentParser()
     parser.add_argument('input', help = 'Path to .csv file with archive names')
@@ -24,7 +16,27 @@ if __name__ == '__main__':
     parser.add_argument('--gpd', help = 'Use GPD model', action = 'store_true')
     parser.add_argument('--model', help = 'Custom model loader import, default: None', default = None)
     parser.add_argument('--loader_argv', help = 'Custom model loader arguments, default: None', default = None)
-    parser.add_argument('--out', '-o', help = 'Path to output file with predictions', default = 'predictions.txt')
+    parser.add_argument('--saved-model', help = 'Path to inference-only model artifact exported by export_model.py,'
+                                                ' default: artifact of the --weights, if it is exported and'
+                                                ' --backend is not set',
+                        default = None)
+    parser.add_argument('--backend', help = 'Inference backend: "keras" (Keras model predict), "function" (direct'
+                                            ' tf.function call of the model, without Keras predict overhead) or'
+                                            ' "tflite" (quantized TFLite model, see --tflite-model). Exported'
+                                            ' SavedModel is always called as tf.function, default: exported'
+                                            ' SavedModel of the --weights, if it is exported, otherwise keras',
+                        choices = ['keras', 'function', 'tflite'], default = None)
+    parser.add_argument('--tflite-model', help = 'Path to TFLite model for --backend tflite, default: int8 or dynamic'
+                                                 ' range model of the --weights, converted by export_model.py --tflite',
+                        default = None)
+    parser.add_argument('--out', '-o', help = 'Path to output file with predictions, default: predictions.txt'
+                                              ' (predictions.npy, .parquet or .feather for --output-format)',
+                        default = None)
+    parser.add_argument('--output-format', help = 'Predictions output format: "text", "npy" (NumPy structured'
+                                                  ' array), "parquet" or "feather" (require pyarrow). Binary'
+                                                  ' formats keep full SEED ids and nanosecond pick times,'
+                                                  ' default: text',
+                        choices = ['text', 'npy', 'parquet', 'feather'], default = 'text')
     parser.add_argument('--threshold', help = 'Positive prediction threshold, default: 0.998', default = 0.998)
     parser.add_argument('--batch-size', help = 'Model batch size, default: 150 slices '
                                                '(each slice is: 4 seconds by 3 channels)',
@@ -43,8 +55,22 @@ if __name__ == '__main__':
                         action = 'store_true')
     parser.add_argument('--print-precision', help = 'Floating point precision for results pseudo-probability output',
                         default = 4)
-    parser.add_argument('--time', help = 'Print out performance time in stdout', action = 'store_true')
+    parser.add_argument('--time', help = 'Print out performance time of every scan stage in stdout',
+                        action = 'store_true')
     parser.add_argument('--cpu', help = 'Disable GPU usage', action = 'store_true')
+    parser.add_argument('--intra-op-threads', help = 'TensorFlow (and TFLite interpreter) threads number of a single'
+                                                     ' operation, default: TensorFlow default (all cores), with'
+                                                     ' --workers: cores are split evenly between the workers',
+                        default = None)
+    parser.add_argument('--inter-op-threads', help = 'TensorFlow threads number for independent operations,'
+                                                     ' default: TensorFlow default, with --workers: 1',
+                        default = None)
+    parser.add_argument('--blas-threads', help = 'NumPy/SciPy BLAS and OpenMP threads number of every process,'
+                                                 ' default: library default, with --workers: cores are split'
+                                                 ' evenly between the workers', default = None)
+    parser.add_argument('--cpu-affinity', help = 'CPUs to run on, format: "0-15" or "0-7,16-23", with --workers'
+                                                 ' every worker is pinned to its own equal part of the list,'
+                                                 ' default: None (no affinity)', default = None)
     parser.add_argument('--start', help = 'Earliest time stamp allowed for input waveforms,'
                                           ' format examples: "2021-04-01" or "2021-04-01T12:35:40"', default = None)
     parser.add_argument('--end', help = 'Latest time stamp allowed for input waveforms'
@@ -53,6 +79,79 @@ if __name__ == '__main__':
                                                         ' Increases performance and reduces memory demand if set (at'
                                                         ' a cost of potential accuracy loss).',
                         action = 'store_true')
+    parser.add_argument('--shared-stft', help = 'Compute spectrogram once per trace and slice it for every sliding'
+                                                ' window (spectrogram models only, --shift should be a multiple'
+                                                ' of the STFT hop length: 16 samples)',
+                        action = 'store_true')
+    parser.add_argument('--sparse-picking', help = 'Find positives directly on sliding windows scores, without'
+                                                   ' restoring them to the full sampling rate',
+                        action = 'store_true')
+    parser.add_argument('--workers', help = 'Number of worker processes, which scan archive groups in parallel,'
+                                            ' every worker loads its own model, default: 1',
+                        default = 1)
+    parser.add_argument('--prefetch', help = 'Number of archive groups and trace chunks, which are read and'
+                                             ' preprocessed in background while the model predicts, 0 - disable'
+                                             ' background processing, default: 1',
+                        default = 1)
+    parser.add_argument('--cache', help = 'Path to the preprocessed waveforms cache directory, repeated scans of the'
+                                          ' same archives with the same preprocessing options skip reading and'
+                                          ' preprocessing, default: None (no cache)',
+                        default = None)
+    parser.add_argument('--cache-size', help = 'Preprocessed waveforms cache size limit in gigabytes, least recently'
+                                               ' used archives are removed from the cache, default: 10',
+                        default = 10)
+    parser.add_argument('--save-scores', help = 'Path to the directory to save raw sliding windows scores of every'
+                                                ' archive group, see --from-scores, default: None',
+                        default = None)
+    parser.add_argument('--from-scores', help = 'Path to the directory with scores saved by --save-scores. Picks'
+                                                ' positives on saved scores (e.g. with another --threshold) without'
+                                                ' running the model, default: None',
+                        default = None)
+    parser.add_argument('--metrics', help = 'Path to the file to dump per stage timers and counters (windows,'
+                                            ' samples read, picks, bytes written), updated after every archive group,'
+                                            ' default: None', default = None)
+    parser.add_argument('--metrics-format', help = 'Metrics file format: "json" (per group and per run metrics) or'
+                                                   ' "prometheus" (run metrics in Prometheus text format),'
+                                                   ' default: json',
+                        choices = ['json', 'prometheus'], default = 'json')
+    parser.add_argument('--dtype', help = 'Data type of preprocessed waveforms and normalized model input data:'
+                                          ' float64, float32 or float16 (preprocessing is done in float32, only'
+                                          ' normalized data is stored in float16), default: float32',
+                        choices = ['float64', 'float32', 'float16'], default = 'float32')
+    parser.add_argument('--journal', help = 'Path to the scan journal, which records completed archive groups and'
+                                            ' trace chunks with their output file offsets, so the scan can be'
+                                            ' resumed with --resume, default: no journal (<output file>.journal'
+                                            ' with --resume)', default = None)
+    parser.add_argument('--resume', help = 'Continue interrupted scan from its journal: skip completed archive'
+                                           ' groups and chunks and remove partially written output. The'
+                                           ' interrupted scan should be started with --journal',
+                        action = 'store_true')
+    parser.add_argument('--pack-batches', help = 'Pack sliding windows of all chunks, traces and archive groups into'
+                                                ' full --batch-size model batches, instead of predicting every chunk'
+                                                ' separately. Speeds up scanning of many short or gappy traces',
+                        action = 'store_true')
+    parser.add_argument('--coarse-stride', help = 'Two-pass scanning: sliding windows stride of the first (coarse)'
+                                                 ' pass in samples, a multiple of --shift, e.g. 150. Only regions'
+                                                 ' around coarse windows with P or S score above'
+                                                 ' --coarse-threshold are rescanned with --shift, default: None'
+                                                 ' (single pass)', default = None)
+    parser.add_argument('--coarse-threshold', help = 'Coarse pass P or S score, which triggers fine rescan, should be'
+                                                    ' lower than --threshold, default: 0.05', default = 0.05)
+    parser.add_argument('--coarse-padding', help = 'Number of samples rescanned with --shift on both sides of the'
+                                                  ' triggered regions, default: 200', default = 200)
+    parser.add_argument('--gate', help = 'Energy pre-trigger before the model: "stalta" (STA/LTA ratio of the'
+                                         ' channels energy) or "energy" (STA of the channels energy relative to its'
+                                         ' chunk median). Windows far from triggers get noise scores without running'
+                                         ' the model, default: None (no gate)',
+                        choices = ['stalta', 'energy'], default = None)
+    parser.add_argument('--gate-threshold', help = 'Pre-trigger threshold of the STA/LTA ratio or STA to median'
+                                                  ' ratio, default: 2', default = 2.)
+    parser.add_argument('--gate-sta', help = 'Pre-trigger short term average length, default: 1 second',
+                        default = 1.)
+    parser.add_argument('--gate-lta', help = 'Pre-trigger long term average length, default: 20 seconds',
+                        default = 20.)
+    parser.add_argument('--gate-padding', help = 'Windows closer than this number of samples to a triggered sample'
+                                                ' are predicted, default: 200', default = 200)
 
     args = parser.parse_args()  # parse arguments
 
@@ -110,7 +209,94 @@ if __name__ == '__main__':
                              f' positive_labels contents: {[k for k in positive_labels.keys()]}')
             sys.exit(2)
 
-    # Set start and end date
+    # Set values
+    frequency = 100.
+
+    args.batch_size = int(args.batch_size)
+    args.trace_size = int(float(args.trace_size) * frequency)
+    args.shift = int(args.shift)
+    args.print_precision = int(args.print_precision)
+
+    if not args.out:
+        args.out = 'predictions.' + {'text': 'txt'}.get(args.output_format, args.output_format)
+
+    args.workers = int(args.workers)
+    args.prefetch = int(args.prefetch)
+    args.cache_size = int(float(args.cache_size) * 1024**3)
+
+    if args.pack_batches and (args.shared_stft or args.plot_positives or args.plot_positives_original):
+        parser.print_help()
+        sys.stderr.write('ERROR: --pack-batches can not be used with --shared-stft, --plot-positives'
+                         ' and --plot-positives-original')
+        sys.exit(2)
+
+    if args.coarse_stride is not None:
+        args.coarse_stride = int(args.coarse_stride)
+        if args.coarse_stride <= args.shift or args.coarse_stride % args.shift:
+            parser.print_help()
+            sys.stderr.write('ERROR: --coarse-stride should be a multiple of --shift and larger than --shift')
+            sys.exit(2)
+        if args.pack_batches or args.shared_stft:
+            parser.print_help()
+            sys.stderr.write('ERROR: --coarse-stride can not be used with --pack-batches and --shared-stft')
+            sys.exit(2)
+    args.coarse_threshold = float(args.coarse_threshold)
+    args.coarse_padding = int(args.coarse_padding)
+
+    if args.coarse_stride and args.coarse_threshold > min(threshold_labels.values()):
+        parser.print_help()
+        sys.stderr.write('ERROR: --coarse-threshold should not be higher than --threshold')
+        sys.exit(2)
+
+    args.gate_threshold = float(args.gate_threshold)
+    args.gate_sta = int(float(args.gate_sta) * frequency)
+    args.gate_lta = int(float(args.gate_lta) * frequency)
+    args.gate_padding = int(args.gate_padding)
+
+    if args.gate and (args.coarse_stride or args.pack_batches or args.shared_stft):
+        parser.print_help()
+        sys.stderr.write('ERROR: --gate can not be used with --coarse-stride, --pack-batches and --shared-stft')
+        sys.exit(2)
+    if args.gate and not 0 < args.gate_sta < args.gate_lta:
+        parser.print_help()
+        sys.stderr.write('ERROR: --gate-sta should be positive and shorter than --gate-lta')
+        sys.exit(2)
+
+    for name in ('intra_op_threads', 'inter_op_threads', 'blas_threads'):
+        if getattr(args, name) is not None:
+            setattr(args, name, int(getattr(args, name)))
+
+    # CPU threads and affinity, set before NumPy import
+    from utils.cpu_config import parse_cpu_list, available_cpus, split_cpus, process_threads, configure_process
+
+    worker_cpus = None  # CPU list of every worker
+    try:
+        cpus = parse_cpu_list(args.cpu_affinity) if args.cpu_affinity else None
+
+        if args.workers > 1:
+
+            # Avoid oversubscription: every worker gets its share of the cores
+            if cpus:
+                worker_cpus = split_cpus(cpus, args.workers)
+            threads = process_threads(cpus or available_cpus(), args.workers)
+
+            if args.intra_op_threads is None:
+                args.intra_op_threads = threads
+            if args.inter_op_threads is None:
+                args.inter_op_threads = 1
+            if args.blas_threads is None:
+                args.blas_threads = threads
+
+            # Workers inherit BLAS threads environment
+            configure_process(blas_threads = args.blas_threads)
+        else:
+            configure_process(cpus, args.blas_threads)
+    except (ValueError, OSError) as e:
+        parser.print_help()
+        sys.stderr.write(f'ERROR: --cpu-affinity: {e}')
+        sys.exit(2)
+
+    # Set start and end date, after CPU configuration: obspy imports NumPy
     def parse_date_param(args, p_name):
         """
         Parse parameter from dictionary to UTCDateTime type.
@@ -118,6 +304,8 @@ if __name__ == '__main__':
         if not getattr(args, p_name):
             return None
 
+        from obspy.core.utcdatetime import UTCDateTime
+
         try:
             return UTCDateTime(getattr(args, p_name))
         except TypeError as e:
@@ -132,236 +320,199 @@ if __name__ == '__main__':
     args.end = parse_date_param(args, 'end')
     args.start = parse_date_param(args, 'start')
 
-    # Set values
-    frequency = 100.
-    n_features = 400
-    half_duration = (n_features * 0.5) / frequency
-
-    args.batch_size = int(args.batch_size)
-    args.trace_size = int(float(args.trace_size) * frequency)
-    args.shift = int(args.shift)
-    args.print_precision = int(args.print_precision)
+    if args.resume and args.output_format in ('parquet', 'feather'):
+        parser.print_help()
+        sys.stderr.write(f'ERROR: --resume is not supported with --output-format {args.output_format},'
+                         f' use "text" or "npy" output')
+        sys.exit(2)
 
     import utils.scan_tools as stools
+    import utils.archive_scanner as scanner
+    from utils.instrumentation import Metrics, dump_metrics
 
     archives = stools.parse_archive_csv(args.input)  # parse archive names
 
-    # Load model
-    if args.model:
-
-        # TODO: Check if loader_argv is set and check (if possible) loader_call if it receives arguments
-        #       Print warning then if loader_argv is not set and print help message about custom models
-
-        import importlib
-
-        model_loader = importlib.import_module(args.model)  # import loader module
-        loader_call = getattr(model_loader, 'load_model')  # import loader function
+    # Scan journal and resume of the interrupted scan
+    from utils.journal import ScanJournal, resume_state, truncate_output
 
-        # Parse loader arguments
-        loader_argv = args.loader_argv
+    # Journal is written only on request: it syncs output to disk after every chunk
+    if args.resume and not args.journal:
+        args.journal = f'{args.out}.journal'
 
-        # TODO: Improve parsing to support quotes and whitespaces inside said quotes
-        #       Also parse whitespaces between argument and key
-        argv_split = loader_argv.strip().split()
-        argv_dict = {}
-
-        for pair in argv_split:
-
-            spl = pair.split('=')
-            if len(spl) == 2:
-                argv_dict[spl[0]] = spl[1]
-
-        model = loader_call(**argv_dict)
-    # TODO: Print loaded model info. Also add flag --inspect to print model summary.
-    else:
+    done_groups = set()
+    partial = None
+    if args.resume:
 
-        if args.cnn:
-            import utils.seismo_load as seismo_load
-            if not args.weights: args.weights = default_weights['cnn']
-            model = seismo_load.load_cnn(args.weights)
-        elif args.gpd:
-            from utils.gpd_loader import load_model as load_gpd
-            if not args.weights: args.weights = default_weights['gpd']
-            model = load_gpd(args.weights)
-        else:
-            import utils.seismo_load as seismo_load
-            if not args.weights: args.weights = default_weights['favor']
-            model = seismo_load.load_performer(args.weights)
-
-    # Main loop
-    total_performance_time = 0.
-    for n_archive, l_archives in enumerate(archives):
-
-        # Write archives info
-        with open(args.out, 'a') as f:
-            line = ''
-            for path in l_archives:
-                line += f'{path} '
-            line += '\n'
-            f.write(line)
-
-        # Read data
-        streams = []
-        for path in l_archives:
-            streams.append(read(path))
-
-        # If --plot-positives-original, save original streams
-        original_streams = None
-        if args.plot_positives_original:
-            original_streams = []
-            for path in l_archives:
-                original_streams.append(read(path))
-
-        # Pre-process data
-        for st in streams:
-            stools.pre_process_stream(st, args.no_filter, args.no_detrend)
-
-        # Cut archives to the same length
-        streams = stools.trim_streams(streams, args.start, args.end)
-        if original_streams:
-            original_streams = stools.trim_streams(original_streams, args.start, args.end)
-
-        # Check if stream traces number is equal
-        lengths = [len(st) for st in streams]
-        if len(np.unique(np.array(lengths))) != 1:
-            continue
-
-        n_traces = len(streams[0])
-
-        # Progress bar preparations
-        total_batch_count = 0
-        for i in range(n_traces):
-
-            traces = [st[i] for st in streams]
-
-            l_trace = traces[0].data.shape[0]
-            last_batch = l_trace % args.trace_size
-            batch_count = l_trace // args.trace_size + 1 \
-                if last_batch \
-                else l_trace // args.trace_size
-
-            total_batch_count += batch_count
-
-        # Predict
-        current_batch_global = 0
-        for i in range(n_traces):
-
-            traces = stools.get_traces(streams, i)
-            original_traces = None
-            if original_streams:
-                original_traces = stools.get_traces(original_streams, i)
-                if traces[0].data.shape[0] != original_traces[0].data.shape[0]:
-                    raise AttributeError('WARNING: Traces and original_traces have different sizes, '
-                                         'check if preprocessing changes stream length!')
-
-            # Determine batch count
-            l_trace = traces[0].data.shape[0]
-            last_batch = l_trace % args.trace_size
-            batch_count = l_trace // args.trace_size + 1 \
-                if last_batch \
-                else l_trace // args.trace_size
-
-            freq = traces[0].stats.sampling_rate
-            station = traces[0].stats.station
-
-            for b in range(batch_count):
-
-                detected_peaks = []
-
-                b_size = args.trace_size
-                if b == batch_count - 1 and last_batch:
-                    b_size = last_batch
-
-                start_pos = b * args.trace_size
-                end_pos = start_pos + b_size
-                t_start = traces[0].stats.starttime
-
-                batches = [trace.slice(t_start + start_pos / freq, t_start + end_pos / freq) for trace in traces]
-                original_batches = None
-                if original_traces:
-                    original_batches = [trace.slice(t_start + start_pos / freq, t_start + end_pos / freq)
-                                        for trace in original_traces]
-
-                # Progress bar
-
-                if args.time:
-                    stools.progress_bar(current_batch_global / total_batch_count, 40, add_space_around = False,
-                                        prefix = f'Group {n_archive + 1} out of {len(archives)} [',
-                                        postfix = f'] - Batch: {batches[0].stats.starttime} '
-                                                  f'- {batches[0].stats.endtime} '
-                                                  f'Time: {total_performance_time:.6} seconds')
-                else:
-                    stools.progress_bar(current_batch_global / total_batch_count, 40, add_space_around = False,
-                                        prefix = f'Group {n_archive + 1} out of {len(archives)} [',
-                                        postfix = f'] - Batch: {batches[0].stats.starttime}'
-                                                  f' - {batches[0].stats.endtime}')
-                current_batch_global += 1
-
-                scores, performance_time = stools.scan_traces(*batches,
-                                                              model = model,
-                                                              args = args,
-                                                              original_data = original_batches)  # predict
-                total_performance_time += performance_time
-
-                if scores is None:
-                    continue
+        if not os.path.exists(args.journal) and os.path.exists(args.out):
+            parser.print_help()
+            sys.stderr.write(f'ERROR: No scan journal {args.journal} of the output {args.out}, only scans started'
+                             f' with --journal can be resumed')
+            sys.exit(2)
 
-                # TODO: window step 10 should be in params, including the one used in predict.scan_traces
-                restored_scores = stools.restore_scores(scores, (len(batches[0]), len(model_labels)), args.shift)
+        try:
+            state = resume_state(args.journal, archives)
+        except ValueError as e:
+            parser.print_help()
+            sys.stderr.write(f'ERROR: {e}')
+            sys.exit(2)
 
-                # Get indexes of predicted events
-                predicted_labels = {}
-                for label in positive_labels:
+        if state:
+            done_groups = state['done']
+            partial = state['partial']
+            offset = state['offset']
 
-                    other_labels = []
-                    for k in model_labels:
-                        if k != label:
-                            other_labels.append(model_labels[k])
+            # Chunk level resume is supported only by the single process scan, other modes rescan the whole group
+            if partial and (partial['trace'] is None or args.save_scores or args.from_scores or args.workers > 1):
+                offset = partial['group_offset']
+                partial = None
 
-                    positives = stools.get_positives(restored_scores,
-                                                     positive_labels[label],
-                                                     other_labels,
-                                                     threshold = threshold_labels[label])
+            truncate_output(args.out, offset)
 
-                    predicted_labels[label] = positives
+            print(f'Resuming scan: {len(done_groups)} out of {len(archives)} archive groups are completed')
 
-                # Convert indexes to datetime
-                predicted_timestamps = {}
-                for label in predicted_labels:
+    todo = [n for n in range(len(archives)) if n not in done_groups]
 
-                    tmp_prediction_dates = []
-                    for prediction in predicted_labels[label]:
+    run_metrics = Metrics()
+    group_metrics = []  # (archive paths, Metrics) of every scanned group
 
-                        starttime = batches[0].stats.starttime
+    # All results are written through a single buffered output sink
+    from utils.result_sink import open_sink
 
-                        # Get prediction UTCDateTime and model pseudo-probability
-                        # TODO: why params['frequency'] here but freq = traces[0].stats.frequency before?
-                        tmp_prediction_dates.append([starttime + (prediction[0] / frequency) + half_duration,
-                                                     prediction[1]])
+    try:
+        sink = open_sink(args.out, args.output_format, metrics = run_metrics)
+    except ValueError as e:
+        parser.print_help()
+        sys.stderr.write(f'ERROR: {e}')
+        sys.exit(2)
 
-                    predicted_timestamps[label] = tmp_prediction_dates
+    journal = None
+    if args.journal:
+        journal = ScanJournal(args.journal, append = args.resume)
 
-                # Prepare output data
-                for typ in predicted_timestamps:
-                    for pred in predicted_timestamps[typ]:
+    def add_group_metrics(l_archives, metrics):
+        """
+        Adds group metrics to the run metrics and dumps them if --metrics is set.
+        """
+        group_metrics.append((l_archives, metrics))
+        run_metrics.add(metrics)
+        if args.metrics:
+            dump_metrics(args.metrics, run_metrics, group_metrics, args.metrics_format)
 
-                        prediction = {'type': typ,
-                                      'datetime': pred[0],
-                                      'pseudo-probability': pred[1]}
+    # Main loop
+    total_performance_time = 0.
+    if args.from_scores:
+
+        # Only pick positives on saved scores
+        for n_archive in todo:
+
+            l_archives = archives[n_archive]
+            stools.progress_bar(n_archive / len(archives), 40, add_space_around = False,
+                                prefix = 'Groups [',
+                                postfix = f'] - {n_archive + 1} out of {len(archives)}')
+
+            metrics = Metrics()
+            if journal:
+                journal.group_started(n_archive, l_archives, sink)
+            if not scanner.rescan_group(n_archive, l_archives, args, positive_labels, threshold_labels,
+                                        out = sink, metrics = metrics):
+                print(f'\nWARNING: No saved scores for the group: {" ".join(l_archives)}')
+            if journal:
+                journal.group_done(n_archive, sink)
+            add_group_metrics(l_archives, metrics)
+        print('')
+
+    elif args.workers > 1:
+
+        # Models are loaded by the workers, results are merged in the input order
+        import multiprocessing as mp
+
+        context = mp.get_context('spawn')
+
+        # Every worker takes its CPU list from the queue
+        cpu_queue = None
+        if worker_cpus:
+            cpu_queue = context.Queue()
+            for part in worker_cpus:
+                cpu_queue.put(part)
+
+        with context.Pool(args.workers,
+                          initializer = scanner.init_worker,
+                          initargs = (args, model_labels, positive_labels, threshold_labels, cpu_queue)) as pool:
+
+            jobs = pool.imap(scanner.scan_group_job, [(n, archives[n]) for n in todo])
+            for n_archive, (part_path, performance_time, metrics) in zip(todo, jobs):
+
+                if journal:
+                    journal.group_started(n_archive, archives[n_archive], sink)
+                sink.append_part(part_path)
+                os.remove(part_path)
+                if journal:
+                    journal.group_done(n_archive, sink)
 
-                        detected_peaks.append(prediction)
+                total_performance_time += performance_time
 
-                if args.print_scores:
-                    stools.print_scores(batches, restored_scores, predicted_labels, f't{i}_b{b}')
+                group = Metrics()
+                group.add(metrics)
+                add_group_metrics(archives[n_archive], group)
+                stools.progress_bar((n_archive + 1) / len(archives), 40, add_space_around = False,
+                                    prefix = 'Groups [',
+                                    postfix = f'] - {n_archive + 1} out of {len(archives)}')
+            print('')
 
-                stools.print_results(detected_peaks, args.out, precision = args.print_precision, station = station)
+    else:
 
-            print('')
+        # Load model
+        try:
+            with run_metrics.timer('model_load'):
+                model = scanner.load_model(args)
+            with run_metrics.timer('warmup'):
+                model.warmup(args.batch_size)
+        except ValueError as e:
+            parser.print_help()
+            sys.stderr.write(f'ERROR: {e}')
+            sys.exit(2)
 
-        # Write separator
-        with open(args.out, 'a') as f:
-            line = '---' * 12 + '\n'
-            f.write(line)
+        # Next groups are read and preprocessed, while the model predicts on the current one
+        from utils.pipeline import prefetch
+
+        archives_metrics = [Metrics() for _ in archives]
+        groups = prefetch(lambda n: scanner.load_group(archives[n], args, metrics = archives_metrics[n]),
+                          todo, depth = args.prefetch)
+
+        # Windows of all groups are packed into full batches, group results are written when predicted
+        packer = None
+        if args.pack_batches:
+            from utils.batching import BatchPacker
+            packer = BatchPacker(model, args.batch_size, metrics = run_metrics)
+
+        for n_archive, group in zip(todo, groups):
+
+            l_archives = archives[n_archive]
+            resume = partial if partial and partial['group'] == n_archive else None
+
+            total_performance_time = scanner.scan_group(n_archive, l_archives, model, args,
+                                                        model_labels, positive_labels, threshold_labels,
+                                                        n_archives = len(archives),
+                                                        total_performance_time = total_performance_time,
+                                                        group = group,
+                                                        out = sink,
+                                                        metrics = archives_metrics[n_archive],
+                                                        packer = packer,
+                                                        journal = journal,
+                                                        resume = resume)
+            if packer is not None:
+                packer.defer(add_group_metrics, l_archives, archives_metrics[n_archive])
+            else:
+                add_group_metrics(l_archives, archives_metrics[n_archive])
+
+        if packer is not None:
+            packer.flush()
+            total_performance_time = packer.performance_time
+
+    if journal:
+        journal.close(sink)
+    sink.close()
 
     if args.time:
         print(f'Total model prediction time: {total_performance_time:.6} seconds')
+        print(run_metrics.summary())
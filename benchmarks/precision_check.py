@@ -0,0 +1,141 @@
+"""
+Reduced precision accuracy check: scans the same synthetic (or given) archive group with float64, float32 and
+float16 data paths (see archive_scan.py --dtype) and reports scores and picks differences against float64 as JSON.
+
+Usage example (from the repository root):
+
+python -m benchmarks.precision_check --duration 3600 --model favor --out precision.json
+"""
+import os
+import sys
+import json
+import argparse
+
+# Silence tensorflow warnings
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+
+def scan_with_dtype(model, streams, args, dtype):
+    """
+    Preprocesses copies of streams and scans them with the data type.
+    :return: tuple (scores, picks), picks is a dictionary of label: list of pick sample positions
+    """
+    import numpy as np
+    import utils.scan_tools as stools
+    from utils.archive_scanner import n_features
+
+    model_labels = {'p': 0, 's': 1, 'n': 2}
+    positive_labels = {'p': 0, 's': 1}
+    threshold_labels = {'p': args.threshold, 's': args.threshold}
+
+    scan_args = argparse.Namespace(shift = args.shift, batch_size = args.batch_size, shared_stft = False,
+                                   plot_positives = False, plot_positives_original = False, dtype = dtype)
+
+    streams = [st.copy() for st in streams]
+    for st in streams:
+        stools.pre_process_stream(st, args.no_filter, args.no_detrend, dtype = stools.preprocess_dtype(dtype))
+
+    streams = stools.trim_streams(streams)
+    traces = stools.get_traces(streams, 0)
+
+    prepared = stools.prepare_traces(*traces, args = scan_args, n_features = n_features)
+    scores = stools.predict_windows(model, prepared['windows'], args.batch_size)
+
+    restored = stools.restore_scores(scores, (len(traces[0]), len(model_labels)), args.shift)
+    predicted_labels = stools.pick_positives(restored, model_labels, positive_labels, threshold_labels)
+
+    picks = {label: np.array([pos for pos, _ in positives], dtype = int)
+             for label, positives in predicted_labels.items()}
+
+    return scores, picks
+
+
+def compare_picks(reference, picks, tolerance):
+    """
+    Returns number of reference picks matched within tolerance samples, missed and extra picks.
+    """
+    import numpy as np
+
+    if not reference.shape[0] or not picks.shape[0]:
+        return {'matched': 0, 'missed': int(reference.shape[0]), 'extra': int(picks.shape[0]), 'max_offset': 0}
+
+    offsets = np.abs(reference[:, np.newaxis] - picks[np.newaxis, :]).min(axis = 1)
+    matched = offsets <= tolerance
+
+    return {'matched': int(matched.sum()),
+            'missed': int((~matched).sum()),
+            'extra': int(picks.shape[0] - matched.sum()),
+            'max_offset': int(offsets[matched].max()) if matched.any() else 0}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', help = 'Model: favor, cnn or gpd, default: favor', default = 'favor')
+    parser.add_argument('--weights', '-w', help = 'Path to model weights, default: model default weights',
+                        default = None)
+    parser.add_argument('--archives', help = 'N, E, Z archive paths to scan, default: synthetic archives',
+                        nargs = 3, default = None)
+    parser.add_argument('--duration', help = 'Synthetic archives duration in seconds, default: 3600',
+                        default = 3600.)
+    parser.add_argument('--out', '-o', help = 'Path to output JSON file, default: print to stdout', default = None)
+    parser.add_argument('--batch-size', help = 'Model batch size, default: 150', default = 150)
+    parser.add_argument('--shift', help = 'Sliding windows shift, default: 10 samples', default = 10)
+    parser.add_argument('--threshold', help = 'Positive prediction threshold, default: 0.998', default = 0.998)
+    parser.add_argument('--tolerance', help = 'Max pick offset in samples to match float64 pick, default: 10',
+                        default = 10)
+    parser.add_argument('--no-filter', help = 'Do not filter input waveforms', action = 'store_true')
+    parser.add_argument('--no-detrend', help = 'Do not detrend input waveforms', action = 'store_true')
+    parser.add_argument('--cpu', help = 'Disable GPU usage', action = 'store_true')
+
+    args = parser.parse_args()
+
+    args.duration = float(args.duration)
+    args.batch_size = int(args.batch_size)
+    args.shift = int(args.shift)
+    args.threshold = float(args.threshold)
+    args.tolerance = int(args.tolerance)
+
+    if args.cpu:
+        os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    import numpy as np
+    from obspy import read
+    from benchmarks.scan_benchmark import load_benchmark_model
+    from benchmarks.synthetic import synthetic_group
+
+    if args.archives:
+        streams = [read(path) for path in args.archives]
+    else:
+        streams, _ = synthetic_group(duration = args.duration)
+
+    model, weights = load_benchmark_model(args.model, args.weights)
+
+    reference_scores, reference_picks = scan_with_dtype(model, streams, args, 'float64')
+
+    report = {'model': args.model,
+              'weights': weights,
+              'windows': int(reference_scores.shape[0]),
+              'reference_picks': {label: int(picks.shape[0]) for label, picks in reference_picks.items()},
+              'dtypes': {}}
+
+    for dtype in ['float32', 'float16']:
+
+        scores, picks = scan_with_dtype(model, streams, args, dtype)
+        difference = np.abs(scores.astype(np.float64) - reference_scores)
+
+        report['dtypes'][dtype] = {
+            'max_abs_difference': float(difference.max()),
+            'mean_abs_difference': float(difference.mean()),
+            'picks': {label: compare_picks(reference_picks[label], picks[label], args.tolerance)
+                      for label in reference_picks}
+        }
+
+    text = json.dumps(report, indent = 2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
@@ -0,0 +1,126 @@
+"""
+Preprocessing benchmark: preprocesses synthetic 3-component archives of several sampling rates with obspy Stream
+methods (detrend, filter, interpolate of every trace) and with utils.preprocessing kernels on stacked channels,
+and reports wall time and maximum difference of the results as JSON. Also checks that data filtered in chunks
+with the kept filter state (real-time scanner) matches the whole-trace filtering.
+
+Usage example (from the repository root):
+
+python -m benchmarks.preprocessing --duration 86400 --frequencies 100 50 200 --out preprocessing.json
+"""
+import os
+import sys
+import json
+import argparse
+import platform
+from time import time
+
+
+def obspy_pre_process(stream, no_filter = False, no_detrend = False, dtype = None):
+    """
+    Preprocessing with obspy Stream methods, one trace at a time.
+    """
+    if not no_detrend:
+        stream.detrend(type = 'linear')
+    if not no_filter:
+        stream.filter(type = 'highpass', freq = 2)
+    if stream[0].stats.delta != 0.01:
+        stream.interpolate(100.)
+
+    if dtype is not None:
+        for trace in stream:
+            trace.data = trace.data.astype(dtype, copy = False)
+
+
+def chunked_filter_difference(data, frequency, chunk_size):
+    """
+    Returns maximum difference between data filtered at once and in chunks of chunk_size samples.
+    """
+    import numpy as np
+    from utils.preprocessing import HighpassFilter
+
+    whole = HighpassFilter(2., frequency, data.shape[0])(data)
+
+    highpass = HighpassFilter(2., frequency, data.shape[0])
+    chunks = [highpass(data[:, start : start + chunk_size]) for start in range(0, data.shape[1], chunk_size)]
+
+    return float(np.abs(np.concatenate(chunks, axis = 1) - whole).max())
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--duration', help = 'Synthetic archives duration in seconds, default: 86400',
+                        default = 86400.)
+    parser.add_argument('--frequencies', help = 'Archives sampling rates, default: 100 50 200', nargs = '+',
+                        default = [100., 50., 200.])
+    parser.add_argument('--repeat', help = 'Number of runs of every method, default: 3', default = 3)
+    parser.add_argument('--dtype', help = 'Preprocessed data type, default: float32', default = 'float32')
+    parser.add_argument('--chunk-size', help = 'Chunk size in samples for the chunked filter check, default: 512',
+                        default = 512)
+    parser.add_argument('--out', '-o', help = 'Path to output JSON file, default: print to stdout', default = None)
+
+    args = parser.parse_args()
+
+    args.duration = float(args.duration)
+    args.frequencies = [float(frequency) for frequency in args.frequencies]
+    args.repeat = int(args.repeat)
+    args.chunk_size = int(args.chunk_size)
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    import numpy as np
+    from benchmarks.synthetic import synthetic_group
+    from utils.preprocessing import pre_process_streams
+
+    results = {}
+    for frequency in args.frequencies:
+
+        streams, _ = synthetic_group(duration = args.duration, frequency = frequency)
+
+        times = {'obspy': [], 'kernels': []}
+        for _ in range(args.repeat):
+
+            reference = [st.copy() for st in streams]
+            start_time = time()
+            for st in reference:
+                obspy_pre_process(st, dtype = args.dtype)
+            times['obspy'].append(time() - start_time)
+
+            processed = [st.copy() for st in streams]
+            start_time = time()
+            pre_process_streams(processed, dtype = args.dtype)
+            times['kernels'].append(time() - start_time)
+
+        difference = max(float(np.abs(a[0].data.astype(np.float64) - b[0].data).max())
+                         for a, b in zip(reference, processed))
+        scale = max(float(np.abs(st[0].data).max()) for st in reference)
+
+        data = np.stack([st[0].data for st in streams]).astype(np.float64)
+
+        results[f'{frequency:g}'] = {'samples': int(streams[0][0].stats.npts),
+                                     'obspy': min(times['obspy']),
+                                     'kernels': min(times['kernels']),
+                                     'speedup': min(times['obspy']) / min(times['kernels']),
+                                     'max_abs_difference': difference,
+                                     'max_relative_difference': difference / scale if scale else 0.,
+                                     'chunked_filter_difference': chunked_filter_difference(data, frequency,
+                                                                                            args.chunk_size)}
+
+        print(f'{frequency:g} Hz: obspy {min(times["obspy"]):.3f} s, kernels {min(times["kernels"]):.3f} s',
+              file = sys.stderr)
+
+    report = {'platform': {'python': platform.python_version(),
+                           'machine': platform.machine(),
+                           'processor': platform.processor()},
+              'duration': args.duration,
+              'dtype': args.dtype,
+              'repeat': args.repeat,
+              'frequencies': results}
+
+    text = json.dumps(report, indent = 2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
@@ -0,0 +1,135 @@
+"""
+miniSEED replay for realtime_scan.py load testing: splits archives (or synthetic archives of many stations) into
+miniSEED records and serves them to a single TCP client, or appends them to a growing file, in order of the
+records end times, faster than real time.
+
+Usage example (from the repository root):
+
+python -m benchmarks.replay --stations 24 --duration 600 --speed 10 --port 18000 &
+python realtime_scan.py --tcp localhost:18000 --quiet
+"""
+import io
+import os
+import sys
+import socket
+import argparse
+from time import time, sleep
+
+import numpy as np
+
+
+def record_packets(streams, record_samples = 100, record_length = 512):
+    """
+    Splits traces into single miniSEED records.
+    :param streams: list of obspy streams
+    :param record_samples: samples per record, should fit into record_length bytes
+    :param record_length: miniSEED record length in bytes
+    :return: list of (record end time UTCDateTime, record bytes), sorted by end time
+    """
+    packets = []
+    for stream in streams:
+        for trace in stream:
+
+            encoding = 'STEIM2' if np.issubdtype(trace.data.dtype, np.integer) else 'FLOAT32'
+            if encoding == 'STEIM2':
+                trace.data = trace.data.astype(np.int32)
+            else:
+                trace.data = trace.data.astype(np.float32)
+
+            for start in range(0, trace.stats.npts, record_samples):
+
+                record_trace = trace.copy()
+                record_trace.data = trace.data[start : start + record_samples]
+                record_trace.stats.starttime = trace.stats.starttime + start / trace.stats.sampling_rate
+
+                f = io.BytesIO()
+                record_trace.write(f, format = 'MSEED', reclen = record_length, encoding = encoding)
+                packets.append((record_trace.stats.endtime, f.getvalue()))
+
+    packets.sort(key = lambda x: x[0])
+
+    return packets
+
+
+def replay(packets, write, speed = 1.):
+    """
+    Writes records, every record is written when its end time is reached on the replay clock.
+    :param packets: record_packets output
+    :param write: function, which writes record bytes
+    :param speed: replay clock speed relative to real time, 0 - write as fast as possible
+    :return: tuple (records number, replay wall time)
+    """
+    if not packets:
+        return 0, 0.
+
+    t0 = packets[0][0]
+    start_time = time()
+
+    for endtime, data in packets:
+
+        if speed > 0:
+            delay = (endtime - t0) / speed - (time() - start_time)
+            if delay > 0:
+                sleep(delay)
+
+        write(data)
+
+    return len(packets), time() - start_time
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', help = 'Path to archive_scan.py input file with archive names, all groups'
+                                          ' are replayed at once, default: synthetic archives', default = None)
+    parser.add_argument('--stations', help = 'Number of synthetic stations, default: 10', default = 10)
+    parser.add_argument('--duration', help = 'Synthetic archives duration in seconds, default: 600',
+                        default = 600.)
+    parser.add_argument('--speed', help = 'Replay speed relative to real time, 0 - as fast as possible,'
+                                          ' default: 1', default = 1.)
+    parser.add_argument('--record-samples', help = 'Samples per miniSEED record, default: 100', default = 100)
+    parser.add_argument('--record-length', help = 'miniSEED record length in bytes, default: 512', default = 512)
+    parser.add_argument('--host', help = 'TCP server host, default: localhost', default = 'localhost')
+    parser.add_argument('--port', help = 'TCP server port, default: 18000', default = 18000)
+    parser.add_argument('--file', help = 'Append records to this growing file instead of serving them over TCP',
+                        default = None)
+
+    args = parser.parse_args()
+
+    args.stations = int(args.stations)
+    args.duration = float(args.duration)
+    args.speed = float(args.speed)
+    args.record_samples = int(args.record_samples)
+    args.record_length = int(args.record_length)
+    args.port = int(args.port)
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    from obspy import read
+
+    streams = []
+    if args.input:
+        from utils.scan_tools import parse_archive_csv
+        for l_archives in parse_archive_csv(args.input):
+            streams.extend(read(path) for path in l_archives)
+    else:
+        from benchmarks.synthetic import synthetic_group
+        for i in range(args.stations):
+            group, _ = synthetic_group(duration = args.duration, station = f'S{i:03d}', seed = i)
+            streams.extend(group)
+
+    print('Encoding records..', file = sys.stderr)
+    packets = record_packets(streams, args.record_samples, args.record_length)
+    print(f'{len(packets)} records, {packets[-1][0] - packets[0][0]:.1f} seconds of data', file = sys.stderr)
+
+    if args.file:
+        with open(args.file, 'ab', buffering = 0) as f:
+            n_records, replay_time = replay(packets, f.write, args.speed)
+    else:
+        with socket.create_server((args.host, args.port)) as server:
+            print(f'Waiting for connection on {args.host}:{args.port}..', file = sys.stderr)
+            connection, address = server.accept()
+            with connection:
+                n_records, replay_time = replay(packets, connection.sendall, args.speed)
+
+    print(f'Replayed {n_records} records in {replay_time:.1f} seconds', file = sys.stderr)
@@ -0,0 +1,226 @@
+"""
+Archive scanning benchmark: scans synthetic miniSEED day archives with the Seismo-Performer, Spec-CNN and GPD
+models and reports per-stage wall time and throughput as JSON.
+
+Usage example (from the repository root):
+
+python -m benchmarks.scan_benchmark --duration 3600 --models favor cnn --out bench.json
+
+Stages follow archive_scan.py: read, pre_process, trim, windowing, predict, restore_scores, get_positives and
+print_results. If model weights are not available, model is benchmarked with random weights.
+"""
+import os
+import sys
+import json
+import argparse
+import tempfile
+import platform
+from time import time
+from contextlib import contextmanager
+
+# Silence tensorflow warnings
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+
+class StageTimer:
+
+    def __init__(self):
+        self.stages = {}
+
+    @contextmanager
+    def __call__(self, name):
+        """
+        Adds wall time of the block to the stage.
+        """
+        start_time = time()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.) + time() - start_time
+
+
+def load_benchmark_model(name, weights = None, backend = 'keras'):
+    """
+    Loads model by name: "favor", "cnn" or "gpd". Uses random weights if weights file does not exist.
+    :param backend: inference backend, see utils.backends.as_backend
+    :return: tuple (utils.backends.InferenceBackend, weights path or None)
+    """
+    from utils.backends import as_backend
+    from utils.archive_scanner import default_weights
+
+    if weights is None:
+        weights = default_weights[name]
+    if not os.path.exists(weights):
+        weights = None
+
+    if name == 'favor':
+        import utils.seismo_load as seismo_load
+        model = seismo_load.load_performer(weights, compile = False)
+    elif name == 'cnn':
+        import utils.seismo_load as seismo_load
+        model = seismo_load.load_cnn(weights, compile = False)
+    elif name == 'gpd':
+        from utils.gpd_loader import gpd, load_model
+        model = load_model(weights, compile = False) if weights else gpd()
+    else:
+        raise ValueError(f'Unknown model "{name}"')
+
+    return as_backend(model, backend), weights
+
+
+def benchmark_model(name, paths, args, backend = 'keras'):
+    """
+    Scans archive group with the model and returns benchmark results.
+    """
+    from obspy import read
+    import utils.scan_tools as stools
+    from utils.preprocessing import pre_process_streams
+    from utils.segments import SegmentIndex
+    from utils.archive_scanner import chunk_positions, get_detected_peaks, n_features
+
+    model_labels = {'p': 0, 's': 1, 'n': 2}
+    positive_labels = {'p': 0, 's': 1}
+    threshold_labels = {'p': args.threshold, 's': args.threshold}
+
+    # prepare_data options
+    scan_args = argparse.Namespace(shift = args.shift, batch_size = args.batch_size, shared_stft = False,
+                                   plot_positives = False, plot_positives_original = False, dtype = args.dtype)
+
+    timer = StageTimer()
+
+    with timer('model_load'):
+        model, weights = load_benchmark_model(name, backend = backend)
+
+    # Exclude graph tracing from the predict stage
+    with timer('warmup'):
+        model.warmup(args.batch_size)
+
+    out_path = os.path.join(args.dir, f'{name}_predictions.txt')
+    if os.path.exists(out_path):
+        os.remove(out_path)
+
+    with timer('read'):
+        streams = [read(path) for path in paths]
+
+    with timer('pre_process'):
+        pre_process_streams(streams, args.no_filter, args.no_detrend, dtype = stools.preprocess_dtype(args.dtype))
+
+    with timer('trim'):
+        index = SegmentIndex(streams)
+
+    n_samples = sum(end - start for start, end in index.segments)
+    trace_size = int(args.trace_size * index.frequency)
+
+    n_windows = 0
+    n_picks = 0
+    for segment_start, segment_end in index.segments:
+        for start_pos, end_pos in chunk_positions(segment_end - segment_start, trace_size, args.shift):
+
+            with timer('windowing'):
+                data = index.slice(segment_start + start_pos, segment_start + end_pos)
+                prepared = stools.prepare_data(data, args = scan_args, n_features = n_features)
+
+            if prepared is None:
+                continue
+
+            with timer('predict'):
+                scores = stools.predict_windows(model, prepared['windows'], args.batch_size)
+            n_windows += scores.shape[0]
+
+            with timer('restore_scores'):
+                restored = stools.restore_scores(scores, (end_pos - start_pos, len(model_labels)), args.shift)
+
+            with timer('get_positives'):
+                predicted_labels = stools.pick_positives(restored, model_labels, positive_labels, threshold_labels)
+
+            with timer('print_results'):
+                detected_peaks = get_detected_peaks(predicted_labels, index.time(segment_start + start_pos))
+                stools.print_results(detected_peaks, out_path, station = index.headers[0]['station'])
+            n_picks += len(detected_peaks)
+
+    scan_time = sum(t for stage, t in timer.stages.items() if stage not in ['model_load', 'warmup'])
+
+    return {'weights': weights,
+            'backend': backend,
+            'samples': n_samples,
+            'windows': n_windows,
+            'picks': n_picks,
+            'scan_time': scan_time,
+            'samples_per_second': n_samples / scan_time,
+            'windows_per_second': n_windows / timer.stages.get('predict', float('nan')),
+            'stages': timer.stages}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--models', help = 'Models to benchmark, default: favor cnn gpd', nargs = '+',
+                        default = ['favor', 'cnn', 'gpd'])
+    parser.add_argument('--duration', help = 'Synthetic archives duration in seconds, default: 86400',
+                        default = 86400.)
+    parser.add_argument('--dir', help = 'Directory for synthetic archives and predictions,'
+                                        ' default: temporary directory', default = None)
+    parser.add_argument('--out', '-o', help = 'Path to output JSON file, default: print to stdout', default = None)
+    parser.add_argument('--batch-size', help = 'Model batch size, default: 150', default = 150)
+    parser.add_argument('--trace-size', help = 'Length of processed stream chunks in seconds, default: 600',
+                        default = 600)
+    parser.add_argument('--shift', help = 'Sliding windows shift, default: 10 samples', default = 10)
+    parser.add_argument('--threshold', help = 'Positive prediction threshold, default: 0.998', default = 0.998)
+    parser.add_argument('--no-filter', help = 'Do not filter input waveforms', action = 'store_true')
+    parser.add_argument('--no-detrend', help = 'Do not detrend input waveforms', action = 'store_true')
+    parser.add_argument('--cpu', help = 'Disable GPU usage', action = 'store_true')
+    parser.add_argument('--dtype', help = 'Waveforms data type, default: float32',
+                        choices = ['float64', 'float32', 'float16'], default = 'float32')
+    parser.add_argument('--backends', help = 'Inference backends to benchmark every model with: keras, function,'
+                                             ' default: keras', nargs = '+', choices = ['keras', 'function'],
+                        default = ['keras'])
+
+    args = parser.parse_args()
+
+    if args.cpu:
+        os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
+
+    args.duration = float(args.duration)
+    args.batch_size = int(args.batch_size)
+    args.trace_size = float(args.trace_size)
+    args.shift = int(args.shift)
+    args.threshold = float(args.threshold)
+
+    if not args.dir:
+        args.dir = tempfile.mkdtemp(prefix = 'seismo_bench_')
+
+    from benchmarks.synthetic import write_synthetic_group
+
+    start_time = time()
+    paths, events = write_synthetic_group(args.dir, duration = args.duration)
+    generation_time = time() - start_time
+
+    results = {'config': {'duration': args.duration,
+                          'batch_size': args.batch_size,
+                          'trace_size': args.trace_size,
+                          'shift': args.shift,
+                          'threshold': args.threshold,
+                          'no_filter': args.no_filter,
+                          'no_detrend': args.no_detrend,
+                          'dtype': args.dtype,
+                          'injected_events': len(events),
+                          'generation_time': generation_time},
+               'platform': {'python': platform.python_version(),
+                            'machine': platform.machine(),
+                            'cpu_count': os.cpu_count()},
+               'models': {}}
+
+    for name in args.models:
+        for backend in args.backends:
+
+            # Results of several backends are stored as "<model>/<backend>"
+            key = name if len(args.backends) == 1 else f'{name}/{backend}'
+
+            print(f'Benchmarking {key}..', file = sys.stderr)
+            results['models'][key] = benchmark_model(name, paths, args, backend = backend)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent = 2)
+    else:
+        print(json.dumps(results, indent = 2))
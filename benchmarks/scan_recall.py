@@ -0,0 +1,245 @@
+"""
+Fast scan modes recall check: scans the same synthetic (or given) archive group with the full --shift scan, with
+two-pass scans of every coarse stride (--coarse, see archive_scan.py --coarse-stride) and with every energy
+pre-trigger method and threshold (--gate, see archive_scan.py --gate), and reports number of predicted windows and
+picks recall against the full scan as JSON. Both checks are done, if neither --coarse nor --gate is set.
+For synthetic archives, picks are also matched against the injected P and S arrivals, as labelled picks.
+
+Usage example (from the repository root):
+
+python -m benchmarks.scan_recall --duration 3600 --model favor --coarse --strides 100 150 200 --out recall.json
+python -m benchmarks.scan_recall --duration 3600 --model favor --gate --methods stalta energy --thresholds 1.5 2 3
+"""
+import os
+import sys
+import json
+import argparse
+
+# Silence tensorflow warnings
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+
+def scan_with_options(model, traces, args, **options):
+    """
+    Scans traces with the scan options, e.g. coarse_stride or gate (see archive_scan.py), default: full scan.
+    :return: tuple (number of predicted windows, picks), picks is a dictionary of label: array of pick sample
+        positions (arrival samples, relative to the traces start)
+    """
+    import numpy as np
+    import utils.scan_tools as stools
+    from utils.archive_scanner import n_features
+    from utils.instrumentation import Metrics
+
+    model_labels = {'p': 0, 's': 1, 'n': 2}
+    positive_labels = {'p': 0, 's': 1}
+    threshold_labels = {'p': args.threshold, 's': args.threshold}
+
+    scan_args = argparse.Namespace(shift = args.shift, batch_size = args.batch_size, shared_stft = False,
+                                   plot_positives = False, plot_positives_original = False, dtype = 'float32',
+                                   coarse_stride = None, gate = None)
+    for name, value in options.items():
+        setattr(scan_args, name, value)
+
+    metrics = Metrics()
+    scores, _ = stools.scan_traces(*traces, model = model, args = scan_args, n_features = n_features,
+                                   metrics = metrics, trigger_labels = list(positive_labels.values()))
+
+    restored = stools.restore_scores(scores, (len(traces[0]), len(model_labels)), args.shift)
+    predicted_labels = stools.pick_positives(restored, model_labels, positive_labels, threshold_labels)
+
+    # Window position to the arrival sample, same as in get_detected_peaks
+    picks = {label: np.array([pos + n_features // 2 for pos, _ in positives], dtype = int)
+             for label, positives in predicted_labels.items()}
+
+    return metrics.counters['windows'], picks
+
+
+def arrival_labels(traces, events):
+    """
+    Returns injected synthetic arrivals as labelled picks: dictionary of label: array of arrival sample positions,
+    relative to the traces start.
+    :param events: list of (P arrival, S arrival), see benchmarks.synthetic.synthetic_group
+    """
+    import numpy as np
+
+    t_start = traces[0].stats.starttime
+    frequency = traces[0].stats.sampling_rate
+
+    return {label: np.array([int(round((event[i] - t_start) * frequency)) for event in events], dtype = int)
+            for i, label in enumerate(['p', 's'])}
+
+
+def recall(reference_windows, reference_picks, windows, picks, labels, args):
+    """
+    Returns recall report of the scan against the full scan and the labelled picks.
+    """
+    from benchmarks.precision_check import compare_picks
+
+    result = {'windows': int(windows),
+              'reduction': reference_windows / windows if windows else float('inf'),
+              'picks': {label: compare_picks(reference_picks[label], picks[label], args.tolerance)
+                        for label in reference_picks}}
+    if labels:
+        result['labels'] = {label: compare_picks(labels[label], picks[label], args.label_tolerance)
+                            for label in labels}
+
+    return result
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', help = 'Model: favor, cnn or gpd, default: favor', default = 'favor')
+    parser.add_argument('--weights', '-w', help = 'Path to model weights, default: model default weights',
+                        default = None)
+    parser.add_argument('--archives', help = 'N, E, Z archive paths to scan, default: synthetic archives',
+                        nargs = 3, default = None)
+    parser.add_argument('--duration', help = 'Synthetic archives duration in seconds, default: 3600',
+                        default = 3600.)
+    parser.add_argument('--out', '-o', help = 'Path to output JSON file, default: print to stdout', default = None)
+    parser.add_argument('--batch-size', help = 'Model batch size, default: 150', default = 150)
+    parser.add_argument('--shift', help = 'Sliding windows shift, default: 10 samples', default = 10)
+    parser.add_argument('--threshold', help = 'Positive prediction threshold, default: 0.998', default = 0.998)
+    parser.add_argument('--coarse', help = 'Check coarse-to-fine scans (--coarse-stride)', action = 'store_true')
+    parser.add_argument('--strides', help = 'Coarse pass strides in samples, default: 50 100 150 200',
+                        nargs = '+', default = [50, 100, 150, 200])
+    parser.add_argument('--coarse-threshold', help = 'Coarse pass score, which triggers fine rescan, default: 0.05',
+                        default = 0.05)
+    parser.add_argument('--coarse-padding', help = 'Fine rescan padding in samples, default: 200', default = 200)
+    parser.add_argument('--gate', help = 'Check energy pre-trigger scans (--gate)', action = 'store_true')
+    parser.add_argument('--methods', help = 'Gate methods: stalta and/or energy, default: stalta energy',
+                        nargs = '+', choices = ['stalta', 'energy'], default = ['stalta', 'energy'])
+    parser.add_argument('--thresholds', help = 'Gate thresholds, default: 1.5 2 3', nargs = '+',
+                        default = [1.5, 2., 3.])
+    parser.add_argument('--sta', help = 'Short term average length, default: 1 second', default = 1.)
+    parser.add_argument('--lta', help = 'Long term average length, default: 20 seconds', default = 20.)
+    parser.add_argument('--padding', help = 'Gate padding in samples, default: 200', default = 200)
+    parser.add_argument('--tolerance', help = 'Max pick offset in samples to match full scan pick, default: 10',
+                        default = 10)
+    parser.add_argument('--label-tolerance', help = 'Max pick offset in samples to match injected synthetic'
+                                                    ' arrival, default: 100', default = 100)
+    parser.add_argument('--no-filter', help = 'Do not filter input waveforms', action = 'store_true')
+    parser.add_argument('--no-detrend', help = 'Do not detrend input waveforms', action = 'store_true')
+    parser.add_argument('--cpu', help = 'Disable GPU usage', action = 'store_true')
+
+    args = parser.parse_args()
+
+    args.duration = float(args.duration)
+    args.batch_size = int(args.batch_size)
+    args.shift = int(args.shift)
+    args.threshold = float(args.threshold)
+    args.strides = [int(stride) for stride in args.strides]
+    args.coarse_threshold = float(args.coarse_threshold)
+    args.coarse_padding = int(args.coarse_padding)
+    args.thresholds = [float(threshold) for threshold in args.thresholds]
+    args.sta = float(args.sta)
+    args.lta = float(args.lta)
+    args.padding = int(args.padding)
+    args.tolerance = int(args.tolerance)
+    args.label_tolerance = int(args.label_tolerance)
+
+    if not args.coarse and not args.gate:
+        args.coarse = args.gate = True
+
+    wrong_strides = [stride for stride in args.strides if stride <= args.shift or stride % args.shift]
+    if args.coarse and wrong_strides:
+        parser.print_help()
+        sys.stderr.write(f'ERROR: --strides should be multiples of --shift and larger than --shift:'
+                         f' {", ".join(map(str, wrong_strides))}')
+        sys.exit(2)
+
+    if args.gate and not 0 < args.sta < args.lta:
+        parser.print_help()
+        sys.stderr.write('ERROR: --sta should be positive and shorter than --lta')
+        sys.exit(2)
+
+    if args.cpu:
+        os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    from obspy import read
+    import utils.scan_tools as stools
+    from benchmarks.scan_benchmark import load_benchmark_model
+    from benchmarks.synthetic import synthetic_group
+    from benchmarks.precision_check import compare_picks
+
+    events = None
+    if args.archives:
+        streams = [read(path) for path in args.archives]
+    else:
+        streams, events = synthetic_group(duration = args.duration)
+
+    for st in streams:
+        stools.pre_process_stream(st, args.no_filter, args.no_detrend)
+
+    streams = stools.trim_streams(streams)
+    traces = stools.get_traces(streams, 0)
+    frequency = traces[0].stats.sampling_rate
+
+    # Injected arrivals as labelled picks
+    labels = arrival_labels(traces, events) if events else None
+
+    model, weights = load_benchmark_model(args.model, args.weights)
+    model.warmup(args.batch_size)
+
+    reference_windows, reference_picks = scan_with_options(model, traces, args)
+
+    report = {'model': args.model,
+              'weights': weights,
+              'threshold': args.threshold,
+              'windows': int(reference_windows),
+              'reference_picks': {label: int(picks.shape[0]) for label, picks in reference_picks.items()}}
+
+    if labels:
+        report['labels'] = {label: compare_picks(labels[label], reference_picks[label], args.label_tolerance)
+                            for label in labels}
+
+    if args.coarse:
+
+        report['coarse'] = {'coarse_threshold': args.coarse_threshold,
+                            'coarse_padding': args.coarse_padding,
+                            'strides': {}}
+
+        for stride in args.strides:
+
+            windows, picks = scan_with_options(model, traces, args, coarse_stride = stride,
+                                               coarse_threshold = args.coarse_threshold,
+                                               coarse_padding = args.coarse_padding)
+
+            result = recall(reference_windows, reference_picks, windows, picks, labels, args)
+            report['coarse']['strides'][stride] = result
+
+            missed = sum(x['missed'] for x in result['picks'].values())
+            print(f'stride {stride}: {windows} windows ({result["reduction"]:.1f}x fewer), {missed} full scan picks'
+                  f' missed', file = sys.stderr)
+
+    if args.gate:
+
+        report['gate'] = {'sta': args.sta,
+                          'lta': args.lta,
+                          'padding': args.padding,
+                          'gates': {}}
+
+        for method in args.methods:
+            for threshold in args.thresholds:
+
+                windows, picks = scan_with_options(model, traces, args, gate = method, gate_threshold = threshold,
+                                                   gate_sta = int(args.sta * frequency),
+                                                   gate_lta = int(args.lta * frequency),
+                                                   gate_padding = args.padding)
+
+                result = recall(reference_windows, reference_picks, windows, picks, labels, args)
+                result.update({'method': method, 'gate_threshold': threshold})
+                report['gate']['gates'][f'{method}_{threshold}'] = result
+
+                missed = sum(x['missed'] for x in result['picks'].values())
+                print(f'{method} {threshold}: {windows} windows ({result["reduction"]:.1f}x fewer), {missed}'
+                      f' full scan picks missed', file = sys.stderr)
+
+    text = json.dumps(report, indent = 2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
@@ -0,0 +1,140 @@
+"""
+Startup time benchmark: measures wall time of the scanner commands and module imports in fresh interpreter
+processes, and lists the slowest imports of every target (python -X importtime), as JSON.
+
+Usage example (from the repository root):
+
+python -m benchmarks.startup --repeat 5 --out startup.json
+python -m benchmarks.startup --targets help archive_scanner model_load --top 20
+
+Targets:
+- "help" - archive_scan.py --help
+- "realtime_help" - realtime_scan.py --help
+- "validate" - archive_scan.py on the input file with invalid options, exits after input and options validation
+- "scan_tools", "archive_scanner" - import of the utils modules
+- "tensorflow" - import of TensorFlow alone, lower bound of the model load time
+- "model_load" - archive_scanner.load_model with default options (random weights, if weights file does not exist)
+"""
+import os
+import re
+import sys
+import json
+import argparse
+import platform
+import subprocess
+from time import time
+
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+model_load_code = """
+import argparse, os
+import utils.archive_scanner as scanner
+args = argparse.Namespace(weights = None, cnn = False, gpd = False, model = None, loader_argv = None,
+                          saved_model = None, backend = None, tflite_model = None, shared_stft = False, shift = 10,
+                          intra_op_threads = None, inter_op_threads = None)
+if not os.path.exists(scanner.default_weights['favor']):
+    import utils.seismo_load as seismo_load
+    seismo_load.load_performer(None, compile = False)
+else:
+    scanner.load_model(args)
+"""
+
+
+def target_commands(input_path):
+    """
+    Returns dictionary of target name: command arguments, run with the current interpreter.
+    """
+    return {'help': ['archive_scan.py', '--help'],
+            'realtime_help': ['realtime_scan.py', '--help'],
+            'validate': ['archive_scan.py', input_path, '--pack-batches', '--shared-stft'],
+            'scan_tools': ['-c', 'import utils.scan_tools'],
+            'archive_scanner': ['-c', 'import utils.archive_scanner'],
+            'tensorflow': ['-c', 'import tensorflow'],
+            'model_load': ['-c', model_load_code]}
+
+
+def run(command, importtime = False):
+    """
+    Runs command in a fresh interpreter from the repository root.
+    :return: tuple (wall time, stderr)
+    """
+    env = dict(os.environ, TF_CPP_MIN_LOG_LEVEL = '3')
+    arguments = [sys.executable] + (['-X', 'importtime'] if importtime else []) + command
+
+    start_time = time()
+    result = subprocess.run(arguments, cwd = root, env = env, stdout = subprocess.DEVNULL,
+                            stderr = subprocess.PIPE, universal_newlines = True)
+
+    return time() - start_time, result.stderr
+
+
+def slowest_imports(stderr, top = 10):
+    """
+    Parses python -X importtime output.
+    :return: list of {"module", "self", "cumulative"} times in seconds of the top level imports, slowest first
+    """
+    imports = []
+    for line in stderr.splitlines():
+
+        match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)', line)
+        if not match or len(match.group(3)) > 1:
+            continue
+
+        imports.append({'module': match.group(4),
+                        'self': int(match.group(1)) / 1e6,
+                        'cumulative': int(match.group(2)) / 1e6})
+
+    imports.sort(key = lambda x: -x['cumulative'])
+
+    return imports[:top]
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--targets', help = 'Targets to benchmark, default: all', nargs = '+', default = None)
+    parser.add_argument('--repeat', help = 'Number of runs of every target, default: 3', default = 3)
+    parser.add_argument('--top', help = 'Number of slowest top level imports to report, default: 10', default = 10)
+    parser.add_argument('--input', help = 'archive_scan.py input file for the "validate" target,'
+                                          ' default: test/nysh_archives.txt', default = 'test/nysh_archives.txt')
+    parser.add_argument('--out', '-o', help = 'Path to output JSON file, default: print to stdout', default = None)
+
+    args = parser.parse_args()
+
+    args.repeat = int(args.repeat)
+    args.top = int(args.top)
+
+    commands = target_commands(args.input)
+    targets = args.targets or list(commands)
+
+    unknown = [target for target in targets if target not in commands]
+    if unknown:
+        parser.print_help()
+        sys.stderr.write(f'ERROR: Unknown targets: {", ".join(unknown)}')
+        sys.exit(2)
+
+    results = {}
+    for target in targets:
+
+        times = [run(commands[target])[0] for _ in range(args.repeat)]
+        _, stderr = run(commands[target], importtime = True)
+
+        results[target] = {'min': min(times),
+                           'mean': sum(times) / len(times),
+                           'max': max(times),
+                           'imports': slowest_imports(stderr, args.top)}
+
+        print(f'{target}: {min(times):.3f} s', file = sys.stderr)
+
+    report = {'platform': {'python': platform.python_version(),
+                           'machine': platform.machine(),
+                           'processor': platform.processor()},
+              'repeat': args.repeat,
+              'targets': results}
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent = 2)
+    else:
+        print(json.dumps(report, indent = 2))
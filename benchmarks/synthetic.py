@@ -0,0 +1,98 @@
+"""
+Synthetic 3-component miniSEED archives for benchmarks: band-limited noise with injected P-like
+(high frequency, strongest on Z channel) and S-like (lower frequency, strongest on horizontal channels)
+transients.
+
+Usage example:
+
+from benchmarks.synthetic import write_synthetic_group
+paths, events = write_synthetic_group('bench_data', duration = 86400.)
+"""
+import os
+import numpy as np
+from obspy import Stream, Trace, UTCDateTime
+
+
+def transient(n_samples, frequency, dominant_frequency, rise, decay, rng):
+    """
+    Returns transient waveform: noise burst around dominant frequency with exponential envelope.
+    :param n_samples: length in samples
+    :param frequency: sampling rate
+    :param dominant_frequency: burst dominant frequency in Hz
+    :param rise: envelope rise time in seconds
+    :param decay: envelope decay time in seconds
+    :param rng: numpy random generator
+    """
+    t = np.arange(n_samples) / frequency
+    envelope = (1. - np.exp(-t / rise)) * np.exp(-t / decay)
+    phase = rng.uniform(0, 2 * np.pi)
+    carrier = np.sin(2 * np.pi * dominant_frequency * t + phase) + 0.3 * rng.standard_normal(n_samples)
+    return envelope * carrier
+
+
+def synthetic_group(duration = 86400., frequency = 100., events_per_hour = 6, noise_level = 100.,
+                    starttime = UTCDateTime(2021, 4, 1), station = 'SYNT', seed = 42):
+    """
+    Returns list of N, E, Z streams with synthetic data and list of injected events.
+    :param duration: archives duration in seconds
+    :param frequency: sampling rate
+    :param events_per_hour: number of injected events per hour
+    :param noise_level: noise standard deviation in counts
+    :param starttime: archives start time
+    :param station: station code
+    :param seed: random seed
+    :return: tuple (streams, events), events is a list of (P arrival UTCDateTime, S arrival UTCDateTime)
+    """
+    rng = np.random.default_rng(seed)
+    n_samples = int(duration * frequency)
+
+    data = rng.standard_normal((3, n_samples)) * noise_level
+
+    events = []
+    n_events = int(duration / 3600. * events_per_hour)
+    for p_time in np.sort(rng.uniform(10., duration - 60., n_events)):
+
+        s_time = p_time + rng.uniform(2., 15.)
+        amplitude = noise_level * rng.uniform(5., 50.)
+
+        p_pos = int(p_time * frequency)
+        p_wave = transient(min(int(20 * frequency), n_samples - p_pos), frequency, 8., 0.05, 2., rng)
+        for channel, weight in enumerate([0.3, 0.3, 1.]):
+            data[channel, p_pos : p_pos + p_wave.shape[0]] += amplitude * weight * p_wave
+
+        s_pos = int(s_time * frequency)
+        s_wave = transient(min(int(30 * frequency), n_samples - s_pos), frequency, 3., 0.2, 4., rng)
+        for channel, weight in enumerate([1., 1., 0.4]):
+            data[channel, s_pos : s_pos + s_wave.shape[0]] += 2. * amplitude * weight * s_wave
+
+        events.append((starttime + p_time, starttime + s_time))
+
+    streams = []
+    for channel, code in enumerate(['EHN', 'EHE', 'EHZ']):
+        header = {'network': 'XX', 'station': station, 'location': '00', 'channel': code,
+                  'sampling_rate': frequency, 'starttime': starttime}
+        streams.append(Stream([Trace(data = data[channel].astype(np.int32), header = header)]))
+
+    return streams, events
+
+
+def write_synthetic_group(path, **kwargs):
+    """
+    Writes synthetic N, E, Z miniSEED archives into the directory.
+    :param path: output directory
+    :param kwargs: synthetic_group arguments
+    :return: tuple (archive paths, events)
+    """
+    os.makedirs(path, exist_ok = True)
+
+    streams, events = synthetic_group(**kwargs)
+
+    paths = []
+    for st in streams:
+        stats = st[0].stats
+        file_path = os.path.join(path, f'{stats.station}.{stats.network}.{stats.location}.{stats.channel}'
+                                       f'.{stats.starttime.year}.{stats.starttime.julday:03d}')
+        st.write(file_path, format = 'MSEED', encoding = 'STEIM2')
+        paths.append(file_path)
+
+    return paths, events
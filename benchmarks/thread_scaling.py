@@ -0,0 +1,171 @@
+"""
+CPU thread scaling benchmark: measures model throughput (windows per second) against the number of threads
+for every model weights file in WEIGHTS/, and reports it as JSON.
+
+Every measurement runs in a fresh process, because TensorFlow thread pools can be set only once: the process is
+pinned to the first N available CPUs, TensorFlow intra-op and BLAS threads are set to N and inter-op threads to 1
+(see utils/cpu_config.py and archive_scan.py --intra-op-threads).
+
+Usage example (from the repository root):
+
+python -m benchmarks.thread_scaling --cpu --out scaling.json
+python -m benchmarks.thread_scaling --weights WEIGHTS/w_model_cnn_v2.0.h5 --threads 1 2 4 8 16 --duration 20
+"""
+import os
+import sys
+import glob
+import json
+import argparse
+import platform
+import subprocess
+from time import time
+
+# Silence tensorflow warnings
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def default_threads(n_cpus):
+    """
+    Returns thread counts: powers of two up to the number of CPUs, and the number of CPUs.
+    """
+    threads = []
+    n = 1
+    while n < n_cpus:
+        threads.append(n)
+        n *= 2
+    threads.append(n_cpus)
+
+    return threads
+
+
+def measure(name, weights, threads, batch_size = 150, duration = 10., backend = 'keras', affinity = True):
+    """
+    Measures model throughput in the current process, should be called before TensorFlow initialization.
+    :return: dictionary with "windows_per_second" and "batches"
+    """
+    from utils.cpu_config import available_cpus, configure_process, configure_tensorflow
+
+    configure_process(available_cpus()[:threads] if affinity else None, blas_threads = threads)
+    configure_tensorflow(intra_op_threads = threads, inter_op_threads = 1)
+
+    import numpy as np
+    from benchmarks.scan_benchmark import load_benchmark_model
+
+    model, _ = load_benchmark_model(name, weights, backend)
+    model.warmup(batch_size)
+
+    rng = np.random.default_rng(0)
+    x = rng.standard_normal((batch_size, *model.input_spec.shape[1:])).astype(model.input_spec.dtype)
+
+    n_batches = 0
+    start_time = time()
+    while time() - start_time < duration:
+        model.infer_batch(x)
+        n_batches += 1
+    elapsed = time() - start_time
+
+    return {'windows_per_second': n_batches * batch_size / elapsed, 'batches': n_batches}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--weights', help = 'Model weights files, default: every weights file in WEIGHTS/',
+                        nargs = '+', default = None)
+    parser.add_argument('--threads', help = 'Thread counts, default: powers of two up to the number of available'
+                                            ' CPUs', nargs = '+', default = None)
+    parser.add_argument('--batch-size', help = 'Model batch size, default: 150', default = 150)
+    parser.add_argument('--duration', help = 'Duration of every measurement in seconds, default: 10', default = 10.)
+    parser.add_argument('--backend', help = 'Inference backend: keras or function, default: keras',
+                        choices = ['keras', 'function'], default = 'keras')
+    parser.add_argument('--no-affinity', help = 'Do not pin measurement processes to CPUs', action = 'store_true')
+    parser.add_argument('--cpu', help = 'Disable GPU usage', action = 'store_true')
+    parser.add_argument('--out', '-o', help = 'Path to output JSON file, default: print to stdout', default = None)
+    parser.add_argument('--measure', help = argparse.SUPPRESS, nargs = 3, default = None)
+
+    args = parser.parse_args()
+
+    if args.cpu:
+        os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
+
+    args.batch_size = int(args.batch_size)
+    args.duration = float(args.duration)
+
+    sys.path.insert(0, root)
+
+    # Single measurement process: --measure NAME WEIGHTS THREADS
+    if args.measure:
+        name, weights, threads = args.measure
+        result = measure(name, weights, int(threads), args.batch_size, args.duration, args.backend,
+                         affinity = not args.no_affinity)
+        print(json.dumps(result))
+        sys.exit(0)
+
+    from export_model import model_name
+    from utils.cpu_config import available_cpus
+
+    n_cpus = len(available_cpus())
+    threads = [int(n) for n in args.threads] if args.threads else default_threads(n_cpus)
+
+    weights = args.weights
+    if not weights:
+        weights = sorted(glob.glob(os.path.join(root, 'WEIGHTS', '*.h5')) +
+                         glob.glob(os.path.join(root, 'WEIGHTS', '*.hd5')))
+
+    results = {}
+    for path in weights:
+
+        name = model_name(path)
+        model_results = {'model': name, 'threads': {}}
+        results[os.path.basename(path)] = model_results
+
+        for n in threads:
+
+            command = [sys.executable, '-m', 'benchmarks.thread_scaling', '--measure', name, path, str(n),
+                       '--batch-size', str(args.batch_size), '--duration', str(args.duration),
+                       '--backend', args.backend]
+            if args.no_affinity:
+                command.append('--no-affinity')
+            if args.cpu:
+                command.append('--cpu')
+
+            process = subprocess.run(command, cwd = root, stdout = subprocess.PIPE, stderr = subprocess.PIPE,
+                                     universal_newlines = True)
+            if process.returncode:
+                error = process.stderr.strip().splitlines()[-1:] or ['unknown error']
+                model_results['error'] = error[0]
+                print(f'{os.path.basename(path)}: {error[0]}', file = sys.stderr)
+                break
+
+            result = json.loads(process.stdout.strip().splitlines()[-1])
+            model_results['threads'][n] = result
+            print(f'{os.path.basename(path)} ({name}), {n} threads: {result["windows_per_second"]:.1f} windows/s',
+                  file = sys.stderr)
+
+        # Parallel efficiency relative to a single thread
+        measured = model_results['threads']
+        if measured and min(measured) == 1:
+            base = measured[1]['windows_per_second']
+            for n, result in measured.items():
+                result['speedup'] = result['windows_per_second'] / base
+                result['efficiency'] = result['speedup'] / n
+
+    report = {'platform': {'python': platform.python_version(),
+                           'machine': platform.machine(),
+                           'processor': platform.processor(),
+                           'cpu_count': os.cpu_count(),
+                           'available_cpus': n_cpus},
+              'batch_size': args.batch_size,
+              'duration': args.duration,
+              'backend': args.backend,
+              'affinity': not args.no_affinity,
+              'models': results}
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent = 2)
+    else:
+        print(json.dumps(report, indent = 2))
@@ -0,0 +1,116 @@
+import argparse
+import glob
+import sys
+
+# Silence tensorflow warnings
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+
+def model_name(weights_path):
+    """
+    Guesses model name by the weights file name: "cnn", "gpd" or "favor".
+    """
+    file_name = os.path.basename(weights_path).lower()
+    if 'cnn' in file_name:
+        return 'cnn'
+    if 'gpd' in file_name:
+        return 'gpd'
+    return 'favor'
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Exports inference-only SavedModel artifacts, which are loaded'
+                                                   ' by archive_scan.py instead of rebuilding Keras models, or'
+                                                   ' quantized TFLite models for archive_scan.py --backend tflite.')
+    parser.add_argument('--weights', '-w', help = 'Paths to model weights files, default: every weights file'
+                                                  ' in WEIGHTS/', nargs = '+', default = None)
+    parser.add_argument('--cnn', help = 'Weights are Spec-CNN model weights', action = 'store_true')
+    parser.add_argument('--gpd', help = 'Weights are GPD model weights', action = 'store_true')
+    parser.add_argument('--favor', help = 'Weights are Seismo-Performer model weights', action = 'store_true')
+    parser.add_argument('--out', '-o', help = 'Artifact path, single --weights only, default: weights path'
+                                              ' with .savedmodel or .<mode>.tflite extension', default = None)
+    parser.add_argument('--tflite', help = 'Convert to TFLite model with "dynamic" range or full "int8" quantization'
+                                           ' instead of SavedModel export, default: None',
+                        choices = ['dynamic', 'int8'], default = None)
+    parser.add_argument('--calibration-data', help = 'Path to HDF5 dataset (see h5_generator.py) with int8'
+                                                     ' quantization calibration windows', default = None)
+    parser.add_argument('--calibration-size', help = 'Number of int8 calibration windows, default: 1000',
+                        default = 1000)
+    parser.add_argument('--cpu', help = 'Disable GPU usage', action = 'store_true')
+
+    args = parser.parse_args()
+
+    if args.cpu:
+        os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
+
+    weights = args.weights
+    if not weights:
+        weights = sorted(glob.glob(os.path.join('WEIGHTS', '*.h5')) + glob.glob(os.path.join('WEIGHTS', '*.hd5')))
+
+    if not weights:
+        parser.print_help()
+        sys.stderr.write('ERROR: No weights files found')
+        sys.exit(2)
+
+    if args.out and len(weights) > 1:
+        parser.print_help()
+        sys.stderr.write('ERROR: --out can be used only with a single --weights file')
+        sys.exit(2)
+
+    if args.tflite == 'int8' and not args.calibration_data:
+        parser.print_help()
+        sys.stderr.write('ERROR: --tflite int8 requires --calibration-data')
+        sys.exit(2)
+
+    args.calibration_size = int(args.calibration_size)
+
+    from utils.exported_model import export_model, exported_path
+    from utils.tflite_model import convert_tflite, tflite_path, h5_calibration_data
+
+    failed = False
+    for weights_path in weights:
+
+        if args.cnn:
+            name = 'cnn'
+        elif args.gpd:
+            name = 'gpd'
+        elif args.favor:
+            name = 'favor'
+        else:
+            name = model_name(weights_path)
+
+        try:
+            if name == 'cnn':
+                import utils.seismo_load as seismo_load
+                model = seismo_load.load_cnn(weights_path, compile = False)
+            elif name == 'gpd':
+                from utils.gpd_loader import load_model as load_gpd
+                model = load_gpd(weights_path, compile = False)
+            else:
+                import utils.seismo_load as seismo_load
+                model = seismo_load.load_performer(weights_path, compile = False)
+        except (OSError, ValueError) as e:
+            print(f'Skipped {weights_path}: failed to load {name} model weights: {e}')
+            failed = True
+            continue
+
+        if args.tflite:
+
+            calibration_data = None
+            if args.tflite == 'int8':
+                calibration_data = h5_calibration_data(args.calibration_data, args.calibration_size)
+
+            path = args.out or tflite_path(weights_path, args.tflite)
+            with open(path, 'wb') as f:
+                f.write(convert_tflite(model, args.tflite, calibration_data))
+
+        else:
+            path = args.out or exported_path(weights_path)
+            export_model(model, path, weights_path = weights_path, model_name = name)
+
+        print(f'Exported {weights_path} ({name}) to {path}')
+
+    if failed:
+        sys.exit(1)
@@ -1,7 +1,5 @@
+import sys
 import argparse
-import h5py as h5
-import numpy as np
-import pandas as pd
 
 # Silence tensorflow warnings
 import os
@@ -18,14 +16,42 @@ if __name__ == '__main__':
     parser.add_argument('--favor', help = 'Use Fast-Attention version of the Seismo-Performer',
                         action = 'store_true')
     parser.add_argument('--model', help = 'Custom model loader module import path')
+    parser.add_argument('--saved-model', help = 'Path to inference-only model artifact exported by export_model.py')
     parser.add_argument('--data', '-d', help = 'Dataset file path')
     parser.add_argument('--out', '-o', help = 'Output file path', default = 'prc_out.csv')
     parser.add_argument('--loader-argv', help = 'Output file path')
+    parser.add_argument('--tflite', help = 'Path to TFLite model, converted from the same weights by'
+                                           ' export_model.py --tflite, to compare its accuracy with the float model')
 
     args = parser.parse_args()
 
+    if args.cnn and args.favor:
+        parser.print_help()
+        sys.stderr.write('ERROR: --cnn and --favor can not be used together')
+        sys.exit(2)
+
+    # Exported artifact is a complete model, model selection options would be silently ignored
+    if args.saved_model and (args.cnn or args.favor or args.weights or args.model):
+        parser.print_help()
+        sys.stderr.write('ERROR: --saved-model can not be used with --cnn, --favor, --weights or --model')
+        sys.exit(2)
+
+    if args.model and (args.cnn or args.favor):
+        parser.print_help()
+        sys.stderr.write('ERROR: --model can not be used with --cnn or --favor')
+        sys.exit(2)
+
+    import h5py as h5
+    import numpy as np
+    import pandas as pd
+
     # Load model
-    if args.model:
+    if args.saved_model:
+
+        from utils.exported_model import ExportedModel
+        model = ExportedModel(args.saved_model)
+
+    elif args.model:
 
         # TODO: Check if loader_argv is set and check (if possible) loader_call if it receives arguments
         #       Print warning then if loader_argv is not set and print help message about custom models
@@ -55,12 +81,14 @@ if __name__ == '__main__':
 
         import utils.seismo_load as seismo_load
 
+        # Seismo-Performer (--favor) is the default model, --tflite models are compared with this float model
         if args.cnn:
-            model = seismo_load.load_cnn(args.weights)
-        elif args.favor:
-            model = seismo_load.load_favor(args.weights)
+            model = seismo_load.load_cnn(args.weights, compile = False)
         else:
-            model = seismo_load.load_transformer(args.weights)
+            model = seismo_load.load_performer(args.weights, compile = False)
+
+    from utils.backends import as_backend
+    model = as_backend(model)
 
     # Load data with h5_generator
     from h5_generator import train_test_split as h5_tts
@@ -85,5 +113,24 @@ if __name__ == '__main__':
         'Y_score': Y_scores
     }
 
+    # Compare quantized model with the float model
+    if args.tflite:
+
+        from utils.tflite_model import TFLiteModel
+
+        tflite_scores = TFLiteModel(args.tflite).predict(X_test)
+
+        data['Y_pred_tflite'] = np.argmax(tflite_scores, axis = 1)
+        data['Y_score_tflite'] = np.max(tflite_scores, axis = 1)
+
+        accuracy = np.mean(data['Y_pred'] == Y)
+        tflite_accuracy = np.mean(data['Y_pred_tflite'] == Y)
+
+        print(f'Float model accuracy: {accuracy:.6f}')
+        print(f'TFLite model accuracy: {tflite_accuracy:.6f}')
+        print(f'Accuracy difference: {tflite_accuracy - accuracy:+.6f}')
+        print(f'Predictions agreement: {np.mean(data["Y_pred"] == data["Y_pred_tflite"]):.6f}')
+        print(f'Max scores difference: {np.max(np.abs(tflite_scores - scores)):.6f}')
+
     df = pd.DataFrame(data)
     df.to_csv(args.out, index = False)
@@ -0,0 +1,216 @@
+import argparse
+import json
+import sys
+from time import time
+
+# Silence tensorflow warnings
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+
+if __name__ == '__main__':
+
+    # Command line arguments parsing
+    parser = argparse.ArgumentParser(description = 'Real-time phase picking on miniSEED records stream from a TCP'
+                                                   ' server (e.g. benchmarks/replay.py) or a growing file.')
+    parser.add_argument('--tcp', help = 'TCP server address to read miniSEED records from, format: HOST:PORT',
+                        default = None)
+    parser.add_argument('--follow', help = 'Path to growing miniSEED file to read appended records from',
+                        default = None)
+    parser.add_argument('--follow-timeout', help = 'Stop if --follow file does not grow for this number of'
+                                                   ' seconds, default: None (follow forever)', default = None)
+    parser.add_argument('--record-length', help = 'miniSEED record length in bytes, default: 512', default = 512)
+    parser.add_argument('--weights', '-w', help = 'Path to model weights', default = None)
+    parser.add_argument('--cnn', help = 'Use simple CNN model on top of spectrogram', action = 'store_true')
+    parser.add_argument('--gpd', help = 'Use GPD model', action = 'store_true')
+    parser.add_argument('--model', help = 'Custom model loader import, default: None', default = None)
+    parser.add_argument('--loader_argv', help = 'Custom model loader arguments, default: None', default = None)
+    parser.add_argument('--saved-model', help = 'Path to inference-only model artifact exported by export_model.py,'
+                                                ' default: artifact of the --weights, if it is exported and'
+                                                ' --backend is not set',
+                        default = None)
+    parser.add_argument('--backend', help = 'Inference backend: "keras", "function" or "tflite", see'
+                                            ' archive_scan.py -h, default: exported SavedModel of the --weights,'
+                                            ' if it is exported, otherwise function',
+                        choices = ['keras', 'function', 'tflite'], default = None)
+    parser.add_argument('--tflite-model', help = 'Path to TFLite model for --backend tflite', default = None)
+    parser.add_argument('--out', '-o', help = 'Path to output file with predictions, default: predictions.txt'
+                                              ' (predictions.npy, .parquet or .feather for --output-format)',
+                        default = None)
+    parser.add_argument('--output-format', help = 'Predictions output format: "text", "npy", "parquet" or'
+                                                  ' "feather", see archive_scan.py -h. Parquet and Feather files'
+                                                  ' are readable only after exit, default: text',
+                        choices = ['text', 'npy', 'parquet', 'feather'], default = 'text')
+    parser.add_argument('--threshold', help = 'Positive prediction threshold, default: 0.998', default = 0.998)
+    parser.add_argument('--batch-size', help = 'Model batch size, windows of all stations are packed into'
+                                               ' batches, default: 150', default = 150)
+    parser.add_argument('--shift', help = 'Sliding windows shift, default: 10 samples (10 ms)', default = 10)
+    parser.add_argument('--buffer-size', help = 'Per channel ring buffer length, max channels delay relative to'
+                                                ' each other, default: 120 seconds', default = 120)
+    parser.add_argument('--no-filter', help = 'Do not filter input waveforms', action = 'store_true')
+    parser.add_argument('--peak-dist', help = 'Min distance between picks of the same phase, picks are released'
+                                              ' only when this (or 2 seconds, if larger) of following scores is'
+                                              ' available, default: 2 seconds', default = 2)
+    parser.add_argument('--sparse-picking', help = 'Find positives directly on sliding windows scores',
+                        action = 'store_true')
+    parser.add_argument('--print-precision', help = 'Floating point precision for results pseudo-probability output',
+                        default = 4)
+    parser.add_argument('--quiet', help = 'Do not print picks to stdout', action = 'store_true')
+    parser.add_argument('--stats-interval', help = 'Print pick latency statistics every this number of seconds,'
+                                                   ' 0 - only on exit, default: 60', default = 60)
+    parser.add_argument('--metrics', help = 'Path to the file to dump stage timers and counters along with'
+                                            ' latency statistics, updated with every statistics print,'
+                                            ' default: None', default = None)
+    parser.add_argument('--cpu', help = 'Disable GPU usage', action = 'store_true')
+    parser.add_argument('--intra-op-threads', help = 'TensorFlow (and TFLite interpreter) threads number of a single'
+                                                     ' operation, default: TensorFlow default (all cores)',
+                        default = None)
+    parser.add_argument('--inter-op-threads', help = 'TensorFlow threads number for independent operations,'
+                                                     ' default: TensorFlow default',
+                        default = None)
+    parser.add_argument('--blas-threads', help = 'NumPy/SciPy BLAS and OpenMP threads number of every process,'
+                                                 ' default: library default', default = None)
+    parser.add_argument('--cpu-affinity', help = 'CPUs to run on, format: "0-15" or "0-7,16-23",'
+                                                 ' default: None (no affinity)', default = None)
+
+    args = parser.parse_args()
+
+    if args.cpu:
+        os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
+
+    if bool(args.tcp) == bool(args.follow):
+        parser.print_help()
+        sys.stderr.write('ERROR: Exactly one of --tcp and --follow should be set')
+        sys.exit(2)
+
+    model_labels = {'p': 0, 's': 1, 'n': 2}
+    positive_labels = {'p': 0, 's': 1}
+
+    # Parse thresholds, format: "0.998" or "p: 0.95, s: 0.9901"
+    threshold_labels = {}
+    try:
+        split_thresholds = str(args.threshold).split(',')
+        if len(split_thresholds) == 1:
+            for label in positive_labels:
+                threshold_labels[label] = float(split_thresholds[0])
+        else:
+            for split in split_thresholds:
+                label, value = split.split(':')
+                threshold_labels[label.strip()] = float(value)
+    except ValueError:
+        parser.print_help()
+        sys.stderr.write('ERROR: Wrong --threshold format. Hint: --threshold "p: 0.95, s: 0.9901"')
+        sys.exit(2)
+
+    if set(threshold_labels) != set(positive_labels):
+        parser.print_help()
+        sys.stderr.write('ERROR: --threshold values do not match positive_labels.'
+                         f' positive_labels contents: {[k for k in positive_labels.keys()]}')
+        sys.exit(2)
+
+    # Set values
+    frequency = 100.
+
+    args.record_length = int(args.record_length)
+    args.batch_size = int(args.batch_size)
+    args.shift = int(args.shift)
+    args.buffer_size = int(float(args.buffer_size) * frequency)
+    args.peak_dist = int(float(args.peak_dist) * frequency)
+    args.print_precision = int(args.print_precision)
+
+    if not args.out:
+        args.out = 'predictions.' + {'text': 'txt'}.get(args.output_format, args.output_format)
+    args.stats_interval = float(args.stats_interval)
+    if args.follow_timeout is not None:
+        args.follow_timeout = float(args.follow_timeout)
+    for name in ('intra_op_threads', 'inter_op_threads', 'blas_threads'):
+        if getattr(args, name) is not None:
+            setattr(args, name, int(getattr(args, name)))
+
+    # CPU threads and affinity, set before NumPy import
+    from utils.cpu_config import parse_cpu_list, configure_process
+
+    try:
+        configure_process(parse_cpu_list(args.cpu_affinity) if args.cpu_affinity else None, args.blas_threads)
+    except (ValueError, OSError) as e:
+        parser.print_help()
+        sys.stderr.write(f'ERROR: --cpu-affinity: {e}')
+        sys.exit(2)
+
+    # load_model options, which are not supported in real-time mode
+    args.shared_stft = False
+
+    import utils.archive_scanner as scanner
+    from utils.realtime import RealtimeScanner, tcp_records, file_records
+    from utils.instrumentation import Metrics
+
+    metrics = Metrics()
+
+    try:
+        with metrics.timer('model_load'):
+            model = scanner.load_model(args, default_backend = 'function')
+        with metrics.timer('warmup'):
+            model.warmup(args.batch_size)
+    except ValueError as e:
+        parser.print_help()
+        sys.stderr.write(f'ERROR: {e}')
+        sys.exit(2)
+
+    try:
+        realtime = RealtimeScanner(model, args.out, model_labels, positive_labels, threshold_labels,
+                                   batch_size = args.batch_size,
+                                   shift = args.shift,
+                                   n_features = scanner.n_features,
+                                   frequency = frequency,
+                                   buffer_size = args.buffer_size,
+                                   highpass = None if args.no_filter else 2.,
+                                   peak_dist = args.peak_dist,
+                                   sparse = args.sparse_picking,
+                                   precision = args.print_precision,
+                                   print_picks = not args.quiet,
+                                   output_format = args.output_format,
+                                   metrics = metrics)
+    except ValueError as e:
+        parser.print_help()
+        sys.stderr.write(f'ERROR: {e}')
+        sys.exit(2)
+
+    def print_stats():
+        """
+        Prints latency statistics and dumps metrics.
+        """
+        stats = realtime.latency_summary()
+        print(f'Picks: {stats["picks"]}', end = '')
+        if stats['picks']:
+            print(f', latency: mean {stats["mean"]:.3f} s, p50 {stats["p50"]:.3f} s, p95 {stats["p95"]:.3f} s,'
+                  f' max {stats["max"]:.3f} s', end = '')
+        print(f', stations: {len(realtime.stations)}')
+
+        if args.metrics:
+            with open(args.metrics, 'w') as f:
+                json.dump(dict(metrics.to_dict(), latency = stats), f, indent = 2)
+
+    if args.tcp:
+        host, port = args.tcp.rsplit(':', 1)
+        source = tcp_records(host, int(port), args.record_length)
+    else:
+        source = file_records(args.follow, args.record_length, timeout = args.follow_timeout)
+
+    # Main loop
+    last_stats_time = time()
+    try:
+        for records, arrival_time in source:
+
+            for record in records:
+                realtime.add_record(record, arrival_time)
+            realtime.process()
+
+            if args.stats_interval and time() - last_stats_time >= args.stats_interval:
+                print_stats()
+                last_stats_time = time()
+
+    except KeyboardInterrupt:
+        pass
+
+    realtime.close()
+    print_stats()
@@ -8,8 +8,6 @@ Description: model layers, model itself and auxiliary functions
 
 import math
 import six
-import h5py
-from sklearn.model_selection import train_test_split
 import itertools 
 
 import tensorflow as tf
@@ -33,6 +31,8 @@ def load_hdf5_to_numpy(filename):
     :filename: HDF5 file name
     :returns: tuple (X, Y) numpy arrays with samples and labels
     """
+    import h5py
+
     f = h5py.File(filename, 'r')
     X = f['X']
     Y = f['Y']
@@ -52,6 +52,8 @@ def load_test_train_data(hdf5_file, proportion, random_state=1):
     :random_state: fix state for testing purposes
     :returns: train and test sets with labels (numpy arrays)
     """
+    from sklearn.model_selection import train_test_split
+
     # load data
     X, Y = load_hdf5_to_numpy(hdf5_file)
     # split dataset for train (75%), test (25%)
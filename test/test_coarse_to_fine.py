@@ -0,0 +1,128 @@
+"""
+Coarse-to-fine scanning kernels: utils.scan_tools.coarse_to_fine_indexes and predict_coarse_to_fine.
+
+Run from the repository root: python -m pytest test
+"""
+import numpy as np
+
+from utils.backends import InferenceBackend, InputSpec
+from utils.scan_tools import coarse_to_fine_indexes, predict_coarse_to_fine, predict_windows
+
+
+class WindowMeanModel(InferenceBackend):
+    """
+    Deterministic model: P score is the window mean of the first channel, S is 0, noise is 1 - P.
+    """
+    input_spec = InputSpec((None, 4, 1), np.float32)
+
+    def __init__(self):
+        self.predicted = 0
+
+    def infer_batch(self, x):
+        self.predicted += x.shape[0]
+        p = x[:, :, 0].mean(axis = 1)
+        return np.stack([p, np.zeros_like(p), 1. - p], axis = 1).astype(np.float32)
+
+
+def windows_of(values, n_features = 4):
+    """
+    Returns sliding windows with shift 1 of a single channel.
+    """
+    data = np.asarray(values, dtype = np.float32)[:, np.newaxis]
+    return np.lib.stride_tricks.sliding_window_view(data, (n_features, 1))[:, 0].transpose(0, 2, 1)
+
+
+def test_no_trigger():
+    scores = np.array([[0., 0., 1.], [0.01, 0., 0.99], [0., 0., 1.]])
+    indexes = coarse_to_fine_indexes(scores, np.array([0, 5, 9]), 10, 0.05, [0, 1], padding = 2)
+    assert indexes.shape[0] == 0
+
+
+def test_triggered_window_neighbourhood():
+    scores = np.array([[0., 0., 1.], [0., 0., 1.], [0., 0.5, 0.5], [0., 0., 1.], [0., 0., 1.]])
+    coarse_indexes = np.array([0, 5, 10, 15, 19])
+
+    indexes = coarse_to_fine_indexes(scores, coarse_indexes, 20, 0.05, [0, 1], padding = 0)
+    assert indexes.tolist() == [6, 7, 8, 9, 11, 12, 13, 14]
+
+    # Padding extends the region, coarse windows are never rescanned
+    indexes = coarse_to_fine_indexes(scores, coarse_indexes, 20, 0.05, [0, 1], padding = 2)
+    assert indexes.tolist() == [3, 4, 6, 7, 8, 9, 11, 12, 13, 14, 16, 17]
+
+
+def test_trigger_labels():
+    scores = np.array([[0., 0., 1.], [0., 0.5, 0.5], [0., 0., 1.]])
+    assert coarse_to_fine_indexes(scores, np.array([0, 5, 9]), 10, 0.05, [0], padding = 0).shape[0] == 0
+    assert coarse_to_fine_indexes(scores, np.array([0, 5, 9]), 10, 0.05, [1], padding = 0).shape[0] > 0
+
+
+def test_trigger_at_edges():
+    scores = np.array([[0.5, 0., 0.5], [0., 0., 1.], [0.5, 0., 0.5]])
+    indexes = coarse_to_fine_indexes(scores, np.array([0, 5, 9]), 10, 0.05, [0, 1], padding = 100)
+    assert indexes.tolist() == [1, 2, 3, 4, 6, 7, 8]
+
+
+def test_overlapping_regions_are_merged():
+    scores = np.array([[0., 0., 1.], [0.5, 0., 0.5], [0.5, 0., 0.5], [0., 0., 1.]])
+    indexes = coarse_to_fine_indexes(scores, np.array([0, 3, 6, 9]), 10, 0.05, [0, 1], padding = 1)
+    assert indexes.tolist() == [1, 2, 4, 5, 7, 8]
+    assert np.unique(indexes).shape[0] == indexes.shape[0]
+
+
+def test_quiet_trace_is_interpolated():
+    windows = windows_of(np.zeros(40))
+    model = WindowMeanModel()
+
+    scores, n_predicted = predict_coarse_to_fine(model, windows, 8, stride = 10, trigger = 0.05, padding = 2)
+
+    assert scores.shape == (windows.shape[0], 3)
+    assert n_predicted == model.predicted == 5  # windows 0, 10, 20, 30 and the last one
+    assert np.all(scores[:, :2] == 0.) and np.all(scores[:, 2] == 1.)
+
+
+def test_triggered_region_matches_full_scan():
+    values = np.zeros(60)
+    values[30:34] = 1.
+    windows = windows_of(values)
+
+    full = predict_windows(WindowMeanModel(), windows, 8)
+    scores, n_predicted = predict_coarse_to_fine(WindowMeanModel(), windows, 8, stride = 10, trigger = 0.05,
+                                                 trigger_labels = [0, 1], padding = 2)
+
+    # Every window with P score above the trigger is predicted exactly
+    triggered = full[:, 0] >= 0.05
+    assert np.array_equal(scores[triggered], full[triggered])
+    assert n_predicted < windows.shape[0]
+
+    # Skipped windows are interpolated between coarse windows and stay below the trigger
+    assert np.all(scores[~triggered, 0] < 0.05)
+
+
+def test_interpolation_between_coarse_windows():
+    # Coarse windows 0 and 4 have P scores 0 and 0.04 (below the trigger), windows between are interpolated
+    values = np.zeros(11)
+    values[8:] = [0.04, 0.04, 0.04]
+    windows = windows_of(values)[:8]
+
+    scores, n_predicted = predict_coarse_to_fine(WindowMeanModel(), windows, 8, stride = 4, trigger = 0.05)
+
+    coarse = np.array([0, 4, 7])
+    full = predict_windows(WindowMeanModel(), windows, 8)
+    assert n_predicted == coarse.shape[0]
+    assert np.array_equal(scores[coarse], full[coarse])
+    assert np.allclose(scores[:, 0], np.interp(np.arange(8), coarse, full[coarse, 0]))
+
+
+def test_short_and_empty_traces():
+    # Fewer windows than the stride: first and last windows are the coarse pass
+    windows = windows_of(np.zeros(6))
+    scores, n_predicted = predict_coarse_to_fine(WindowMeanModel(), windows, 8, stride = 10, trigger = 0.05)
+    assert scores.shape == (3, 3) and n_predicted == 2
+
+    # Single window
+    scores, n_predicted = predict_coarse_to_fine(WindowMeanModel(), windows[:1], 8, stride = 10, trigger = 0.05)
+    assert scores.shape == (1, 3) and n_predicted == 1
+
+    # No windows
+    scores, n_predicted = predict_coarse_to_fine(WindowMeanModel(), windows[:0], 8, stride = 10, trigger = 0.05)
+    assert scores.shape == (0, 3) and n_predicted == 0
@@ -0,0 +1,89 @@
+"""
+Energy pre-trigger kernels: utils.scan_tools.energy_gate and predict_gated.
+
+Run from the repository root: python -m pytest test
+"""
+import numpy as np
+import pytest
+
+from utils.scan_tools import energy_gate, predict_gated, sliding_window_strided
+from test.test_coarse_to_fine import WindowMeanModel
+
+
+def noise(n_samples, n_channels = 3, seed = 0):
+    return np.random.default_rng(seed).normal(size = (n_samples, n_channels))
+
+
+def test_stalta_quiet_trace():
+    data = noise(10000)
+    active = energy_gate(data, 400, 10, method = 'stalta', sta = 100, lta = 2000, threshold = 3., padding = 0)
+
+    assert active.shape[0] == (10000 - 400) // 10 + 1
+
+    # Windows, which contain samples of the first LTA, are always predicted, stationary noise is gated
+    windows_in_lta = (2000 - 1) // 10 + 1
+    assert np.all(active[:windows_in_lta])
+    assert not np.any(active[windows_in_lta:])
+
+
+def test_stalta_event_and_padding():
+    data = noise(10000)
+    data[6000:6100] *= 50.
+
+    active = energy_gate(data, 400, 10, method = 'stalta', sta = 100, lta = 2000, threshold = 3., padding = 0)
+    event_windows = np.flatnonzero(active[200:]) + 200
+    assert event_windows.shape[0]
+    assert np.all(event_windows * 10 <= 6200) and np.all(event_windows * 10 + 400 > 6000)
+
+    # Padding activates windows around the triggered samples
+    padded = energy_gate(data, 400, 10, method = 'stalta', sta = 100, lta = 2000, threshold = 3., padding = 200)
+    assert np.all(padded[active])
+    assert padded.sum() > active.sum()
+
+
+def test_energy_method():
+    data = noise(10000)
+    assert not np.any(energy_gate(data, 400, 10, method = 'energy', sta = 100, threshold = 3., padding = 0))
+
+    data[6000:6100] *= 50.
+    active = energy_gate(data, 400, 10, method = 'energy', sta = 100, threshold = 3., padding = 0)
+    assert np.any(active) and not np.any(active[:500])
+
+
+def test_trace_shorter_than_lta():
+    # Whole trace is inside the first LTA: every window is predicted
+    data = noise(1000)
+    active = energy_gate(data, 400, 10, method = 'stalta', sta = 100, lta = 2000, threshold = 3., padding = 0)
+    assert active.shape[0] == 61 and np.all(active)
+
+
+def test_trace_shorter_than_window():
+    assert energy_gate(noise(399), 400, 10).shape[0] == 0
+    assert energy_gate(noise(0), 400, 10).shape[0] == 0
+    assert energy_gate(noise(0), 400, 10, method = 'energy').shape[0] == 0
+
+
+def test_unknown_method():
+    with pytest.raises(ValueError):
+        energy_gate(noise(1000), 400, 10, method = 'unknown')
+
+
+def test_predict_gated():
+    data = np.zeros((50, 1), dtype = np.float32)
+    data[20:24] = 1.
+    windows = sliding_window_strided(data, 4, 1)
+
+    active = np.zeros(windows.shape[0], dtype = bool)
+    active[18:24] = True
+
+    model = WindowMeanModel()
+    scores, n_predicted = predict_gated(model, windows, 4, active, [0., 0., 1.])
+
+    assert n_predicted == model.predicted == 6
+    assert np.array_equal(scores[~active], np.tile([0., 0., 1.], ((~active).sum(), 1)))
+    assert np.array_equal(scores[active], model.infer_batch(windows[active]))
+
+    # Nothing is active: model is not called
+    model = WindowMeanModel()
+    scores, n_predicted = predict_gated(model, windows, 4, np.zeros(windows.shape[0], dtype = bool), [0., 0., 1.])
+    assert n_predicted == model.predicted == 0 and scores.shape == (windows.shape[0], 3)
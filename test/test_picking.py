@@ -0,0 +1,176 @@
+"""
+Peak picking on scores: utils.scan_tools.get_positives against the per peak loop of the original implementation.
+
+Run from the repository root: python -m pytest test
+"""
+import numpy as np
+import pytest
+from scipy.signal import find_peaks
+
+from utils.scan_tools import get_positives, pick_positives, get_positives_sparse, pick_positives_sparse, \
+    restore_scores
+
+
+# Original implementation averages empty slices of scores shorter than the averaging window
+pytestmark = pytest.mark.filterwarnings('ignore::RuntimeWarning')
+
+
+def get_positives_loop(_scores, peak_idx, other_idxs, peak_dist = 10000, avg_window_half_size = 100,
+                       threshold = 0.8):
+    """
+    Original get_positives: class means are computed for every peak separately.
+    """
+    _positives = []
+
+    x = _scores[:, peak_idx]
+
+    peaks = find_peaks(x, distance = peak_dist, height=[threshold, 1.])
+
+    for _i in range(len(peaks[0])):
+
+        start_id = peaks[0][_i] - avg_window_half_size
+        if start_id < 0:
+            start_id = 0
+
+        end_id = start_id + avg_window_half_size*2
+        if end_id > len(x):
+            end_id = len(x) - 1
+            start_id = end_id - avg_window_half_size*2
+
+        # Get mean values
+        peak_mean = x[start_id : end_id].mean()
+
+        means = []
+        for idx in other_idxs:
+            means.append(_scores[:, idx][start_id : end_id].mean())
+
+        is_max = True
+        for m in means:
+
+            if m > peak_mean:
+                is_max = False
+
+        if is_max:
+            _positives.append([peaks[0][_i], peaks[1]['peak_heights'][_i]])
+
+    return _positives
+
+
+def random_scores(n_samples, rng, dtype = np.float32):
+    """
+    Returns smooth random P, S and noise scores of shape (n_samples, 3), which sum to 1.
+    """
+    logits = np.cumsum(rng.normal(scale = 0.3, size = (n_samples, 3)), axis = 0)
+    logits[:, 2] += rng.uniform(0., 2.)
+    scores = np.exp(logits - logits.max(axis = 1, keepdims = True))
+    return (scores / scores.sum(axis = 1, keepdims = True)).astype(dtype)
+
+
+def assert_same_positives(scores, **kwargs):
+    for peak_idx, other_idxs in ((0, [1, 2]), (1, [0, 2])):
+        expected = get_positives_loop(scores, peak_idx, other_idxs, **kwargs)
+        assert get_positives(scores, peak_idx, other_idxs, **kwargs) == expected
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+def test_random_scores(dtype):
+    rng = np.random.default_rng(0)
+    for n_samples in (3, 50, 150, 199, 200, 201, 1000, 20000):
+        for _ in range(5):
+
+            scores = random_scores(n_samples, rng, dtype)
+            for peak_dist, avg_window_half_size in ((10, 100), (100, 10), (10000, 100), (1, 1)):
+                assert_same_positives(scores, peak_dist = peak_dist, avg_window_half_size = avg_window_half_size,
+                                      threshold = rng.uniform(0.3, 0.9))
+
+
+def test_scores_shorter_than_averaging_window():
+    # Averaging window start is negative and counted from the end of the scores, as in the original slices
+    rng = np.random.default_rng(1)
+    for n_samples in range(2, 200, 7):
+        scores = random_scores(n_samples, rng)
+        scores[n_samples // 3, 0] = 1.
+        assert_same_positives(scores, peak_dist = 10, avg_window_half_size = 100, threshold = 0.5)
+
+
+def test_peaks_near_the_edges():
+    scores = np.zeros((1000, 3), dtype = np.float32)
+    scores[:, 2] = 1.
+    for peak in (1, 50, 99, 100, 101, 899, 900, 950, 998):
+        scores[peak] = [0.9, 0., 0.1]
+
+    assert_same_positives(scores, peak_dist = 1, avg_window_half_size = 100, threshold = 0.5)
+    assert_same_positives(scores, peak_dist = 1, avg_window_half_size = 1, threshold = 0.5)
+
+
+def test_ambiguous_means():
+    # Class means are equal or within the rounding error of the cumulative sums: exact means are compared
+    rng = np.random.default_rng(2)
+    for _ in range(20):
+
+        scores = random_scores(3000, rng, np.float64)
+        scores[:, 2] = scores[:, 0]
+        scores[:, 2] += rng.choice([0., 1e-12, -1e-12, 1e-7], size = 3000) * rng.integers(0, 2, size = 3000)
+        assert_same_positives(scores, peak_dist = 50, avg_window_half_size = 100, threshold = 0.3)
+
+        scores = scores.astype(np.float32)
+        assert_same_positives(scores, peak_dist = 50, avg_window_half_size = 100, threshold = 0.3)
+
+
+def test_pick_positives():
+    rng = np.random.default_rng(3)
+    scores = random_scores(5000, rng)
+    model_labels = {'p': 0, 's': 1, 'n': 2}
+
+    predicted = pick_positives(scores, model_labels, {'p': 0, 's': 1}, {'p': 0.6, 's': 0.5})
+    assert predicted == {'p': get_positives_loop(scores, 0, [1, 2], threshold = 0.6),
+                         's': get_positives_loop(scores, 1, [0, 2], threshold = 0.5)}
+
+
+def assert_same_sparse_positives(scores, shift, length, **kwargs):
+    restored = restore_scores(scores, (length, scores.shape[1]), shift)
+    for peak_idx, other_idxs in ((0, [1, 2]), (1, [0, 2])):
+
+        expected = get_positives(restored, peak_idx, other_idxs, **kwargs)
+        positives = get_positives_sparse(scores, shift, length, peak_idx, other_idxs, **kwargs)
+
+        assert [sample for sample, _ in positives] == [sample for sample, _ in expected]
+        assert np.allclose([height for _, height in positives], [height for _, height in expected],
+                           rtol = 0., atol = 1e-6)
+
+
+def test_sparse_positives():
+    # Float64 scores: float32 rounding of interpolated scores may create plateaus, which are not on the knots
+    rng = np.random.default_rng(4)
+    for n_windows in (2, 3, 20, 100, 1000):
+        for shift in (1, 10, 37):
+            for _ in range(3):
+
+                scores = random_scores(n_windows, rng, np.float64)
+                # Plateaus of equal scores
+                scores[n_windows // 2 : n_windows // 2 + 3] = scores[n_windows // 2]
+
+                for length in ((n_windows - 1) * shift + 1, n_windows * shift, n_windows * shift + 399):
+                    for peak_dist, avg_window_half_size in ((10, 100), (100, 10), (10000, 100)):
+                        assert_same_sparse_positives(scores, shift, length, peak_dist = peak_dist,
+                                                     avg_window_half_size = avg_window_half_size,
+                                                     threshold = rng.uniform(0.3, 0.9))
+
+
+def test_pick_positives_sparse():
+    rng = np.random.default_rng(5)
+    scores = random_scores(3000, rng, np.float64)
+    model_labels = {'p': 0, 's': 1, 'n': 2}
+    threshold_labels = {'p': 0.6, 's': 0.5}
+
+    restored = restore_scores(scores, (scores.shape[0] * 10, 3), 10)
+    expected = pick_positives(restored, model_labels, {'p': 0, 's': 1}, threshold_labels)
+    assert sum(len(positives) for positives in expected.values())
+
+    predicted = pick_positives_sparse(scores, 10, scores.shape[0] * 10, model_labels, {'p': 0, 's': 1},
+                                      threshold_labels)
+    assert predicted.keys() == expected.keys()
+    for label in expected:
+        assert [sample for sample, _ in predicted[label]] == [sample for sample, _ in expected[label]]
+        assert np.allclose([height for _, height in predicted[label]], [height for _, height in expected[label]],
+                           rtol = 0., atol = 1e-6)
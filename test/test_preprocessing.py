@@ -0,0 +1,133 @@
+"""
+Preprocessing kernels: utils.preprocessing against obspy Trace detrend, filter and interpolate.
+
+Run from the repository root: python -m pytest test
+"""
+import numpy as np
+import pytest
+from obspy import Stream, Trace, UTCDateTime
+
+from utils.preprocessing import pre_process_streams, HighpassFilter, resample
+from benchmarks.preprocessing import obspy_pre_process
+
+
+# Obspy interpolation weights of constant data divide by zero
+pytestmark = pytest.mark.filterwarnings('ignore::RuntimeWarning')
+
+
+def random_stream(n_samples, sampling_rate, rng, starttime = UTCDateTime(2021, 4, 1, 0, 0, 0.003),
+                  channels = 'NEZ'):
+    """
+    Returns stream of integer counts with an offset, a trend and low frequency noise, as raw archive data.
+    """
+    stream = Stream()
+    for channel in channels:
+        data = np.cumsum(rng.normal(scale = 50., size = n_samples)) + rng.uniform(-1e4, 1e4)
+        data += np.linspace(0., rng.uniform(-1e3, 1e3), n_samples)
+        trace = Trace(data = data.astype(np.int32))
+        trace.stats.sampling_rate = sampling_rate
+        trace.stats.starttime = starttime
+        trace.stats.channel = 'EH' + channel
+        stream.append(trace)
+    return stream
+
+
+@pytest.mark.parametrize('sampling_rate', [100., 50., 200., 40.])
+def test_pre_process_streams(sampling_rate):
+    rng = np.random.default_rng(int(sampling_rate))
+    for n_samples in (2, 1001, 30000):
+        for no_filter, no_detrend in ((False, False), (True, False), (False, True)):
+
+            # Channels of the first stream are stacked, second stream has channels of different lengths and starts
+            streams = [random_stream(n_samples, sampling_rate, rng),
+                       random_stream(n_samples, sampling_rate, rng, channels = 'Z')
+                       + random_stream(n_samples + 7, sampling_rate, rng, UTCDateTime(2021, 4, 1, 0, 0, 1.5), 'N')]
+            expected = [stream.copy() for stream in streams]
+            trace_samples = {id(trace): trace.stats.npts for stream in streams for trace in stream}
+
+            pre_process_streams(streams, no_filter, no_detrend)
+            for stream in expected:
+                obspy_pre_process(stream, no_filter, no_detrend)
+
+            for stream, expected_stream in zip(streams, expected):
+                for trace, expected_trace in zip(stream, expected_stream):
+
+                    assert trace.stats.sampling_rate == expected_trace.stats.sampling_rate == 100.
+                    assert trace.stats.starttime == expected_trace.stats.starttime
+                    assert trace.data.dtype == np.float64 and trace.data.shape == expected_trace.data.shape
+
+                    # Obspy interpolation reads past the data end for a new sample exactly at the last sample,
+                    # utils.preprocessing.resample returns the last sample there
+                    data, expected_data = trace.data, expected_trace.data
+                    n_original = trace_samples[id(trace)]
+                    if sampling_rate != 100. and (data.shape[0] - 1) * sampling_rate == (n_original - 1) * 100.:
+                        data, expected_data = data[:-1], expected_data[:-1]
+
+                    scale = max(np.abs(expected_data).max(), 1.)
+                    assert np.abs(data - expected_data).max() <= 1e-9 * scale
+
+
+def test_resample_end():
+    # Last new sample is exactly at the last sample of the data
+    data = np.stack([np.arange(1008.), np.arange(1008.) ** 2])
+    resampled = resample(data, 50., 100., start = UTCDateTime(2021, 4, 1, 0, 0, 1.503).timestamp)
+    assert resampled.shape == (2, 2015)
+    assert np.array_equal(resampled[:, -1], data[:, -1])
+    assert np.allclose(resampled[0], np.arange(2015) / 2.)
+
+
+def test_pre_process_dtype():
+    rng = np.random.default_rng(1)
+    stream = random_stream(5000, 50., rng)
+    expected = stream.copy()
+
+    pre_process_streams([stream], dtype = np.float32)
+    obspy_pre_process(expected, dtype = np.float32)
+
+    # Last new sample is exactly at the last sample, see test_resample_end
+    for trace, expected_trace in zip(stream, expected):
+        assert trace.data.dtype == np.float32
+        assert np.allclose(trace.data[:-1], expected_trace.data[:-1], rtol = 1e-6, atol = 1e-6)
+
+
+def test_chunked_filter_matches_whole_trace():
+    rng = np.random.default_rng(2)
+    data = np.cumsum(rng.normal(size = (3, 20000)), axis = 1) + rng.uniform(-1e4, 1e4, size = (3, 1))
+
+    whole = HighpassFilter(2., 100., 3)(data)
+    scale = np.abs(whole).max()
+
+    for chunk_size in (1, 7, 512, 4096, 20000):
+        highpass = HighpassFilter(2., 100., 3)
+        chunks = [highpass(data[:, start : start + chunk_size]) for start in range(0, data.shape[1], chunk_size)]
+        assert np.abs(np.concatenate(chunks, axis = 1) - whole).max() <= 1e-9 * scale
+
+    # Channels are filtered separately, e.g. real-time channels of different latency
+    highpass = HighpassFilter(2., 100., 3)
+    filtered = np.empty_like(data)
+    filtered[:2, :5000] = highpass(data[:2, :5000], channels = [0, 1])
+    filtered[2, :12000] = highpass(data[2:, :12000], channels = [2])[0]
+    filtered[:2, 5000:] = highpass(data[:2, 5000:], channels = [0, 1])
+    filtered[2, 12000:] = highpass(data[2:, 12000:], channels = [2])[0]
+    assert np.abs(filtered - whole).max() <= 1e-9 * scale
+
+    # Reset starts a new trace
+    highpass.reset()
+    assert np.array_equal(highpass(data), whole)
+
+
+def test_filter_initial_state():
+    # Steady state of the first sample: constant offset is removed without a step transient
+    rng = np.random.default_rng(3)
+    data = rng.normal(size = (3, 5000)) + np.array([[1e5], [-3e4], [0.]])
+
+    highpass = HighpassFilter(2., 100., 3)
+    highpass.reset(initial = data[:, 0])
+    filtered = highpass(data)
+
+    expected = HighpassFilter(2., 100., 3)(data - data[:, :1])
+    assert np.abs(filtered - expected).max() <= 1e-9 * np.abs(data).max()
+
+    # Single channel
+    highpass.reset(channels = [1], initial = 5.)
+    assert np.allclose(highpass(np.full((1, 100), 5.), channels = [1]), 0., atol = 1e-9)
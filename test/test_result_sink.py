@@ -0,0 +1,202 @@
+"""
+Result sinks and scan journal: utils.result_sink and utils.journal.
+
+Run from the repository root: python -m pytest test
+"""
+import os
+import json
+import types
+import numpy as np
+from obspy import UTCDateTime
+
+from utils.result_sink import NpySink, TextSink, pick_dtype
+from utils.journal import ScanJournal, load_records, resume_state
+
+
+t0 = UTCDateTime(2021, 4, 1)
+ids = ('XX', 'S0', '00', 'EH?')
+
+
+def peaks(n, first = 0):
+    """
+    Returns n get_detected_peaks records, one per second after t0.
+    """
+    return [{'type': 'p', 'pseudo-probability': 0.99, 'datetime': t0 + i, 'ns': (t0 + i).ns, 'sample': i * 100}
+            for i in range(first, first + n)]
+
+
+def test_npy_header_is_rewritten(tmp_path):
+    path = str(tmp_path / 'picks.npy')
+
+    sink = NpySink(path, flush_size = 2)
+    sink.write_peaks(peaks(2), ids, t0)
+    assert np.load(path).shape == (2,)
+
+    sink.write_peaks(peaks(3, 2), ids, t0)
+    sink.close()
+
+    picks = np.load(path)
+    assert picks.dtype == pick_dtype and picks.shape == (5,)
+    assert picks['sample'].tolist() == [0, 100, 200, 300, 400]
+    assert picks['time'][1] == np.datetime64((t0 + 1).ns, 'ns')
+    assert picks['channel'][0] == 'EH?'
+
+
+def test_npy_append(tmp_path):
+    path = str(tmp_path / 'picks.npy')
+
+    sink = NpySink(path)
+    sink.write_peaks(peaks(2), ids, t0)
+    sink.close()
+
+    # Partially written record is removed on reopen, e.g. after output truncation on --resume
+    with open(path, 'ab') as f:
+        f.write(b'\x00' * 10)
+
+    sink = NpySink(path)
+    sink.write_peaks(peaks(1, 2), ids, t0)
+    sink.close()
+
+    assert np.load(path)['sample'].tolist() == [0, 100, 200]
+
+
+def test_npy_position_and_sync(tmp_path):
+    path = str(tmp_path / 'picks.npy')
+
+    sink = NpySink(path, flush_size = 3)
+    header_size = os.path.getsize(path)
+    assert sink.position() == sink.sync() == header_size
+
+    # Buffered picks are counted by position, but not written by sync
+    sink.write_peaks(peaks(2), ids, t0)
+    assert sink.position() == header_size + 2 * pick_dtype.itemsize
+    assert sink.sync() == header_size
+    assert os.path.getsize(path) == header_size and np.load(path).shape == (0,)
+
+    # Flush size is reached
+    sink.write_peaks(peaks(1, 2), ids, t0)
+    assert sink.sync() == sink.position() == os.path.getsize(path)
+    sink.close()
+
+
+def test_text_position_and_sync(tmp_path):
+    path = str(tmp_path / 'picks.txt')
+
+    sink = TextSink(path, flush_size = 3)
+    sink.write_line('group\n')
+    sink.write_peaks(peaks(1), ids, t0)
+    assert sink.position() == sink.buffered_bytes > 0
+    assert sink.sync() == 0 and os.path.getsize(path) == 0
+
+    position = sink.position()
+    sink.flush()
+    assert sink.sync() == position == os.path.getsize(path)
+    sink.close()
+
+    with open(path) as f:
+        assert f.read().splitlines() == ['group', 'S0 P 0.99 01.04.2021 00:00:00.']
+
+
+def test_journal_records_follow_output(tmp_path):
+    out_path = str(tmp_path / 'picks.txt')
+    path = str(tmp_path / 'picks.txt.journal')
+
+    sink = TextSink(out_path, flush_size = 3)
+    journal = ScanJournal(path)
+
+    # Output is not flushed for the journal: records are pending until the output is written
+    journal.group_started(0, ['n', 'e', 'z'], sink)
+    sink.write_line('group\n')
+    sink.write_peaks(peaks(1), ids, t0)
+    journal.chunk_done(0, 0, 0, 1000, sink)
+    assert load_records(path) == [{'event': 'group', 'group': 0, 'archives': ['n', 'e', 'z'], 'offset': 0}]
+    assert len(journal.pending) == 1
+
+    # Flush size is reached, chunk record is written with the next commit
+    sink.write_peaks(peaks(2, 1), ids, t0)
+    journal.chunk_done(0, 0, 1, 2000, sink)
+    records = load_records(path)
+    assert [record['event'] for record in records] == ['group', 'chunk', 'chunk']
+    assert records[-1]['offset'] == os.path.getsize(out_path)
+
+    # Close writes the output and the rest of the records
+    sink.write_line('\n')
+    journal.group_done(0, sink)
+    journal.close(sink)
+    sink.close()
+
+    records = load_records(path)
+    assert records[-1] == {'event': 'done', 'group': 0, 'offset': os.path.getsize(out_path)}
+    assert resume_state(path, [['n', 'e', 'z']]) == {'done': {0}, 'offset': os.path.getsize(out_path),
+                                                     'partial': None}
+
+
+def test_partial_journal_line(tmp_path):
+    path = str(tmp_path / 'journal')
+    with open(path, 'w') as f:
+        f.write(json.dumps({'event': 'group', 'group': 0, 'archives': ['a'], 'offset': 0}) + '\n')
+        f.write(json.dumps({'event': 'chunk', 'group': 0, 'trace': 0, 'chunk': 2, 'released': 5, 'offset': 10}))
+        f.write('\n{"event": "chu')
+
+    state = resume_state(path, [['a']])
+    assert state['offset'] == 10 and state['done'] == set()
+    assert state['partial'] == {'group': 0, 'trace': 0, 'chunk': 2, 'released': 5, 'group_offset': 0}
+
+
+def test_flush_thresholds(tmp_path, monkeypatch):
+    path = str(tmp_path / 'picks.txt')
+
+    # Group headers and separators count towards the bytes threshold
+    sink = TextSink(path, flush_bytes = 100)
+    sink.write_line('a' * 60 + '\n')
+    assert os.path.getsize(path) == 0
+    sink.write_line('-' * 60 + '\n')
+    assert os.path.getsize(path) == 122 and sink.buffered_bytes == 0
+    sink.close()
+
+    # Buffered output is written with the next write after the flush interval
+    now = [0.]
+    monkeypatch.setattr('utils.result_sink.time', types.SimpleNamespace(monotonic = lambda: now[0]))
+
+    path = str(tmp_path / 'picks.npy')
+    sink = NpySink(path, flush_interval = 5.)
+    sink.write_peaks(peaks(1), ids, t0)
+    now[0] = 4.
+    sink.write_peaks(peaks(1, 1), ids, t0)
+    assert not sink.flush_due() and np.load(path).shape == (0,)
+
+    now[0] = 5.
+    assert sink.flush_due()
+    sink.write_peaks(peaks(1, 2), ids, t0)
+    assert np.load(path).shape == (3,) and not sink.flush_due()
+    sink.close()
+
+
+def test_journal_chunk_and_group_records_are_durable(tmp_path, monkeypatch):
+    now = [0.]
+    monkeypatch.setattr('utils.result_sink.time', types.SimpleNamespace(monotonic = lambda: now[0]))
+
+    out_path = str(tmp_path / 'picks.txt')
+    path = str(tmp_path / 'picks.txt.journal')
+    sink = TextSink(out_path, flush_interval = 5.)
+    journal = ScanJournal(path)
+
+    journal.group_started(0, ['n', 'e', 'z'], sink)
+    sink.write_line('group\n')
+    sink.write_peaks(peaks(1), ids, t0)
+    journal.chunk_done(0, 0, 0, 1000, sink)
+    assert len(load_records(path)) == 1
+
+    # Chunk output is written by the next record after the flush interval
+    now[0] = 5.
+    journal.chunk_done(0, 0, 1, 2000, sink)
+    assert [record['chunk'] for record in load_records(path)[1:]] == [0, 1]
+
+    # Group output is written with its record
+    sink.write_peaks(peaks(1, 1), ids, t0)
+    sink.write_line('---\n')
+    journal.group_done(0, sink)
+    assert load_records(path)[-1] == {'event': 'done', 'group': 0, 'offset': os.path.getsize(out_path)}
+
+    journal.close(sink)
+    sink.close()
@@ -0,0 +1,96 @@
+"""
+Crash-safe scan journal: archive_scan.py run is killed in the middle of the second archive group and resumed
+with --resume.
+
+The test module is also the custom model loader of the scans (archive_scan.py --model test.test_resume).
+
+Run from the repository root: python -m pytest test
+"""
+import os
+import sys
+import signal
+import subprocess
+import numpy as np
+
+from utils.backends import InferenceBackend, InputSpec
+
+
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class EnergyModel(InferenceBackend):
+    """
+    Deterministic model: P and S scores grow with the energy ratio of the window halves. Kills its process with
+    SIGKILL on the kill_after batch.
+    """
+    input_spec = InputSpec((None, 400, 3), np.float32)
+
+    def __init__(self, kill_after = 0):
+        self.kill_after = kill_after
+        self.batches = 0
+
+    def infer_batch(self, x):
+        self.batches += 1
+        if self.batches == self.kill_after:
+            os.kill(os.getpid(), signal.SIGKILL)
+
+        x = np.asarray(x, dtype = np.float64)
+        noise = np.abs(x[:, :200]).mean(axis = 1) + 1e-3
+        ratio = np.log(np.abs(x[:, 200:]).mean(axis = 1) / noise + 1e-9)
+
+        p = 1. / (1. + np.exp(-(ratio[:, 2] - 1.) * 4.))
+        s = (1. - p) / (1. + np.exp(-(ratio[:, 0] - 1.5) * 4.))
+        return np.stack([p, s, np.clip(1. - p - s, 0., 1.)], axis = 1).astype(np.float32)
+
+
+def load_model(kill_after = 0):
+    return EnergyModel(int(kill_after))
+
+
+def scan(archives, out, *options, kill_after = 0):
+    """
+    Runs archive_scan.py with the EnergyModel, returns process exit code.
+    """
+    env = dict(os.environ, PYTHONPATH = repository)
+    return subprocess.run([sys.executable, 'archive_scan.py', archives, '--model', 'test.test_resume',
+                           '--loader_argv', f'kill_after={kill_after}', '--threshold', '0.5', '--trace-size', '120',
+                           '-o', out, *options],
+                          cwd = repository, env = env, stdout = subprocess.DEVNULL).returncode
+
+
+def test_resume_after_kill(tmp_path):
+    from benchmarks.synthetic import write_synthetic_group
+    from utils.journal import load_records
+
+    archives = str(tmp_path / 'archives.txt')
+    with open(archives, 'w') as f:
+        for n in range(2):
+            paths, _ = write_synthetic_group(str(tmp_path / f'g{n}'), duration = 600., events_per_hour = 30,
+                                             station = f'S{n}', seed = n)
+            f.write(' '.join(paths) + '\n')
+
+    full = str(tmp_path / 'full.txt')
+    assert scan(archives, full) == 0
+
+    # Every group has 5 chunks of 8 batches, the run is killed in the middle of the second group
+    out = str(tmp_path / 'out.txt')
+    journal = out + '.journal'
+    assert scan(archives, out, '--journal', journal, kill_after = 60) == -signal.SIGKILL
+
+    # Completed group is written and recorded
+    records = load_records(journal)
+    done = [record for record in records if record['event'] == 'done']
+    assert [record['group'] for record in done] == [0]
+    assert records[-1]['group'] == 1
+
+    with open(full) as f:
+        first_group = f.read(done[0]['offset'])
+    with open(out) as f:
+        assert f.read(done[0]['offset']) == first_group
+    assert os.path.getsize(out) >= records[-1]['offset']
+
+    assert scan(archives, out, '--resume') == 0
+
+    with open(full) as f, open(out) as f_out:
+        assert f_out.read() == f.read()
+    assert [record['event'] for record in load_records(journal)][-1] == 'done'
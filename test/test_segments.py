@@ -0,0 +1,126 @@
+"""
+Archive group sample index: utils.segments.
+
+Run from the repository root: python -m pytest test
+"""
+import numpy as np
+import pytest
+from obspy import Trace, Stream, UTCDateTime
+
+from utils.segments import SegmentIndex, channel_ranges, intersect_ranges
+
+
+t0 = UTCDateTime(2021, 4, 1)
+
+
+def trace(channel, start, npts, value = None):
+    """
+    Returns 100 Hz trace, which starts start seconds after t0, data is the sample index from t0 or the value.
+    """
+    first = int(round(start * 100))
+    data = np.arange(first, first + npts, dtype = np.float32) if value is None \
+        else np.full(npts, value, dtype = np.float32)
+    return Trace(data = data, header = {'network': 'XX', 'station': 'S0', 'location': '00', 'channel': channel,
+                                        'sampling_rate': 100., 'starttime': t0 + start})
+
+
+def group(*channels):
+    """
+    Returns list of streams from lists of (start, npts) of every channel.
+    """
+    return [Stream([trace(code, start, npts) for start, npts in traces])
+            for code, traces in zip(['EHN', 'EHE', 'EHZ'], channels)]
+
+
+def test_intersect_ranges():
+    assert intersect_ranges([(0, 10), (20, 30)], [(5, 25)]) == [(5, 10), (20, 25)]
+    assert intersect_ranges([(0, 10)], [(10, 20)]) == []
+    assert intersect_ranges([], [(0, 10)]) == []
+    assert intersect_ranges([(0, 100)], [(0, 10), (20, 30), (90, 120)]) == [(0, 10), (20, 30), (90, 100)]
+
+
+def test_channel_ranges():
+    # Adjacent traces keep their own ranges, overlapping samples belong to the earlier trace
+    assert channel_ranges([(10, 20, 1), (0, 10, 0)]) == [(0, 10, 0), (10, 20, 1)]
+    assert channel_ranges([(0, 15, 0), (10, 20, 1)]) == [(0, 15, 0), (15, 20, 1)]
+    assert channel_ranges([(0, 20, 0), (5, 15, 1)]) == [(0, 20, 0)]
+
+
+def test_single_segment():
+    index = SegmentIndex(group([(0, 1000)], [(0, 1000)], [(0, 1000)]))
+
+    assert index.segments == [(0, 1000)]
+    assert index.gaps == []
+    assert index.ids == ('XX', 'S0', '00', 'EH?')
+    assert index.time(0) == t0 and index.time(100) == t0 + 1
+
+    data = index.slice(100, 500)
+    assert data.shape == (400, 3)
+    assert np.array_equal(data[:, 2], np.arange(100, 500))
+
+
+def test_time_span():
+    # Channels are cut to the latest start and the earliest end, and to the start and end times
+    index = SegmentIndex(group([(0, 1000)], [(1, 1000)], [(0, 900)]))
+    assert index.starttime == t0 + 1 and index.segments == [(0, 800)]
+    assert index.slice(0, 1)[0].tolist() == [100, 100, 100]
+
+    index = SegmentIndex(group([(0, 1000)], [(0, 1000)], [(0, 1000)]), start = t0 + 2, end = t0 + 5)
+    assert index.starttime == t0 + 2 and index.segments == [(0, 301)]
+
+
+def test_gappy_channels():
+    # Channels have different gaps and number of traces
+    index = SegmentIndex(group([(0, 1000)], [(0, 300), (4, 600)], [(0, 800), (9, 100)]))
+
+    assert index.segments == [(0, 300), (400, 800), (900, 1000)]
+    assert index.gaps == [(300, 400), (800, 900)]
+    assert np.array_equal(index.slice(400, 800)[:, 1], np.arange(400, 800))
+
+    with pytest.raises(IndexError):
+        index.slice(200, 500)
+
+
+def test_adjacent_traces_are_not_merged():
+    index = SegmentIndex(group([(0, 500), (5, 500)], [(0, 1000)], [(0, 1000)]))
+    assert index.segments == [(0, 500), (500, 1000)]
+
+    with pytest.raises(IndexError):
+        index.slice(400, 600)
+
+
+def test_disjoint_channel_coverage():
+    index = SegmentIndex(group([(0, 300), (6, 300)], [(3, 300)], [(0, 1000)]))
+    assert index.segments == []
+    assert index.gaps == [(0, index.n_samples)]
+
+
+def test_empty_trace():
+    index = SegmentIndex(group([(0, 1000), (10, 0)], [(0, 1000)], [(0, 1000)]))
+    assert index.segments == [(0, 1000)]
+
+    index = SegmentIndex(group([(0, 1000)], [(0, 0)], [(0, 1000)]))
+    assert index.segments == [] and index.n_samples == 0
+
+
+def test_views_and_traces():
+    streams = group([(0, 1000)], [(0, 1000)], [(0, 1000)])
+    index = SegmentIndex(streams)
+
+    # Channel data is not copied
+    assert np.shares_memory(index.channel_slice(0, 10, 20), streams[0][0].data)
+
+    traces = index.traces(100, 500)
+    assert [tr.stats.channel for tr in traces] == ['EHN', 'EHE', 'EHZ']
+    assert traces[0].stats.starttime == t0 + 1 and traces[0].stats.npts == 400
+    assert not np.shares_memory(traces[0].data, streams[0][0].data)
+
+
+def test_sample_grid_alignment():
+    # Trace, which starts between samples, is aligned to the nearest sample of the first channel grid
+    streams = group([(0, 1000)], [(0, 1000)], [(0, 1000)])
+    streams[1] = Stream([trace('EHE', 0.004, 1000, value = 1.)])
+
+    index = SegmentIndex(streams)
+    assert index.segments == [(0, 1000)]
+    assert np.all(index.slice(0, 1000)[:, 1] == 1.)
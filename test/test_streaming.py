@@ -0,0 +1,118 @@
+"""
+Chunked scanning: utils.streaming.ScoreStream and utils.archive_scanner chunks against a whole trace scan.
+
+Run from the repository root: python -m pytest test
+"""
+import argparse
+import numpy as np
+import pytest
+
+from utils.backends import InferenceBackend, InputSpec
+from utils.scan_tools import restore_scores, pick_positives
+from utils.streaming import ScoreStream
+from utils.archive_scanner import chunk_positions, scan_group, n_features
+from utils.result_sink import NpySink
+from utils.segments import SegmentIndex
+from test.test_picking import random_scores
+
+
+model_labels = {'p': 0, 's': 1, 'n': 2}
+positive_labels = {'p': 0, 's': 1}
+threshold_labels = {'p': 0.5, 's': 0.5}
+
+
+class RatioModel(InferenceBackend):
+    """
+    Deterministic model, which does not depend on the data scale (chunks are normalized separately): P and S scores
+    grow with the energy ratio of the window halves of Z and N channels.
+    """
+    input_spec = InputSpec((None, 400, 3), np.float64)
+
+    def infer_batch(self, x):
+        x = np.asarray(x, dtype = np.float64)
+        ratio = np.log(np.abs(x[:, 200:]).mean(axis = 1) / np.abs(x[:, :200]).mean(axis = 1))
+
+        p = 1. / (1. + np.exp(-(ratio[:, 2] - 1.) * 4.))
+        s = (1. - p) / (1. + np.exp(-(ratio[:, 0] - 1.5) * 4.))
+        return np.stack([p, s, 1. - p - s], axis = 1)
+
+
+def whole_trace_picks(scores, shift):
+    restored = restore_scores(scores, (scores.shape[0] * shift, scores.shape[1]), shift)
+    return pick_positives(restored, model_labels, positive_labels, threshold_labels)
+
+
+def test_chunk_positions():
+    # Chunks cover every window once, chunks shorter than a window are joined with the next chunks
+    for l_trace in (399, 400, 401, 1000, 12345):
+        for trace_size in (60, 399, 400, 401, 1000, 20000):
+
+            positions = chunk_positions(l_trace, trace_size, 10)
+            assert positions[-1][1] == l_trace
+
+            windows = []
+            for start, end in positions:
+                if end - start >= n_features:
+                    windows.extend(range(start, end - n_features + 1, 10))
+            assert windows == list(range(0, l_trace - n_features + 1, 10))
+
+
+@pytest.mark.parametrize('sparse', [False, True])
+def test_stream_matches_whole_trace(sparse):
+    # Float64 scores: no peaks of exactly equal heights, see utils.streaming
+    rng = np.random.default_rng(0)
+    scores = random_scores(2000, rng, np.float64)
+    expected = whole_trace_picks(scores, 10)
+    assert sum(len(picks) for picks in expected.values())
+
+    for chunk_windows in (1, 7, 100, 999, 1000, 2000):
+
+        stream = ScoreStream(10, model_labels, positive_labels, threshold_labels, sparse = sparse)
+        picks = {label: [] for label in positive_labels}
+        for start in range(0, scores.shape[0], chunk_windows):
+
+            # Chunk shorter than a window has no scores
+            for label, positives in stream.push(None).items():
+                picks[label].extend(positives)
+            for label, positives in stream.push(scores[start : start + chunk_windows]).items():
+                picks[label].extend(positives)
+
+        for label, positives in stream.flush().items():
+            picks[label].extend(positives)
+
+        assert picks == expected
+
+
+def scan_picks(index, trace_size, shift = 10, sparse = False, path = None):
+    """
+    Scans the group with scan_group, returns picks sorted by phase and sample.
+    """
+    args = argparse.Namespace(shift = shift, trace_size = trace_size, batch_size = 64, dtype = 'float64',
+                              shared_stft = False, plot_positives = False, plot_positives_original = False,
+                              coarse_stride = None, gate = None, save_scores = None, print_scores = False,
+                              sparse_picking = sparse, print_precision = 4, prefetch = 0, time = False,
+                              threshold = 0.5)
+    out = NpySink(path)
+    scan_group(0, ['n', 'e', 'z'], RatioModel(), args, model_labels, positive_labels, threshold_labels,
+               out = out, progress = False, group = index)
+    out.close()
+
+    picks = np.load(path)
+    return picks[np.lexsort((picks['sample'], picks['phase']))]
+
+
+def test_chunked_scan_matches_whole_trace(tmp_path):
+    from benchmarks.synthetic import synthetic_group
+
+    streams, _ = synthetic_group(duration = 300., events_per_hour = 60, seed = 1)
+    index = SegmentIndex(streams)
+    l_trace = index.n_samples
+
+    expected = scan_picks(index, l_trace, path = str(tmp_path / 'whole.npy'))
+    assert expected.shape[0]
+
+    for trace_size in (60, 399, 400, 401, 1000, 4567):
+        picks = scan_picks(index, trace_size, path = str(tmp_path / f'{trace_size}.npy'))
+
+        assert np.array_equal(picks[['phase', 'sample', 'time']], expected[['phase', 'sample', 'time']])
+        assert np.allclose(picks['probability'], expected['probability'], rtol = 0., atol = 1e-6)
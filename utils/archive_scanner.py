@@ -0,0 +1,597 @@
+"""
+Archive groups scanning: model loading and scan of a single archive group, used by archive_scan.py
+both in a single process and in the worker processes (see --workers).
+"""
+import os
+import numpy as np
+from obspy import read
+
+import utils.scan_tools as stools
+from utils.streaming import ScoreStream
+from utils.pipeline import prefetch
+from utils.batching import BatchPacker
+from utils.waveform_cache import WaveformCache
+from utils.preprocessing import pre_process_streams
+from utils.segments import SegmentIndex
+from utils.score_store import save_group_scores, load_group_scores
+from utils.result_sink import open_sink, part_format, seed_id
+from utils.instrumentation import Metrics, timer, count
+
+
+# Default weights for models
+default_weights = {'favor': 'WEIGHTS/w_model_performer_v2.0.h5',
+                   'cnn': 'WEIGHTS/w_model_cnn_v2.0.h5',
+                   'gpd': 'WEIGHTS/w_gpd_scsn_2000_2017.h5'}
+
+frequency = 100.
+n_features = 400
+half_duration = (n_features * 0.5) / frequency
+
+
+def load_model(args, default_backend = 'keras'):
+    """
+    Loads model according to the archive_scan.py arguments. Raises ValueError if model
+    does not support requested options.
+    :param args: archive_scan.py arguments
+    :param default_backend: backend of the Keras model, if args.backend is not set, default: keras
+    :return: utils.backends.InferenceBackend
+    """
+    from utils.backends import InferenceBackend, as_backend
+    from utils.exported_model import ExportedModel, find_exported
+    from utils.cpu_config import configure_tensorflow
+
+    configure_tensorflow(args.intra_op_threads, args.inter_op_threads)
+
+    if args.backend == 'tflite':
+
+        if args.shared_stft:
+            raise ValueError('--shared-stft requires Keras model, it can not be used with --backend tflite')
+
+        from utils.tflite_model import TFLiteModel, find_tflite
+
+        path = args.tflite_model
+        if not path:
+            if not args.weights:
+                args.weights = default_weights['cnn' if args.cnn else 'gpd' if args.gpd else 'favor']
+            path = find_tflite(args.weights)
+        if not path:
+            raise ValueError(f'No TFLite model found for the weights {args.weights}, convert it with'
+                             f' "export_model.py --tflite" or set --tflite-model')
+
+        model = TFLiteModel(path, num_threads = args.intra_op_threads)
+
+    elif args.saved_model:
+
+        if args.shared_stft:
+            raise ValueError('--shared-stft requires Keras model, it can not be used with --saved-model')
+        model = ExportedModel(args.saved_model)
+
+    elif args.model:
+
+        # TODO: Check if loader_argv is set and check (if possible) loader_call if it receives arguments
+        #       Print warning then if loader_argv is not set and print help message about custom models
+
+        import importlib
+
+        model_loader = importlib.import_module(args.model)  # import loader module
+        loader_call = getattr(model_loader, 'load_model')  # import loader function
+
+        # Parse loader arguments
+        loader_argv = args.loader_argv
+
+        # TODO: Improve parsing to support quotes and whitespaces inside said quotes
+        #       Also parse whitespaces between argument and key
+        argv_split = loader_argv.strip().split()
+        argv_dict = {}
+
+        for pair in argv_split:
+
+            spl = pair.split('=')
+            if len(spl) == 2:
+                argv_dict[spl[0]] = spl[1]
+
+        model = loader_call(**argv_dict)
+    # TODO: Print loaded model info. Also add flag --inspect to print model summary.
+    else:
+
+        if args.cnn:
+            name = 'cnn'
+        elif args.gpd:
+            name = 'gpd'
+        else:
+            name = 'favor'
+
+        if not args.weights: args.weights = default_weights[name]
+
+        # Use inference-only artifact of the weights, if it is exported (see export_model.py) and backend
+        # is not set explicitly
+        exported = None
+        if not args.shared_stft and not args.backend:
+            exported = find_exported(args.weights)
+
+        if exported:
+            model = ExportedModel(exported)
+        elif name == 'cnn':
+            import utils.seismo_load as seismo_load
+            model = seismo_load.load_cnn(args.weights, compile = False)
+        elif name == 'gpd':
+            from utils.gpd_loader import load_model as load_gpd
+            model = load_gpd(args.weights, compile = False)
+        else:
+            import utils.seismo_load as seismo_load
+            model = seismo_load.load_performer(args.weights, compile = False)
+
+    if args.shared_stft:
+
+        from utils.shared_stft import SharedSTFTModel
+
+        if isinstance(model, InferenceBackend):
+            raise ValueError('--shared-stft requires Keras model, custom model loader returned inference backend')
+
+        try:
+            model = SharedSTFTModel(model)
+        except ValueError as e:
+            raise ValueError(f'--shared-stft is not supported by the model: {e}')
+
+        if args.shift % model.hop_length:
+            raise ValueError(f'--shift should be a multiple of the STFT hop length ({model.hop_length})'
+                             f' if --shared-stft is set')
+
+    return as_backend(model, args.backend or default_backend)
+
+
+def load_group(l_archives, args, metrics = None):
+    """
+    Reads and preprocesses archive group.
+    :param l_archives: list of the group archive paths, one per channel
+    :param args: archive_scan.py arguments
+    :param metrics: utils.instrumentation.Metrics, default: None
+    :return: utils.segments.SegmentIndex of the group, None if some channel has no data in the scanned time span.
+    """
+    # Load preprocessed data from the cache
+    cache = None
+    streams = None
+    if args.cache:
+        cache = WaveformCache(args.cache, args.cache_size)
+        cache_key = cache.key(l_archives, no_filter = args.no_filter, no_detrend = args.no_detrend,
+                              dtype = stools.preprocess_dtype(args.dtype).name)
+        with timer(metrics, 'cache_load'):
+            streams = cache.load(cache_key)
+        count(metrics, 'cache_hits' if streams is not None else 'cache_misses')
+
+    if streams is None:
+
+        # Read data
+        streams = []
+        with timer(metrics, 'read'):
+            for path in l_archives:
+                streams.append(read(path))
+        count(metrics, 'samples_read', sum(tr.stats.npts for st in streams for tr in st))
+
+        # Pre-process data
+        with timer(metrics, 'pre_process'):
+            pre_process_streams(streams, args.no_filter, args.no_detrend, dtype = stools.preprocess_dtype(args.dtype))
+
+        if cache:
+            with timer(metrics, 'cache_save'):
+                cache.save(cache_key, streams)
+
+    if not all(len(st) for st in streams):
+        return None
+
+    # Align channels and cut archives to the same time span
+    with timer(metrics, 'trim'):
+        index = SegmentIndex(streams, args.start, args.end)
+
+    if not index.segments:
+        return None
+
+    return index
+
+
+def chunk_positions(l_trace, trace_size, shift):
+    """
+    Returns list of (start, end) sample positions of trace chunks. Every chunk starts with the first window,
+    which is not covered by the previous chunks, so windows crossing chunk boundaries are scanned too.
+    :param l_trace: trace length in samples
+    :param trace_size: chunk size in samples (--trace-size)
+    :param shift: sliding windows shift
+    """
+    positions = []
+    next_pos = 0
+    end_pos = 0
+    while end_pos < l_trace:
+
+        end_pos = min(end_pos + trace_size, l_trace)
+        positions.append((next_pos, end_pos))
+
+        if end_pos - next_pos >= n_features:
+            next_pos += (end_pos - next_pos - n_features + shift) // shift * shift
+
+    return positions
+
+
+def get_detected_peaks(predicted_labels, t_start):
+    """
+    Converts positives to the print_results records.
+    :param predicted_labels: dictionary {label: [[sample, pseudo-probability], ...]}, samples are relative to the
+        trace start and point to the start of the window
+    :param t_start: trace start time
+    :return: list of dictionaries with 'type', 'datetime', 'pseudo-probability', 'sample' (pick window start
+        sample) and 'ns' (pick time in integer nanoseconds, exact to the sample) keys
+    """
+    # Convert indexes to datetime
+    predicted_timestamps = {}
+    for label in predicted_labels:
+
+        tmp_prediction_dates = []
+        for prediction in predicted_labels[label]:
+
+            # Get prediction UTCDateTime and model pseudo-probability
+            tmp_prediction_dates.append([t_start + (prediction[0] / frequency) + half_duration,
+                                         prediction[1],
+                                         int(prediction[0]),
+                                         t_start.ns + int(round(prediction[0] * 1e9 / frequency))
+                                         + int(round(half_duration * 1e9))])
+
+        predicted_timestamps[label] = tmp_prediction_dates
+
+    # Prepare output data
+    detected_peaks = []
+    for typ in predicted_timestamps:
+        for pred in predicted_timestamps[typ]:
+
+            prediction = {'type': typ,
+                          'datetime': pred[0],
+                          'pseudo-probability': pred[1],
+                          'sample': pred[2],
+                          'ns': pred[3]}
+
+            detected_peaks.append(prediction)
+
+    return detected_peaks
+
+
+def scan_group(n_archive, l_archives, model, args, model_labels, positive_labels, threshold_labels,
+               out = None, n_archives = None, total_performance_time = 0., progress = True, group = None,
+               metrics = None, packer = None, journal = None, resume = None):
+    """
+    Scans single archive group and appends results to the output file.
+    :param n_archive: archive group index
+    :param l_archives: list of the group archive paths, one per channel
+    :param model: model
+    :param args: archive_scan.py arguments
+    :param model_labels: dictionary of all model labels and their scores indexes
+    :param positive_labels: dictionary of labels to pick
+    :param threshold_labels: dictionary of thresholds for every positive label
+    :param out: utils.result_sink.ResultSink, default: sink of args.out, closed after the group
+    :param n_archives: total number of archive groups, for progress bar
+    :param total_performance_time: model prediction time before this group, for progress bar
+    :param progress: print progress bar
+    :param group: load_group output, if the group is already loaded
+    :param metrics: utils.instrumentation.Metrics, default: None
+    :param packer: utils.batching.BatchPacker, if set, windows are predicted in batches packed across chunks,
+        traces and groups, and chunk results are written when their batches are predicted (see --pack-batches),
+        call packer.flush() after the last group.
+    :param journal: utils.journal.ScanJournal, records group start, completed chunks and group end
+    :param resume: utils.journal.resume_state "partial" progress of this group, output is continued after its
+        last completed chunk, group header is expected to be already written
+    :return: total model prediction time, including this group
+    """
+    own_sink = out is None
+    if own_sink:
+        out = open_sink(args.out, args.output_format)
+
+    if packer is not None:
+        start_performance_time = packer.performance_time
+
+    def defer(function, *function_args):
+        """
+        Calls function after all previously submitted windows are predicted, if packer is used.
+        """
+        if packer is None:
+            function(*function_args)
+        else:
+            packer.defer(function, *function_args)
+
+    # Write archives info
+    line = ''
+    for path in l_archives:
+        line += f'{path} '
+    line += '\n'
+    if resume is None:
+        if journal:
+            defer(journal.group_started, n_archive, l_archives, out)
+        defer(out.write_line, line)
+
+    if group is None:
+        group = load_group(l_archives, args, metrics = metrics)
+    index = group
+
+    if index is None:
+        if journal:
+            defer(journal.group_done, n_archive, out)
+        if own_sink:
+            defer(out.close)
+        if packer is not None:
+            total_performance_time += packer.performance_time - start_performance_time
+        return total_performance_time
+
+    # Every segment, which is covered by all channels, is scanned as a separate trace
+    n_traces = len(index.segments)
+
+    # Progress bar preparations
+    total_batch_count = 0
+    for segment_start, segment_end in index.segments:
+
+        l_trace = segment_end - segment_start
+        last_batch = l_trace % args.trace_size
+        batch_count = l_trace // args.trace_size + 1 \
+            if last_batch \
+            else l_trace // args.trace_size
+
+        total_batch_count += batch_count
+
+    def process_chunk(scores, i, b, last, start_pos, end_pos, score_stream, trace_scores, ids, t_start):
+        """
+        Picks positives on the chunk scores and writes them to the output file.
+        :param scores: chunk scores, None if the chunk is shorter than a single window
+        :param last: True for the last chunk of the trace
+        :param start_pos, end_pos: chunk samples, relative to the trace start
+        """
+        if args.save_scores and scores is not None:
+            trace_scores.append(scores)
+
+        # Get indexes of predicted events, relative to the trace start
+        predicted_labels = score_stream.push(scores)
+        if last:
+            for label, positives in score_stream.flush().items():
+                predicted_labels[label].extend(positives)
+
+        detected_peaks = get_detected_peaks(predicted_labels, t_start)
+
+        if args.print_scores and scores is not None:
+            segment_start = index.segments[i][0]
+            batches = index.traces(segment_start + start_pos, segment_start + end_pos)
+            restored_scores = stools.restore_scores(scores, (len(batches[0]), len(model_labels)), args.shift)
+
+            # Only picks inside current chunk are plotted
+            batch_labels = {}
+            for label in predicted_labels:
+                batch_labels[label] = [[pos - start_pos, prob] for pos, prob in predicted_labels[label]
+                                       if 0 <= pos - start_pos < len(batches[0])]
+
+            stools.print_scores(batches, restored_scores, batch_labels, f'g{n_archive}_t{i}_b{b}')
+
+        out.write_peaks(detected_peaks, ids, t_start, precision = args.print_precision, metrics = metrics)
+
+        if journal:
+            journal.chunk_done(n_archive, i, b, score_stream.released, out)
+
+    # Scores indexes of the labels, which trigger fine rescan with --coarse-stride
+    trigger_labels = [model_labels[label] for label in positive_labels]
+    # Scores of the windows skipped by --gate
+    noise_scores = [0. if label in positive_labels else 1. for label in sorted(model_labels, key = model_labels.get)]
+
+    # Predict
+    current_batch_global = 0
+    group_scores = []  # (SEED id, start time, scores) of every trace for --save-scores
+    for i in range(n_traces):
+
+        # Traces, which are completed before the resumed chunk
+        if resume and resume['trace'] is not None and i < resume['trace']:
+            continue
+
+        segment_start, segment_end = index.segments[i]
+        l_trace = segment_end - segment_start
+
+        ids = index.ids
+        t_start = index.time(segment_start)
+
+        # Windows, which cross chunk boundaries, are scanned with the next chunk and picks
+        # are released only when their neighbourhood is scanned
+        score_stream = ScoreStream(args.shift, model_labels, positive_labels, threshold_labels,
+                                   sparse = args.sparse_picking, metrics = metrics)
+
+        def prepare_chunk(position, segment_start = segment_start):
+            """
+            Cuts chunk from the segment data and prepares model input.
+            """
+            start_pos, end_pos = position
+
+            data = index.slice(segment_start + start_pos, segment_start + end_pos)
+            prepared = stools.prepare_data(data, args = args, n_features = n_features, metrics = metrics)
+
+            return start_pos, end_pos, prepared
+
+        positions = chunk_positions(l_trace, args.trace_size, args.shift)
+        batch_count = len(positions)
+
+        # Resumed trace: rescan from the chunk, which gives picking context for the first not released pick,
+        # picks before it are already written
+        first_chunk = 0
+        if resume and resume['trace'] == i:
+
+            released = resume['released']
+            for b, (start_pos, _) in enumerate(positions):
+                if start_pos > released - score_stream.context or b > resume['chunk']:
+                    break
+                first_chunk = b
+
+            score_stream.seek(positions[first_chunk][0] // args.shift, released)
+            current_batch_global += first_chunk
+
+        positions = positions[first_chunk:]
+
+        # Next chunks are cut and prepared, while the model predicts on the current one
+        chunks = prefetch(prepare_chunk, positions, depth = args.prefetch)
+
+        trace_scores = []
+
+        for b, (start_pos, end_pos, prepared) in enumerate(chunks, first_chunk):
+
+            # Progress bar
+            if progress:
+                batch_start = index.time(segment_start + start_pos)
+                batch_end = index.time(segment_start + end_pos - 1)
+                if args.time:
+                    stools.progress_bar(current_batch_global / total_batch_count, 40, add_space_around = False,
+                                        prefix = f'Group {n_archive + 1} out of {n_archives} [',
+                                        postfix = f'] - Batch: {batch_start} '
+                                                  f'- {batch_end} '
+                                                  f'Time: {total_performance_time:.6} seconds')
+                else:
+                    stools.progress_bar(current_batch_global / total_batch_count, 40, add_space_around = False,
+                                        prefix = f'Group {n_archive + 1} out of {n_archives} [',
+                                        postfix = f'] - Batch: {batch_start}'
+                                                  f' - {batch_end}')
+            current_batch_global += 1
+
+            chunk = (i, b, b == batch_count - 1, start_pos, end_pos, score_stream, trace_scores, ids, t_start)
+
+            if packer is not None:
+                # Chunk is processed, when all its windows are predicted
+                packer.submit(prepared['windows'] if prepared is not None else None,
+                              lambda scores, chunk = chunk: process_chunk(scores, *chunk))
+                continue
+
+            scores = None
+            if prepared is not None:
+                scores, performance_time = stools.scan_traces(model = model,
+                                                              args = args,
+                                                              prepared = prepared,
+                                                              metrics = metrics,
+                                                              trigger_labels = trigger_labels,
+                                                              noise_scores = noise_scores)  # predict
+                total_performance_time += performance_time
+
+            process_chunk(scores, *chunk)
+
+        if args.save_scores:
+            def save_trace_scores(ids, t_start, trace_scores):
+                scores = np.concatenate(trace_scores) if trace_scores else np.zeros((0, len(model_labels)))
+                group_scores.append((ids, t_start, scores))
+
+            defer(save_trace_scores, ids, t_start, trace_scores)
+
+        if progress:
+            print('')
+
+    if args.save_scores:
+        def save_scores():
+            with timer(metrics, 'save_scores'):
+                save_group_scores(args.save_scores, l_archives, group_scores,
+                                  args.shift, n_features, frequency, model_labels)
+
+        defer(save_scores)
+
+    # Write separator, completed group is written to the output file
+    defer(out.write_line, '---' * 12 + '\n')
+    defer(out.flush, metrics)
+    if journal:
+        defer(journal.group_done, n_archive, out)
+    if own_sink:
+        defer(out.close)
+
+    if packer is not None:
+        total_performance_time += packer.performance_time - start_performance_time
+
+    return total_performance_time
+
+
+def rescan_group(n_archive, l_archives, args, positive_labels, threshold_labels, out = None, metrics = None):
+    """
+    Picks positives on the archive group scores saved with --save-scores, without running the model.
+    :param n_archive: archive group index
+    :param l_archives: list of the group archive paths, one per channel
+    :param args: archive_scan.py arguments
+    :param positive_labels: dictionary of labels to pick
+    :param threshold_labels: dictionary of thresholds for every positive label
+    :param out: utils.result_sink.ResultSink
+    :param metrics: utils.instrumentation.Metrics, default: None
+    :return: True if group scores are stored, False otherwise
+    """
+    # Write archives info
+    line = ''
+    for path in l_archives:
+        line += f'{path} '
+    line += '\n'
+    out.write_line(line)
+
+    with timer(metrics, 'load_scores'):
+        stored = load_group_scores(args.from_scores, l_archives)
+    if stored is None:
+        return False
+
+    meta, traces = stored
+
+    for ids, t_start, scores in traces:
+
+        score_stream = ScoreStream(meta['shift'], meta['model_labels'], positive_labels, threshold_labels,
+                                   sparse = args.sparse_picking, metrics = metrics)
+
+        predicted_labels = score_stream.push(scores)
+        for label, positives in score_stream.flush().items():
+            predicted_labels[label].extend(positives)
+
+        detected_peaks = get_detected_peaks(predicted_labels, t_start)
+        out.write_peaks(detected_peaks, ids, t_start, precision = args.print_precision, metrics = metrics)
+
+    # Write separator, completed group is written to the output file
+    out.write_line('---' * 12 + '\n')
+    out.flush(metrics)
+
+    return True
+
+
+"""
+Worker processes: every worker loads the model once and scans whole archive groups into its own
+part file, which is then appended to the output file by the main process in the input order.
+"""
+_worker = {}
+
+
+def init_worker(args, model_labels, positive_labels, threshold_labels, cpu_queue = None):
+    """
+    Worker process initializer: sets CPU affinity and threads and loads the model.
+    :param cpu_queue: queue of CPU lists, every worker takes one, None - no affinity
+    """
+    if args.cpu:
+        os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
+
+    from utils.cpu_config import configure_process
+    configure_process(cpu_queue.get() if cpu_queue is not None else None, args.blas_threads)
+
+    _worker['args'] = args
+    _worker['labels'] = (model_labels, positive_labels, threshold_labels)
+    _worker['model'] = load_model(args)
+    _worker['model'].warmup(args.batch_size)
+
+
+def scan_group_job(job):
+    """
+    Scans archive group in a worker process, with --pack-batches windows are packed across the group traces.
+    :param job: tuple (n_archive, l_archives)
+    :return: tuple (part file path, model prediction time, group metrics dictionary)
+    """
+    n_archive, l_archives = job
+    args = _worker['args']
+
+    part_path = f'{args.out}.{n_archive}.part'
+    if os.path.exists(part_path):
+        os.remove(part_path)
+    part = open_sink(part_path, part_format(args.output_format))
+
+    metrics = Metrics()
+    packer = None
+    if args.pack_batches:
+        packer = BatchPacker(_worker['model'], args.batch_size, metrics = metrics)
+
+    performance_time = scan_group(n_archive, l_archives, _worker['model'], args, *_worker['labels'],
+                                  out = part, progress = False, metrics = metrics, packer = packer)
+    if packer is not None:
+        packer.flush()
+        performance_time = packer.performance_time
+    part.close()
+
+    return part_path, performance_time, metrics.to_dict()
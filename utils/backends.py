@@ -0,0 +1,126 @@
+"""
+Inference backends: a single interface for running a model on batches of sliding windows, so scanning code
+(utils.scan_tools.predict_windows, utils.batching.BatchPacker, prc_eval.py) does not depend on how the model is
+executed.
+
+Backends:
+- KerasBackend - Keras model.predict_on_batch (archive_scan.py --backend keras)
+- FunctionBackend - direct call of a tf.function with fixed input signature, without Keras predict overhead
+  (--backend function)
+- utils.exported_model.ExportedModel - inference-only SavedModel artifact, a FunctionBackend
+- utils.tflite_model.TFLiteModel - quantized TFLite model (--backend tflite)
+
+Custom model loaders (archive_scan.py --model) may return either a Keras model or any InferenceBackend.
+
+Usage example:
+
+from utils.backends import as_backend
+backend = as_backend(model, 'function')
+backend.warmup(batch_size = 150)
+scores = backend.infer_batch(windows)  # windows shape: backend.input_spec.shape
+"""
+from collections import namedtuple
+
+import numpy as np
+
+
+# Model input: shape with None batch dimension, e.g. (None, 400, 3), and NumPy data type
+InputSpec = namedtuple('InputSpec', ['shape', 'dtype'])
+
+
+class InferenceBackend:
+
+    input_spec = None
+
+    def infer_batch(self, x):
+        """
+        Returns scores NumPy array of shape (batch, n_classes) for a batch of windows.
+        """
+        raise NotImplementedError
+
+    def warmup(self, batch_size = 1):
+        """
+        Runs inference on a zero batch, so graph tracing and memory allocation are not done on the first real batch.
+        """
+        shape = (batch_size, *self.input_spec.shape[1:])
+        self.infer_batch(np.zeros(shape, dtype = self.input_spec.dtype))
+
+    def predict(self, x, batch_size = 32):
+        """
+        Returns scores for all windows of NumPy array, or for all batches of keras Sequence (e.g. H5Generator),
+        which yields (X, Y) tuples.
+        """
+        if isinstance(x, np.ndarray):
+            batches = (x[start : start + batch_size] for start in range(0, x.shape[0], batch_size))
+        else:
+            batches = (x[i] for i in range(len(x)))
+
+        scores = []
+        for batch in batches:
+            if isinstance(batch, tuple):
+                batch = batch[0]
+            scores.append(self.infer_batch(batch))
+
+        return np.concatenate(scores)
+
+
+class KerasBackend(InferenceBackend):
+
+    def __init__(self, model):
+        """
+        :param model: Keras model
+        """
+        self.model = model
+        self.input_spec = InputSpec(tuple(model.input_shape), np.float32)
+
+    def infer_batch(self, x):
+        return np.asarray(self.model.predict_on_batch(x))
+
+
+class FunctionBackend(InferenceBackend):
+
+    def __init__(self, function, input_spec):
+        """
+        :param function: tf.function, which takes a float32 batch tensor and returns scores tensor
+        :param input_spec: InputSpec of the function input
+        """
+        self.function = function
+        self.input_spec = input_spec
+
+    @classmethod
+    def from_keras(cls, model):
+        """
+        Returns backend, which calls the Keras model in inference mode through a tf.function, traced once
+        for any batch size.
+        """
+        import tensorflow as tf
+
+        input_spec = InputSpec(tuple(model.input_shape), np.float32)
+        function = tf.function(lambda x: model(x, training = False),
+                               input_signature = [tf.TensorSpec(input_spec.shape, tf.float32)])
+
+        backend = cls(function, input_spec)
+        backend.model = model
+
+        return backend
+
+    def infer_batch(self, x):
+        import tensorflow as tf
+        return self.function(tf.convert_to_tensor(x, dtype = tf.float32)).numpy()
+
+
+def as_backend(model, backend = 'keras'):
+    """
+    Wraps model into the inference backend.
+    :param model: Keras model or InferenceBackend, which is returned as is
+    :param backend: "keras" - KerasBackend or "function" - FunctionBackend
+    """
+    if isinstance(model, InferenceBackend):
+        return model
+
+    if backend == 'function':
+        return FunctionBackend.from_keras(model)
+    if backend == 'keras':
+        return KerasBackend(model)
+
+    raise ValueError(f'Backend "{backend}" can not be used with Keras model')
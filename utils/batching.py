@@ -0,0 +1,141 @@
+"""
+Cross-station batch packing: sliding windows of many trace chunks, traces and archive groups are packed into
+fixed size model batches, so every model call is full, no matter how short the scanned segments are.
+
+Every submitted request (windows of a single chunk) gets its scores in a callback. Callbacks are called strictly
+in the submission order, when scores of the request and of all previous requests are available. Requests without
+windows are used to defer actions (e.g. output file writes) until every previously submitted chunk is processed.
+
+Usage example:
+
+packer = BatchPacker(model, batch_size = 150)
+for windows in chunks:
+    packer.submit(windows, lambda scores: process(scores))
+packer.defer(write_separator)
+packer.flush()  # predicts the last partial batch and calls remaining callbacks
+"""
+from time import time
+from collections import deque
+
+import numpy as np
+
+from utils.instrumentation import timer, count
+
+
+class _Request:
+
+    def __init__(self, windows, callback):
+        self.windows = windows
+        self.callback = callback
+        self.scores = None
+        self.size = 0 if windows is None else windows.shape[0]
+        self.copied = 0  # windows copied into batches
+        self.scored = 0  # windows with scores
+
+    @property
+    def complete(self):
+        return self.scored >= self.size
+
+
+class BatchPacker:
+
+    def __init__(self, model, batch_size, dtype = np.float32, metrics = None):
+        """
+        :param model: utils.backends.InferenceBackend
+        :param batch_size: number of windows in every model call, only the last call made by flush can be smaller
+        :param dtype: model input data type, default: float32
+        :param metrics: utils.instrumentation.Metrics, default: None
+        """
+        self.model = model
+        self.batch_size = batch_size
+        self.dtype = dtype
+        self.metrics = metrics
+
+        self.performance_time = 0.  # total model prediction time
+
+        self._requests = deque()  # requests, which callbacks are not called yet
+        self._batch = None  # batch buffer, allocated on the first submitted windows
+        self._filled = 0  # number of windows in the batch buffer
+        self._routes = []  # (request, request offset, batch offset, number of windows) for the batch buffer windows
+
+    def submit(self, windows, callback):
+        """
+        Adds windows to the batches, predicts every batch which is filled up and calls callbacks of
+        completed requests.
+        :param windows: sliding windows array or view of shape (n_windows, n_features, n_channels), or None
+        :param callback: function, called with scores of shape (n_windows, n_classes), or with None if there
+            are no windows
+        """
+        if windows is not None and not windows.shape[0]:
+            windows = None
+
+        request = _Request(windows, callback)
+        self._requests.append(request)
+
+        if windows is not None and self._batch is None:
+            self._batch = np.empty((self.batch_size, *windows.shape[1:]), dtype = self.dtype)
+
+        while request.copied < request.size:
+
+            n = min(self.batch_size - self._filled, request.size - request.copied)
+            self._batch[self._filled : self._filled + n] = windows[request.copied : request.copied + n]
+            self._routes.append((request, request.copied, self._filled, n))
+
+            request.copied += n
+            self._filled += n
+
+            if self._filled == self.batch_size:
+                self._predict()
+
+        self._complete()
+
+    def defer(self, function, *args):
+        """
+        Calls function(*args) after every previously submitted request is processed.
+        """
+        self.submit(None, lambda scores: function(*args))
+
+    def flush(self):
+        """
+        Predicts the last partial batch and calls every remaining callback.
+        """
+        self._predict()
+        self._complete()
+
+    def _predict(self):
+        """
+        Predicts filled part of the batch buffer and routes scores back to the requests.
+        """
+        if not self._filled:
+            return
+
+        start_time = time()
+        with timer(self.metrics, 'predict'):
+            scores = self.model.infer_batch(self._batch[:self._filled])
+        self.performance_time += time() - start_time
+
+        count(self.metrics, 'windows', self._filled)
+        count(self.metrics, 'batches')
+
+        for request, request_offset, batch_offset, n in self._routes:
+
+            if request.scores is None:
+                request.scores = np.empty((request.size, scores.shape[1]), dtype = scores.dtype)
+
+            request.scores[request_offset : request_offset + n] = scores[batch_offset : batch_offset + n]
+            request.scored += n
+
+            # Release windows view, so chunk data can be freed before the callback
+            if request.complete:
+                request.windows = None
+
+        self._filled = 0
+        self._routes = []
+
+    def _complete(self):
+        """
+        Calls callbacks of completed requests in the submission order.
+        """
+        while self._requests and self._requests[0].complete:
+            request = self._requests.popleft()
+            request.callback(request.scores)
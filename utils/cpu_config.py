@@ -0,0 +1,139 @@
+"""
+CPU thread pools and core affinity of the scanner processes (see archive_scan.py --intra-op-threads,
+--inter-op-threads, --blas-threads and --cpu-affinity).
+
+BLAS and OpenMP thread numbers are read by NumPy and SciPy libraries when they are loaded, so configure_process
+should be called before NumPy import: environment variables are also inherited by the worker processes.
+If threadpoolctl is installed, limits are also applied to already loaded libraries. TensorFlow thread pools
+should be set before the first TensorFlow operation, see configure_tensorflow.
+
+Usage example:
+
+cpus = parse_cpu_list('0-7,16-23')
+configure_process(cpus, blas_threads = 1)
+import numpy as np
+configure_tensorflow(intra_op_threads = 8, inter_op_threads = 1)
+"""
+import os
+
+
+# Thread number variables of OpenMP and BLAS implementations
+blas_variables = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'BLIS_NUM_THREADS',
+                  'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+
+def parse_cpu_list(spec):
+    """
+    Parses CPU list, format: "0-7,16-23" or "0,2,4". Raises ValueError on wrong format or if some CPUs are not
+    available to the process.
+    :return: sorted list of CPU indexes
+    """
+    cpus = set()
+    for part in spec.split(','):
+
+        part = part.strip()
+        if not part:
+            continue
+
+        if '-' in part:
+            first, last = part.split('-')
+            first, last = int(first), int(last)
+            if first > last:
+                raise ValueError(f'Wrong CPU range "{part}"')
+            cpus.update(range(first, last + 1))
+        else:
+            cpus.add(int(part))
+
+    if not cpus or min(cpus) < 0:
+        raise ValueError(f'Wrong CPU list "{spec}"')
+
+    unavailable = cpus - set(available_cpus())
+    if unavailable:
+        raise ValueError(f'CPUs {", ".join(map(str, sorted(unavailable)))} are not available,'
+                         f' available CPUs: {", ".join(map(str, available_cpus()))}')
+
+    return sorted(cpus)
+
+
+def available_cpus():
+    """
+    Returns sorted list of CPUs, which the process is allowed to run on.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def split_cpus(cpus, n):
+    """
+    Splits CPU list into n contiguous parts of equal (+-1) size, e.g. one per worker process.
+    Raises ValueError if there are fewer CPUs than parts.
+    """
+    if len(cpus) < n:
+        raise ValueError(f'Can not split {len(cpus)} CPUs between {n} processes')
+
+    size, rest = divmod(len(cpus), n)
+
+    parts = []
+    start = 0
+    for i in range(n):
+        end = start + size + (1 if i < rest else 0)
+        parts.append(cpus[start : end])
+        start = end
+
+    return parts
+
+
+def configure_process(cpus = None, blas_threads = None):
+    """
+    Sets CPU affinity and BLAS/OpenMP threads number of the current process.
+    :param cpus: list of CPU indexes, None - do not change affinity
+    :param blas_threads: BLAS and OpenMP threads number, None - library defaults
+    """
+    if cpus is not None:
+        if not hasattr(os, 'sched_setaffinity'):
+            raise ValueError('CPU affinity is not supported on this platform')
+        os.sched_setaffinity(0, cpus)
+
+    if blas_threads is not None:
+        for variable in blas_variables:
+            os.environ[variable] = str(blas_threads)
+
+        try:
+            from threadpoolctl import threadpool_limits
+            threadpool_limits(limits = blas_threads)
+        except ImportError:
+            pass
+
+
+def configure_tensorflow(intra_op_threads = None, inter_op_threads = None):
+    """
+    Sets TensorFlow thread pools size, should be called before the first TensorFlow operation.
+    :param intra_op_threads: threads number of a single operation (e.g. matrix multiplication), None - default
+    :param inter_op_threads: threads number for independent operations, None - default
+    Raises ValueError if TensorFlow is already initialized.
+    """
+    if intra_op_threads is None and inter_op_threads is None:
+        return
+
+    try:
+        import tensorflow as tf
+    except ImportError:
+        return  # custom model loaders may not use TensorFlow
+
+    try:
+        if intra_op_threads is not None:
+            tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+        if inter_op_threads is not None:
+            tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+    except RuntimeError as e:
+        raise ValueError(f'TensorFlow thread pools can not be set after TensorFlow initialization: {e}')
+
+
+def process_threads(cpus, workers):
+    """
+    Returns default threads number of every process, when cores are split evenly between the workers.
+    :param cpus: list of CPUs available to the run
+    :param workers: number of scanner processes
+    """
+    return max(1, len(cpus) // max(1, workers))
@@ -0,0 +1,94 @@
+"""
+Inference-only model artifacts: a SavedModel with a single concrete function of fixed input signature
+(batch, n_features, n_channels) float32, exported from a Keras model (see export_model.py).
+
+Loading an artifact restores the traced graph and its weights only: model code, Keras layers and optimizer are not
+rebuilt, so startup of short scan jobs and worker processes is much faster.
+
+Usage example:
+
+from utils.exported_model import export_model, ExportedModel
+export_model(model, 'WEIGHTS/w_model_performer_v2.0.savedmodel', weights_path = 'WEIGHTS/w_model_performer_v2.0.h5')
+model = ExportedModel('WEIGHTS/w_model_performer_v2.0.savedmodel')
+scores = model.infer_batch(windows)
+"""
+import os
+import json
+import numpy as np
+
+from utils.backends import FunctionBackend, InputSpec
+
+
+# Artifact description file, stored in the SavedModel directory
+META_FILE = 'seismo_meta.json'
+
+
+def exported_path(weights_path):
+    """
+    Returns default artifact path for the weights file: same path with .savedmodel extension.
+    """
+    return os.path.splitext(weights_path)[0] + '.savedmodel'
+
+
+def find_exported(weights_path):
+    """
+    Returns default artifact path for the weights file, if the artifact exists and is not older than the weights,
+    otherwise None.
+    """
+    path = exported_path(weights_path)
+    meta_path = os.path.join(path, META_FILE)
+
+    if not os.path.exists(meta_path) or not os.path.exists(weights_path):
+        return None
+    if os.path.getmtime(meta_path) < os.path.getmtime(weights_path):
+        return None
+
+    return path
+
+
+def export_model(model, path, weights_path = None, model_name = None):
+    """
+    Exports inference-only SavedModel of the Keras model.
+    :param model: Keras model with input shape (None, n_features, n_channels)
+    :param path: artifact directory path
+    :param weights_path: model weights path, saved to the artifact description
+    :param model_name: model name, saved to the artifact description
+    """
+    import tensorflow as tf
+
+    input_shape = tuple(model.input_shape[1:])
+
+    module = tf.Module()
+    module.model = model
+    module.predict = tf.function(lambda x: model(x, training = False),
+                                 input_signature = [tf.TensorSpec((None, *input_shape), tf.float32)])
+
+    tf.saved_model.save(module, path, signatures = {'serving_default': module.predict})
+
+    # Description is written last, so incomplete exports are not loaded by find_exported
+    meta = {'model': model_name,
+            'weights': weights_path,
+            'input_shape': list(input_shape),
+            'n_classes': int(model.output_shape[-1])}
+    with open(os.path.join(path, META_FILE), 'w') as f:
+        json.dump(meta, f, indent = 2)
+
+
+class ExportedModel(FunctionBackend):
+
+    def __init__(self, path):
+        """
+        Loads inference-only model artifact.
+        :param path: artifact directory path
+        """
+        import tensorflow as tf
+
+        with open(os.path.join(path, META_FILE)) as f:
+            self.meta = json.load(f)
+
+        self.path = path
+        self.module = tf.saved_model.load(path)
+
+        super().__init__(self.module.predict, InputSpec((None, *self.meta['input_shape']), np.float32))
+
+        self.output_shape = (None, self.meta['n_classes'])
@@ -44,16 +44,17 @@ def gpd(n_samples = 400, n_channels = 3, n_classes = 3, flatten = True):
     return keras.Model(inputs, outputs)
 
 
-def load_model(weights_path):
+def load_model(weights_path, compile = True):
 
     model = gpd()
 
     model.load_weights(weights_path)
 
-    model.compile(
-        optimizer = keras.optimizers.Adam(),
-        loss = keras.losses.SparseCategoricalCrossentropy(),
-        metrics = [keras.metrics.SparseCategoricalAccuracy()]
-    )
+    if compile:
+        model.compile(
+            optimizer = keras.optimizers.Adam(),
+            loss = keras.losses.SparseCategoricalCrossentropy(),
+            metrics = [keras.metrics.SparseCategoricalAccuracy()]
+        )
 
     return model
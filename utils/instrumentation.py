@@ -0,0 +1,141 @@
+"""
+Scan instrumentation: named stage timers and counters, collected per archive group and per run and dumped
+as JSON or Prometheus text file format (for node_exporter textfile collector).
+
+Usage example:
+
+from utils.instrumentation import Metrics, timer, count
+metrics = Metrics()
+with timer(metrics, 'predict'):
+    scores = model.predict(windows)
+count(metrics, 'windows', scores.shape[0])
+
+Hot path functions accept metrics = None, so timer and count do nothing if instrumentation is not used.
+"""
+import os
+import json
+import tempfile
+import threading
+from time import time
+from contextlib import contextmanager, nullcontext
+
+
+class Metrics:
+
+    def __init__(self):
+        self.timers = {}  # stage name: total wall time in seconds
+        self.counters = {}  # counter name: value
+        self._lock = threading.Lock()  # stages can run in background threads, see utils.pipeline
+
+    @contextmanager
+    def timer(self, name):
+        """
+        Adds wall time of the block to the named timer.
+        """
+        start_time = time()
+        try:
+            yield
+        finally:
+            elapsed = time() - start_time
+            with self._lock:
+                self.timers[name] = self.timers.get(name, 0.) + elapsed
+
+    def count(self, name, value = 1):
+        """
+        Adds value to the named counter.
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add(self, other):
+        """
+        Adds timers and counters of other Metrics or of its to_dict() output.
+        """
+        if isinstance(other, Metrics):
+            other = other.to_dict()
+
+        with self._lock:
+            for name, value in other['timers'].items():
+                self.timers[name] = self.timers.get(name, 0.) + value
+            for name, value in other['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def to_dict(self):
+        with self._lock:
+            return {'timers': dict(self.timers), 'counters': dict(self.counters)}
+
+    def to_prometheus(self, prefix = 'seismo_scan'):
+        """
+        Returns metrics in Prometheus text exposition format.
+        """
+        metrics = self.to_dict()
+
+        lines = [f'# HELP {prefix}_stage_seconds_total Wall time spent in scan stage.',
+                 f'# TYPE {prefix}_stage_seconds_total counter']
+        for name, value in sorted(metrics['timers'].items()):
+            lines.append(f'{prefix}_stage_seconds_total{{stage="{name}"}} {value:.6f}')
+
+        for name, value in sorted(metrics['counters'].items()):
+            lines.append(f'# TYPE {prefix}_{name}_total counter')
+            lines.append(f'{prefix}_{name}_total {value}')
+
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """
+        Returns human readable stages summary.
+        """
+        metrics = self.to_dict()
+
+        lines = []
+        for name, value in sorted(metrics['timers'].items(), key = lambda x: -x[1]):
+            lines.append(f'{name}: {value:.6} seconds')
+        for name, value in sorted(metrics['counters'].items()):
+            lines.append(f'{name}: {value}')
+
+        return '\n'.join(lines)
+
+
+def timer(metrics, name):
+    """
+    Returns metrics timer context manager, or a context manager which does nothing if metrics is None.
+    """
+    if metrics is None:
+        return nullcontext()
+    return metrics.timer(name)
+
+
+def count(metrics, name, value = 1):
+    """
+    Adds value to the metrics counter, does nothing if metrics is None.
+    """
+    if metrics is not None:
+        metrics.count(name, value)
+
+
+def dump_metrics(path, run_metrics, group_metrics = None, file_format = 'json'):
+    """
+    Atomically writes metrics file, so it can be read at any time during the scan.
+    :param path: output file path
+    :param run_metrics: Metrics of the whole run
+    :param group_metrics: list of (archive paths, Metrics) for every scanned group, JSON format only
+    :param file_format: "json" or "prometheus"
+    """
+    if file_format == 'prometheus':
+        text = run_metrics.to_prometheus()
+        if group_metrics is not None:
+            text += f'# TYPE seismo_scan_groups_total counter\nseismo_scan_groups_total {len(group_metrics)}\n'
+    elif file_format == 'json':
+        data = {'run': run_metrics.to_dict()}
+        if group_metrics is not None:
+            data['groups'] = [dict(metrics.to_dict(), archives = l_archives) for l_archives, metrics in group_metrics]
+        text = json.dumps(data, indent = 2)
+    else:
+        raise ValueError(f'Unknown metrics format "{file_format}"')
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir = directory, prefix = '.metrics.')
+    with os.fdopen(fd, 'w') as f:
+        f.write(text)
+
+    os.replace(tmp_path, path)
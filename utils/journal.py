@@ -0,0 +1,154 @@
+"""
+Crash-safe scan journal for archive_scan.py --resume.
+
+Journal is an append-only file of JSON lines, every line is flushed and synced to disk after the output file,
+so a record is never written before its output. A record is kept pending until the output sink writes its
+output: completed groups are flushed with their "done" record, chunk records wait for the sink buffer thresholds
+(including its flush interval, so a completed chunk is recorded at most flush_interval seconds later), and the
+journal always points to the last durably written output. Records:
+- {"event": "group", "group": n, "archives": [...], "offset": output size before the group header}
+- {"event": "chunk", "group": n, "trace": i, "chunk": b, "released": sample, "offset": output size after chunk}
+- {"event": "done", "group": n, "offset": output size after the group separator}
+
+"released" is ScoreStream.released after the chunk: all picks of the trace before this sample are written.
+On resume, output is truncated to the offset of the last record, so partially written output is removed,
+completed groups are skipped and the last group is continued after its last completed chunk.
+
+Usage example:
+
+state = resume_state(journal_path, archives)
+journal = ScanJournal(journal_path, append = True)
+journal.group_started(n_archive, l_archives, sink)
+journal.chunk_done(n_archive, i, b, score_stream.released, sink)
+journal.group_done(n_archive, sink)
+journal.close(sink)
+"""
+import os
+import json
+
+
+def load_records(path):
+    """
+    Returns list of journal records, partially written last line is ignored.
+    """
+    if not os.path.exists(path):
+        return []
+
+    records = []
+    with open(path) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                break
+
+    return records
+
+
+def resume_state(path, archives):
+    """
+    Returns resume state of the journal, or None if journal is empty. Raises ValueError if journal groups do not
+    match the input archives.
+    :param path: journal path
+    :param archives: list of archive groups, see parse_archive_csv
+    :return: dictionary:
+        "done" - set of completed group indexes,
+        "offset" - output size to truncate output file to,
+        "partial" - None or last group progress: {"group", "trace", "chunk", "released", "group_offset"}
+    """
+    records = load_records(path)
+    if not records:
+        return None
+
+    done = set()
+    partial = None
+    for record in records:
+
+        n_archive = record['group']
+        if record['event'] == 'group':
+            if n_archive >= len(archives) or record['archives'] != archives[n_archive]:
+                raise ValueError(f'Journal {path} does not match input archives: group {n_archive + 1}'
+                                 f' is {" ".join(record["archives"])}')
+            partial = {'group': n_archive, 'trace': None, 'chunk': None, 'released': None,
+                       'group_offset': record['offset']}
+        elif record['event'] == 'chunk':
+            partial.update(trace = record['trace'], chunk = record['chunk'], released = record['released'])
+        elif record['event'] == 'done':
+            done.add(n_archive)
+            partial = None
+
+    return {'done': done, 'offset': records[-1]['offset'], 'partial': partial}
+
+
+def truncate_output(path, offset):
+    """
+    Truncates output file to the journal offset, removing output which is not recorded in the journal.
+    """
+    if os.path.exists(path) and os.path.getsize(path) > offset:
+        with open(path, 'r+b') as f:
+            f.truncate(offset)
+
+
+class ScanJournal:
+
+    def __init__(self, path, append = False):
+        """
+        :param path: journal path
+        :param append: continue existing journal, otherwise it is overwritten
+        """
+        self.path = path
+        self.file = open(path, 'a' if append else 'w')
+        self.pending = []  # records, which output is not written yet
+
+    def close(self, out = None):
+        """
+        Writes the output and all pending records, call before the output is closed.
+        :param out: utils.result_sink.ResultSink of the output file, default: None (pending records are dropped)
+        """
+        if out is not None:
+            out.flush()
+            self.commit(out)
+        self.file.close()
+
+    def write(self, record, out, flush = False):
+        """
+        Adds record with the output size after all already buffered output, record is written to the journal
+        when this output is synced to disk.
+        :param out: utils.result_sink.ResultSink of the output file
+        :param flush: write buffered output now, otherwise only if it reached a sink buffer threshold
+        """
+        record['offset'] = out.position()
+        self.pending.append(record)
+
+        if flush:
+            out.flush()
+        else:
+            out.check_flush()
+        self.commit(out)
+
+    def commit(self, out):
+        """
+        Syncs written output and appends records of the synced output to the journal.
+        """
+        durable = out.sync()
+
+        n = 0
+        while n < len(self.pending) and self.pending[n]['offset'] <= durable:
+            n += 1
+        if not n:
+            return
+
+        self.file.write(''.join(json.dumps(record) + '\n' for record in self.pending[:n]))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.pending = self.pending[n:]
+
+    def group_started(self, n_archive, l_archives, out):
+        self.write({'event': 'group', 'group': n_archive, 'archives': l_archives}, out)
+
+    def chunk_done(self, n_archive, trace, chunk, released, out):
+        self.write({'event': 'chunk', 'group': n_archive, 'trace': trace, 'chunk': chunk,
+                    'released': int(released)}, out)
+
+    def group_done(self, n_archive, out):
+        self.write({'event': 'done', 'group': n_archive}, out, flush = True)
@@ -0,0 +1,50 @@
+"""
+Background stages for archive scanning: reading and preprocessing of the next archive groups and chunks
+is done in background threads, while the model predicts on the current one.
+
+Usage example:
+
+from utils.pipeline import prefetch
+for group in prefetch(load_group, archives, depth = 2):
+    scan(group)
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def prefetch(function, items, depth = 1, workers = 1):
+    """
+    Yields function(item) for every item in the original order, computing up to depth results ahead
+    in background threads. Results are computed only when there is room for them, so no more than
+    depth + 1 results are held in memory at once.
+    :param function: stage function
+    :param items: iterable of stage inputs
+    :param depth: number of results computed ahead, 0 - compute every result in the calling thread
+        only when it is requested.
+    :param workers: number of background threads
+    """
+    if depth <= 0:
+        for item in items:
+            yield function(item)
+        return
+
+    items = iter(items)
+
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(function, item))
+            if len(pending) >= depth:
+                break
+
+        while pending:
+
+            result = pending.popleft().result()
+
+            # Refill the queue before handing the result to the consumer
+            for item in items:
+                pending.append(executor.submit(function, item))
+                break
+
+            yield result
@@ -0,0 +1,174 @@
+"""
+Vectorised preprocessing kernels for multi-channel data of shape (n_channels, n_samples): linear detrend,
+Butterworth highpass with cached filter design and filter state kept between data chunks, and weighted average
+slopes resampling of stacked channels. Kernels give the same results as obspy Trace.detrend('linear'), Trace.filter('highpass', ...)
+and Trace.interpolate(...) of every channel, but process all channels in a single pass, without Trace methods
+and filter design on every call.
+
+Usage example:
+
+data = detrend_linear(data)
+highpass = HighpassFilter(2., 100., n_channels = 3)
+for chunk in chunks:
+    filtered = highpass(chunk)  # same as filtering concatenated chunks at once
+data = resample(data, 50., 100.)
+"""
+import math
+import numpy as np
+
+from utils.scan_tools import highpass_sos
+
+
+def detrend_linear(data):
+    """
+    Returns data with least squares line of every channel subtracted, same as scipy.signal.detrend(type = 'linear').
+    :param data: array of shape (n_channels, n_samples)
+    """
+    data = np.asarray(data, dtype = np.float64)
+    n_samples = data.shape[-1]
+
+    mean = data.mean(axis = -1, keepdims = True)
+    if n_samples < 2:
+        return data - mean
+
+    x = np.arange(n_samples, dtype = np.float64) - (n_samples - 1) / 2.
+    slope = (data @ x)[..., np.newaxis] / np.dot(x, x)
+
+    return data - mean - slope * x
+
+
+class HighpassFilter:
+
+    def __init__(self, freq, df, n_channels, corners = 4):
+        """
+        Causal Butterworth highpass filter of multi-channel data, same as obspy Trace.filter('highpass', ...).
+        Filter state of every channel is kept between calls, so consecutive chunks are filtered exactly as the
+        whole data at once.
+        :param freq: filter corner frequency
+        :param df: sampling rate
+        :param n_channels: number of channels
+        :param corners: filter corners number
+        """
+        self.sos = highpass_sos(freq, df, corners)
+        self.n_channels = n_channels
+        self.state = np.zeros((self.sos.shape[0], self.n_channels, 2))
+
+    def reset(self, channels = None, initial = None):
+        """
+        Resets filter state, e.g. after a gap in the data.
+        :param channels: indexes of the channels to reset, default: None (all channels)
+        :param initial: first sample of the next data of every channel, or a single value: state is the steady
+            state of constant data of this value, so the data offset gives no step transient. Default: None (zero
+            state, same as obspy Trace.filter)
+        """
+        from scipy.signal import sosfilt_zi
+
+        if channels is None:
+            channels = slice(None)
+
+        if initial is None:
+            self.state[:, channels] = 0.
+        else:
+            initial = np.reshape(np.asarray(initial, dtype = np.float64), (-1, 1))
+            self.state[:, channels] = sosfilt_zi(self.sos)[:, np.newaxis, :] * initial
+
+    def __call__(self, data, channels = None):
+        """
+        Filters next chunk of the data.
+        :param data: array of shape (n_channels, n_samples), or (len(channels), n_samples)
+        :param channels: indexes of the data channels, default: None (all channels)
+        :return: filtered data, float64
+        """
+        from scipy.signal import sosfilt
+
+        if channels is None:
+            channels = slice(None)
+
+        data, self.state[:, channels] = sosfilt(self.sos, np.asarray(data, dtype = np.float64), axis = -1,
+                                                zi = self.state[:, channels])
+        return data
+
+
+def resample_npts(n_samples, frequency, new_frequency):
+    """
+    Returns number of samples after resampling, without extrapolation, same as obspy Trace.interpolate.
+    """
+    return int(math.floor((n_samples - 1) / frequency * new_frequency)) + 1
+
+
+def resample(data, frequency, new_frequency, npts = None, start = 0.):
+    """
+    Resamples data with the weighted average slopes interpolation (Wiggins, 1976), same as obspy
+    Trace.interpolate(new_frequency) default method. New samples start at the first sample of the data.
+    Interpolation of every channel is done by the compiled obspy kernel, which is faster than the same scheme
+    vectorised with NumPy.
+    :param data: array of shape (n_channels, n_samples)
+    :param frequency: data sampling rate
+    :param new_frequency: required sampling rate
+    :param npts: number of new samples, default: all samples inside the data time span, see resample_npts
+    :param start: data start timestamp, obspy rounding of the new samples positions depends on it, default: 0
+    :return: resampled data, float64
+    """
+    from obspy.signal.interpolation import weighted_average_slopes
+
+    data = np.asarray(data, dtype = np.float64)
+    if npts is None:
+        npts = resample_npts(data.shape[-1], frequency, new_frequency)
+
+    resampled = np.empty((*data.shape[:-1], npts))
+    for index in np.ndindex(*data.shape[:-1]):
+        resampled[index] = weighted_average_slopes(data[index], start, 1. / frequency, start, 1. / new_frequency,
+                                                   npts)
+
+    # Kernel reads past the data end for a new sample exactly at the last sample, interpolated value is the last
+    # sample itself
+    at_end = np.arange(npts) * frequency >= (data.shape[-1] - 1) * new_frequency
+    resampled[..., at_end] = data[..., -1:]
+
+    return resampled
+
+
+def pre_process_streams(streams, no_filter = False, no_detrend = False, dtype = None, frequency = 100.,
+                        highpass = 2.):
+    """
+    Preprocesses traces of all streams in place: linear detrend, highpass filter and resampling to the frequency,
+    same as utils.scan_tools.pre_process_stream did with obspy Stream methods. Traces with the same start time,
+    length and sampling rate (e.g. channels of a continuous archive) are stacked and processed in a single pass.
+
+    Arguments:
+    streams     -- list of obspy.core.stream objects
+    no_filter   -- do not filter traces
+    no_detrend  -- do not detrend traces
+    dtype       -- data type of the preprocessed traces, default: None (float64)
+    frequency   -- required frequency, default: 100
+    highpass    -- highpass filter frequency, default: 2
+    """
+    groups = {}
+    for stream in streams:
+        for trace in stream:
+            stats = trace.stats
+            groups.setdefault((stats.starttime.ns, stats.npts, stats.sampling_rate), []).append(trace)
+
+    for (_, _, sampling_rate), traces in groups.items():
+
+        data = np.stack([trace.data for trace in traces]).astype(np.float64)
+
+        if not no_detrend:
+            data = detrend_linear(data)
+        if not no_filter:
+            data = HighpassFilter(highpass, sampling_rate, len(traces))(data)
+
+        stats = traces[0].stats
+        delta = stats.delta
+        if delta != 1. / frequency:
+            # Number of samples is computed from timestamps, as obspy Trace.interpolate does
+            npts = int(math.floor((stats.endtime.timestamp - stats.starttime.timestamp) / (1. / frequency))) + 1
+            data = resample(data, sampling_rate, frequency, npts = npts, start = stats.starttime.timestamp)
+            delta = 1. / frequency
+
+        if dtype is not None:
+            data = data.astype(dtype, copy = False)
+
+        for trace, trace_data in zip(traces, data):
+            trace.data = trace_data
+            trace.stats.delta = delta
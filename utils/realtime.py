@@ -0,0 +1,456 @@
+"""
+Real-time detection on miniSEED record streams (see realtime_scan.py).
+
+Every station keeps a ring buffer of highpass filtered samples per channel. When new records complete sliding
+windows on all channels of the station, only those new windows are normalized (every window by its own maximum,
+so scores do not depend on how records are split into reads) and submitted to the model,
+through a BatchPacker shared by all stations, which is flushed after every read from the source. Scores are
+picked with a per station ScoreStream and picks are written through a result sink (see utils.result_sink), which
+is synced after every read with picks, as soon as they are released, together with their latency: wall time from arrival of the record, which completed the pick windows, to the pick output.
+
+Window k of a station starts at sample k * shift from the station start time (start of its first record).
+Channels, which start later (e.g. first record of a late channel), are aligned on the station samples, and
+scanning starts from the first window covered by all channels. If a channel has a gap after its first record,
+the station is restarted from the first record after the gap.
+
+Usage example:
+
+scanner = RealtimeScanner(model, 'predictions.txt', model_labels, positive_labels, threshold_labels)
+for records, arrival_time in tcp_records('localhost', 18000):
+    for record in records:
+        scanner.add_record(record, arrival_time)
+    scanner.process()
+scanner.close()
+"""
+import io
+import os
+import socket
+from time import time, sleep
+
+import numpy as np
+from obspy import read
+
+import utils.scan_tools as stools
+from utils.streaming import ScoreStream
+from utils.preprocessing import HighpassFilter
+from utils.batching import BatchPacker
+from utils.result_sink import open_sink, channel_code
+from utils.archive_scanner import get_detected_peaks
+from utils.instrumentation import timer, count
+
+
+# Channel code last letter: component index, components are ordered N, E, Z as in archive_scan.py input
+components = {'N': 0, '1': 0, 'E': 1, '2': 1, 'Z': 2}
+
+
+class RingBuffer:
+
+    def __init__(self, capacity):
+        """
+        :param capacity: number of stored samples
+        """
+        self.data = np.zeros(capacity, dtype = np.float32)
+        self.begin = 0  # absolute position of the first appended sample
+        self.end = 0  # absolute position of the next sample
+
+    @property
+    def start(self):
+        """
+        Absolute position of the oldest stored sample.
+        """
+        return max(self.begin, self.end - self.data.shape[0])
+
+    def seek(self, position):
+        """
+        Sets absolute position of the first sample of the empty buffer.
+        """
+        if self.end != self.begin:
+            raise ValueError('Only empty buffer position can be set')
+        self.begin = self.end = position
+
+    def append(self, values):
+        """
+        Appends samples, sample with absolute position i is stored at index i % capacity.
+        """
+        capacity = self.data.shape[0]
+        new_end = self.end + values.shape[0]
+
+        positions = np.arange(max(self.end, new_end - capacity), new_end)
+        self.data[positions % capacity] = values[values.shape[0] - positions.shape[0]:]
+
+        self.end = new_end
+
+    def get(self, start, end):
+        """
+        Returns copy of samples in absolute positions [start, end), raises IndexError if they are not stored.
+        """
+        if start < self.start or end > self.end:
+            raise IndexError(f'Samples [{start}, {end}) are not stored, stored: [{self.start}, {self.end})')
+
+        return self.data[np.arange(start, end) % self.data.shape[0]]
+
+
+class StationStream:
+
+    def __init__(self, starttime, frequency, shift, n_features, capacity, highpass = 2.):
+        """
+        :param starttime: UTCDateTime of the station first sample
+        :param frequency: sampling rate
+        :param shift: sliding windows shift
+        :param n_features: window length in samples
+        :param capacity: ring buffers capacity in samples
+        :param highpass: highpass filter frequency, None - no filter
+        """
+        self.starttime = starttime
+        self.frequency = frequency
+        self.shift = shift
+        self.n_features = n_features
+
+        self.buffers = [RingBuffer(capacity) for _ in range(len(set(components.values())))]
+
+        # Filter state of every component is kept between records
+        self.highpass = None
+        if highpass:
+            self.highpass = HighpassFilter(highpass, frequency, len(self.buffers))
+
+        self.channels = [''] * len(self.buffers)  # channel codes of the components
+        self.started = [False] * len(self.buffers)  # components with buffered data
+        self.next_window = 0  # index of the first not yet scanned window
+        self.arrival_time = None  # arrival time of the last added record
+
+    @property
+    def pending(self):
+        """
+        Number of buffered samples, complete on all components, which are not scanned yet.
+        """
+        return min(buffer.end for buffer in self.buffers) - self.next_window * self.shift
+
+    def add(self, component, trace):
+        """
+        Appends trace samples to the component buffer. First trace of the component may start later than the
+        station start, following traces should continue the buffered data.
+        :return: False if trace does not follow the buffered data (gap), True otherwise
+        """
+        buffer = self.buffers[component]
+        self.channels[component] = trace.stats.channel
+
+        position = int(round((trace.stats.starttime - self.starttime) * self.frequency))
+        data = trace.data
+
+        # Late component is aligned on the station samples
+        if not self.started[component] and position > buffer.end:
+            buffer.seek(position)
+
+        # Skip already buffered samples
+        if position < buffer.end:
+            data = data[buffer.end - position:]
+            position = buffer.end
+
+        if position > buffer.end:
+            return False
+
+        if not data.shape[0]:
+            return True
+
+        data = data.astype(np.float64)
+        if self.highpass is not None:
+            # Filter starts from the steady state of the first sample, raw counts offset gives no step transient
+            if not self.started[component]:
+                self.highpass.reset(channels = [component], initial = data[0])
+            data = self.highpass(data[np.newaxis], channels = [component])[0]
+
+        self.started[component] = True
+
+        buffer.append(data.astype(np.float32, copy = False))
+
+        return True
+
+    def windows(self):
+        """
+        Returns new sliding windows, complete on all components, or None. Every window is normalized by its own
+        maximum of all components. Windows before the start of the latest component are skipped.
+        """
+        complete = min(buffer.end for buffer in self.buffers)
+
+        # First window, which is covered by all components
+        first_window = max(self.next_window, -(-max(buffer.begin for buffer in self.buffers) // self.shift))
+
+        n_windows = (complete - self.n_features - first_window * self.shift) // self.shift + 1
+        if n_windows <= 0:
+            return None
+
+        start = first_window * self.shift
+        end = (first_window + n_windows - 1) * self.shift + self.n_features
+
+        data = np.stack([buffer.get(start, end) for buffer in self.buffers], axis = 1)
+
+        self.next_window = first_window + n_windows
+
+        windows = stools.sliding_window_strided(data, self.n_features, self.shift)
+        m = np.max(np.abs(windows), axis = (1, 2), keepdims = True)
+        m[m == 0] = 1.
+
+        return windows / m
+
+
+class RealtimeScanner:
+
+    def __init__(self, model, out, model_labels, positive_labels, threshold_labels, batch_size = 150,
+                 shift = 10, n_features = 400, frequency = 100., buffer_size = 12000, highpass = 2.,
+                 peak_dist = 200, avg_window_half_size = 100, sparse = False, precision = 4, print_picks = True,
+                 output_format = 'text', metrics = None):
+        """
+        :param model: utils.backends.InferenceBackend
+        :param out: output file path
+        :param model_labels: dictionary of all model labels and their scores indexes
+        :param positive_labels: dictionary of labels to pick
+        :param threshold_labels: dictionary of thresholds for every positive label
+        :param batch_size: model batch size
+        :param shift: sliding windows shift
+        :param n_features: window length in samples
+        :param frequency: model sampling rate, records with other sampling rate are skipped
+        :param buffer_size: ring buffers capacity in samples
+        :param highpass: highpass filter frequency, None - no filter
+        :param peak_dist: get_positives peak_dist, picks are released only after max(peak_dist,
+            2 * avg_window_half_size) samples of the following scores are available
+        :param avg_window_half_size: get_positives avg_window_half_size
+        :param sparse: pick on sliding windows scores, see pick_positives_sparse
+        :param precision: pseudo-probability output precision
+        :param print_picks: print picks and their latency to stdout
+        :param output_format: output file format, see utils.result_sink
+        :param metrics: utils.instrumentation.Metrics, default: None
+        """
+        self.sink = open_sink(out, output_format, metrics = metrics)
+        self.written = False  # picks are written since the last sink sync
+        self.labels = (model_labels, positive_labels, threshold_labels)
+        self.shift = shift
+        self.n_features = n_features
+        self.frequency = frequency
+        self.buffer_size = buffer_size
+        self.highpass = highpass
+        self.peak_dist = peak_dist
+        self.avg_window_half_size = avg_window_half_size
+        self.sparse = sparse
+        self.precision = precision
+        self.print_picks = print_picks
+        self.metrics = metrics
+
+        self.packer = BatchPacker(model, batch_size, metrics = metrics)
+
+        self.stations = {}  # (network, station, location): (StationStream, ScoreStream)
+        self.updated = set()  # stations with new records since the last process call
+        self.skipped = set()  # traces ids with unsupported sampling rate or channel
+        self.latencies = []  # pick latencies in seconds
+
+    def add_record(self, record, arrival_time):
+        """
+        Adds miniSEED record to its station buffers.
+        :param record: miniSEED record bytes
+        :param arrival_time: record arrival wall time
+        """
+        with timer(self.metrics, 'read'):
+            traces = read(io.BytesIO(record), format = 'MSEED')
+        count(self.metrics, 'records')
+
+        for trace in traces:
+
+            stats = trace.stats
+            component = components.get(stats.channel[-1:])
+            if component is None or stats.sampling_rate != self.frequency:
+                if trace.id not in self.skipped:
+                    self.skipped.add(trace.id)
+                    print(f'WARNING: Skipped {trace.id}: only {self.frequency} Hz N (1), E (2) and Z channels'
+                          f' are supported')
+                continue
+
+            key = (stats.network, stats.station, stats.location)
+
+            with timer(self.metrics, 'pre_process'):
+                if key not in self.stations:
+                    self._start_station(key, stats.starttime)
+
+                station, _ = self.stations[key]
+                if not station.add(component, trace):
+                    # Gap: restart station from this record
+                    count(self.metrics, 'restarts')
+                    self._flush_station(key)
+                    self._start_station(key, stats.starttime)
+                    station, _ = self.stations[key]
+                    station.add(component, trace)
+
+            station.arrival_time = arrival_time
+            self.updated.add(key)
+
+            # Large reads (e.g. backlog of a growing file) are scanned before they overflow the buffers
+            if station.pending >= self.buffer_size // 2:
+                self._scan_station(key)
+
+    def process(self):
+        """
+        Scans new windows of the updated stations and writes released picks.
+        """
+        for key in sorted(self.updated):
+            if key in self.stations:
+                self._scan_station(key)
+
+        self.updated = set()
+        self.packer.flush()
+        self._sync()
+
+    def close(self):
+        """
+        Writes remaining picks of every station and closes the output.
+        """
+        for key in list(self.stations):
+            self._flush_station(key)
+        self.packer.flush()
+        self.sink.close()
+
+    def _sync(self):
+        """
+        Makes written picks visible to the output file readers.
+        """
+        if self.written:
+            self.sink.flush()
+            self.sink.sync()
+            self.written = False
+
+    def latency_summary(self):
+        """
+        Returns pick latency statistics in seconds.
+        """
+        if not self.latencies:
+            return {'picks': 0}
+
+        latencies = np.array(self.latencies)
+        return {'picks': int(latencies.shape[0]),
+                'mean': float(latencies.mean()),
+                'p50': float(np.percentile(latencies, 50)),
+                'p95': float(np.percentile(latencies, 95)),
+                'max': float(latencies.max())}
+
+    def _scan_station(self, key):
+        """
+        Submits new windows of the station to the model.
+        """
+        station, score_stream = self.stations[key]
+        next_window = station.next_window
+
+        with timer(self.metrics, 'windowing'):
+            try:
+                windows = station.windows()
+            except IndexError:
+                # Channels are too far apart for the buffers
+                count(self.metrics, 'restarts')
+                self._flush_station(key)
+                del self.stations[key]
+                return
+
+        if windows is None:
+            return
+
+        # Windows before the latest component start are skipped only before the first scanned windows
+        first_window = station.next_window - windows.shape[0]
+        if first_window != next_window:
+            score_stream.offset = first_window
+
+        self.packer.submit(windows, lambda scores, key = key, station = station, score_stream = score_stream:
+                           self._write_picks(key, station, score_stream.push(scores), station.arrival_time))
+
+    def _start_station(self, key, starttime):
+        station = StationStream(starttime, self.frequency, self.shift, self.n_features, self.buffer_size,
+                                highpass = self.highpass)
+        score_stream = ScoreStream(self.shift, *self.labels, peak_dist = self.peak_dist,
+                                   avg_window_half_size = self.avg_window_half_size, sparse = self.sparse,
+                                   metrics = self.metrics)
+        self.stations[key] = (station, score_stream)
+
+    def _flush_station(self, key):
+        """
+        Writes remaining picks of the station, after its already submitted windows are predicted.
+        """
+        station, score_stream = self.stations[key]
+        self.packer.submit(None, lambda scores: self._write_picks(key, station, score_stream.flush(),
+                                                                  station.arrival_time))
+
+    def _write_picks(self, key, station, predicted_labels, arrival_time):
+        """
+        Writes picks to the output file and measures their latency.
+        """
+        detected_peaks = get_detected_peaks(predicted_labels, station.starttime)
+        if not detected_peaks:
+            return
+
+        ids = (*key, channel_code(station.channels))
+        self.sink.write_peaks(detected_peaks, ids, station.starttime, precision = self.precision)
+        self.written = True
+
+        latency = time() - arrival_time
+        for peak in detected_peaks:
+
+            self.latencies.append(latency)
+            if self.print_picks:
+                print(f'{".".join(key)} {peak["type"].upper()} {peak["pseudo-probability"]:.{self.precision}f}'
+                      f' {peak["datetime"]} latency: {latency:.3f} s')
+
+
+def split_records(buffer, record_length):
+    """
+    Splits bytes into complete records.
+    :return: tuple (records, rest of the buffer)
+    """
+    n = len(buffer) // record_length
+    records = [bytes(buffer[i * record_length : (i + 1) * record_length]) for i in range(n)]
+    return records, buffer[n * record_length:]
+
+
+def tcp_records(host, port, record_length = 512, read_size = 65536):
+    """
+    Connects to the TCP server and yields (records, arrival time) for every read, until the connection is closed.
+    :param host: server host
+    :param port: server port
+    :param record_length: miniSEED record length in bytes
+    :param read_size: max bytes read at once
+    """
+    with socket.create_connection((host, port)) as connection:
+
+        buffer = b''
+        while True:
+
+            data = connection.recv(read_size)
+            if not data:
+                break
+
+            records, buffer = split_records(buffer + data, record_length)
+            if records:
+                yield records, time()
+
+
+def file_records(path, record_length = 512, poll_interval = 0.1, timeout = None):
+    """
+    Follows growing miniSEED file and yields (records, arrival time) for every appended data.
+    :param path: file path, waits for the file if it does not exist yet
+    :param record_length: miniSEED record length in bytes
+    :param poll_interval: file polling interval in seconds
+    :param timeout: stop if file does not grow for timeout seconds, None - follow forever
+    """
+    while not os.path.exists(path):
+        sleep(poll_interval)
+
+    with open(path, 'rb') as f:
+
+        buffer = b''
+        last_data_time = time()
+        while True:
+
+            data = f.read()
+            if data:
+                last_data_time = time()
+                records, buffer = split_records(buffer + data, record_length)
+                if records:
+                    yield records, last_data_time
+                continue
+
+            if timeout is not None and time() - last_data_time > timeout:
+                break
+            sleep(poll_interval)
@@ -0,0 +1,497 @@
+"""
+Result sinks: buffered pick output of a whole run through a single file handle (see archive_scan.py
+--output-format).
+
+Formats:
+- "text" - archive_scan.py text output: group headers, "STATION TYPE PROBABILITY DATETIME" lines and group
+  separators. Appended to the existing file.
+- "npy" - NumPy structured array of pick_dtype records, appended to the existing file of the same dtype.
+  File header is rewritten with every flush, so the file is always readable with numpy.load.
+- "parquet", "feather" - Apache Parquet and Arrow IPC (Feather v2) files with pick_dtype columns, every
+  flush is written as a row group / record batch. Require pyarrow, existing file is overwritten and file is
+  readable only after the sink is closed.
+
+Columnar records keep full SEED ids: network, station, location and channel, where channel is the common code
+of the group channels with differing characters replaced by "?", e.g. "HH?". Pick time is stored as
+datetime64[ns], computed from the trace start time in integer nanoseconds (see get_detected_peaks), along with
+the trace start time and pick sample index, so times are exact to the sample.
+
+Picks, group headers and separators are written to the file when flush_size picks or flush_bytes bytes are
+buffered, when the oldest buffered output is older than flush_interval seconds (checked with every write), on
+flush (e.g. after every archive group separator) and on close. sync() does not write buffered output, it only
+syncs already written data to disk, so periodic syncs (e.g. of the scan journal) do not split the output into
+small writes. position() is the output size including buffered output.
+
+Usage example:
+
+sink = open_sink('predictions.npy', 'npy')
+sink.write_peaks(detected_peaks, seed_id(traces), t_start)
+position = sink.position()
+durable = sink.sync()  # output before position is on disk if position <= durable
+sink.close()
+picks = np.load('predictions.npy')
+"""
+import os
+import ast
+import time
+import struct
+import numpy as np
+
+from utils.scan_tools import truncate
+from utils.instrumentation import timer, count
+
+
+formats = ['text', 'npy', 'parquet', 'feather']
+extensions = {'text': 'txt', 'npy': 'npy', 'parquet': 'parquet', 'feather': 'feather'}
+
+pick_dtype = np.dtype([('network', 'U8'), ('station', 'U8'), ('location', 'U8'), ('channel', 'U8'),
+                       ('phase', 'U4'), ('probability', np.float64), ('time', 'datetime64[ns]'),
+                       ('trace_start', 'datetime64[ns]'), ('sample', np.int64)])
+
+
+def channel_code(channels):
+    """
+    Returns common channel code of the group channels, characters, which differ between the channels,
+    are replaced by "?", e.g. "HH?" for ["HHN", "HHE", "HHZ"].
+    """
+    channel = ''
+    for characters in zip(*channels):
+        channel += characters[0] if len(set(characters)) == 1 else '?'
+
+    return channel
+
+
+def seed_id(traces):
+    """
+    Returns (network, station, location, channel) of the group traces, see channel_code.
+    """
+    stats = traces[0].stats
+    return stats.network, stats.station, stats.location, channel_code([trace.stats.channel for trace in traces])
+
+
+def format_datetime(datetime):
+    """
+    Returns "%d.%m.%Y %H:%M:%S.%f" time with trailing zeros stripped, without strftime.
+    """
+    d = datetime.datetime
+    return f'{d.day:02d}.{d.month:02d}.{d.year:04d} {d.hour:02d}:{d.minute:02d}:{d.second:02d}.' \
+           f'{d.microsecond:06d}'.rstrip('0')
+
+
+def format_pick(record, precision = 2, upper_case = True, station = None):
+    """
+    Returns print_results text line of the pick record.
+    """
+    line = ''
+    # Print station if provided
+    if station:
+        line += f'{station} '
+
+    tp = record['type'].upper() if upper_case else record['type']
+    line += f'{tp} '
+    line += f'{truncate(record["pseudo-probability"], precision):1.{precision}f} '
+    line += f'{format_datetime(record["datetime"])}\n'
+
+    return line
+
+
+def pick_records(detected_peaks, ids, t_start):
+    """
+    Returns pick_dtype array of the get_detected_peaks records.
+    :param detected_peaks: get_detected_peaks output
+    :param ids: (network, station, location, channel)
+    :param t_start: trace start UTCDateTime
+    """
+    records = np.zeros(len(detected_peaks), dtype = pick_dtype)
+    if not detected_peaks:
+        return records
+
+    network, station, location, channel = ids
+    records['network'] = network
+    records['station'] = station
+    records['location'] = location
+    records['channel'] = channel
+
+    records['phase'] = [record['type'].upper() for record in detected_peaks]
+    records['probability'] = [record['pseudo-probability'] for record in detected_peaks]
+    records['sample'] = [record['sample'] for record in detected_peaks]
+    records['time'] = np.array([record['ns'] for record in detected_peaks], dtype = 'datetime64[ns]')
+    records['trace_start'] = np.datetime64(t_start.ns, 'ns')
+
+    return records
+
+
+class ResultSink:
+    """
+    Base sink: buffers picks and writes them when a buffer threshold is reached, on flush and on close.
+    """
+    def __init__(self, path, flush_size = 10000, flush_bytes = 1024**2, flush_interval = 10., metrics = None):
+        """
+        :param path: output file path
+        :param flush_size: number of buffered picks, which triggers a write
+        :param flush_bytes: size of buffered output in bytes (including group headers and separators), which
+            triggers a write
+        :param flush_interval: max time in seconds, for which output stays buffered, checked with every write
+        :param metrics: utils.instrumentation.Metrics, default: None
+        """
+        self.path = path
+        self.flush_size = flush_size
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.metrics = metrics
+        self.buffered = 0  # buffered picks
+        self.buffered_bytes = 0  # buffered output size
+        self.buffered_time = None  # time of the oldest buffered output
+
+    def write_line(self, line):
+        """
+        Writes group header or separator line, only text output keeps them.
+        """
+        pass
+
+    def flush_due(self):
+        """
+        Returns True if buffered output reached a buffer threshold.
+        """
+        if not self.buffered_bytes:
+            return False
+
+        return self.buffered >= self.flush_size or self.buffered_bytes >= self.flush_bytes or \
+            time.monotonic() - self.buffered_time >= self.flush_interval
+
+    def check_flush(self, metrics = None):
+        """
+        Writes buffered output, if it reached a buffer threshold.
+        """
+        if self.flush_due():
+            self.flush(metrics)
+
+    def write_peaks(self, detected_peaks, ids, t_start, precision = 2, metrics = None):
+        """
+        Writes picks of a single trace.
+        :param detected_peaks: get_detected_peaks output
+        :param ids: (network, station, location, channel), see seed_id
+        :param t_start: trace start UTCDateTime
+        :param precision: text output pseudo-probability precision
+        :param metrics: utils.instrumentation.Metrics of the picks, default: sink metrics
+        """
+        if not detected_peaks:
+            return
+
+        metrics = metrics or self.metrics
+        with timer(metrics, 'output'):
+            self._add(detected_peaks, ids, t_start, precision)
+        count(metrics, 'picks', len(detected_peaks))
+
+        self.check_flush(metrics)
+
+    def write_records(self, records):
+        """
+        Writes pick_dtype records, e.g. loaded from a part file.
+        """
+        raise NotImplementedError
+
+    def append_part(self, path):
+        """
+        Appends part file of the same format, written by a worker process (for columnar formats part files are
+        "npy").
+        """
+        self.write_records(np.load(path))
+
+    def flush(self, metrics = None):
+        """
+        Writes buffered output.
+        :param metrics: utils.instrumentation.Metrics of the write, default: sink metrics
+        """
+        self.buffered = 0
+        self.buffered_bytes = 0
+        self.buffered_time = None
+
+    def position(self):
+        """
+        Returns output file size after all buffered output is written.
+        """
+        raise NotImplementedError
+
+    def sync(self):
+        """
+        Syncs already written output to disk, buffered output is not written.
+        :return: output file size, which is synced to disk
+        """
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    def _add(self, detected_peaks, ids, t_start, precision):
+        raise NotImplementedError
+
+    def _buffer(self, n_picks, n_bytes):
+        """
+        Counts output added to the buffer.
+        """
+        if not self.buffered_bytes:
+            self.buffered_time = time.monotonic()
+        self.buffered += n_picks
+        self.buffered_bytes += n_bytes
+
+
+class TextSink(ResultSink):
+
+    def __init__(self, path, flush_size = 10000, flush_bytes = 1024**2, flush_interval = 10., metrics = None):
+        super().__init__(path, flush_size = flush_size, flush_bytes = flush_bytes, flush_interval = flush_interval,
+                         metrics = metrics)
+        self.file = open(path, 'a')
+        self.lines = []
+        self.written = self.synced = self.file.tell()  # file size after written and synced data
+
+    def write_line(self, line):
+        self._add_line(line)
+        self.check_flush()
+
+    def write_records(self, records):
+        raise ValueError('Text output can not be written from pick records')
+
+    def append_part(self, path):
+        self.flush()
+        with open(path) as part:
+            data = part.read()
+        self.file.write(data)
+        self.file.flush()
+        self.written += len(data.encode())
+
+    def flush(self, metrics = None):
+        if self.lines:
+            metrics = metrics or self.metrics
+            with timer(metrics, 'output'):
+                self.file.write(''.join(self.lines))
+                self.file.flush()
+            count(metrics, 'bytes_written', self.buffered_bytes)
+            self.written += self.buffered_bytes
+            self.lines = []
+        super().flush()
+
+    def position(self):
+        return self.written + self.buffered_bytes
+
+    def sync(self):
+        if self.written > self.synced:
+            os.fsync(self.file.fileno())
+            self.synced = self.written
+        return self.synced
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def _add(self, detected_peaks, ids, t_start, precision):
+        for record in detected_peaks:
+            self._add_line(format_pick(record, precision, station = ids[1]), n_picks = 1)
+
+    def _add_line(self, line, n_picks = 0):
+        self.lines.append(line)
+        self._buffer(n_picks, len(line.encode()))
+
+
+class ColumnarSink(ResultSink):
+    """
+    Buffers picks as pick_dtype arrays.
+    """
+    def __init__(self, path, flush_size = 10000, flush_bytes = 1024**2, flush_interval = 10., metrics = None):
+        super().__init__(path, flush_size = flush_size, flush_bytes = flush_bytes, flush_interval = flush_interval,
+                         metrics = metrics)
+        self.batches = []
+
+    def write_records(self, records):
+        if records.shape[0]:
+            self._add_records(records.astype(pick_dtype, copy = False))
+            self.check_flush()
+
+    def flush(self, metrics = None):
+        if self.batches:
+            metrics = metrics or self.metrics
+            with timer(metrics, 'output'):
+                records = np.concatenate(self.batches)
+                self._write(records)
+            count(metrics, 'bytes_written', records.nbytes)
+            self.batches = []
+        super().flush()
+
+    def _add(self, detected_peaks, ids, t_start, precision):
+        self._add_records(pick_records(detected_peaks, ids, t_start))
+
+    def _add_records(self, records):
+        self.batches.append(records)
+        self._buffer(records.shape[0], records.nbytes)
+
+    def _write(self, records):
+        raise NotImplementedError
+
+
+class NpySink(ColumnarSink):
+    """
+    Appendable .npy file: header has a fixed length, so the records number can be updated in place.
+    """
+    header_size = 384  # fits pick_dtype description and a 20 digits shape
+
+    def __init__(self, path, flush_size = 10000, flush_bytes = 1024**2, flush_interval = 10., metrics = None):
+        super().__init__(path, flush_size = flush_size, flush_bytes = flush_bytes, flush_interval = flush_interval,
+                         metrics = metrics)
+
+        self.length = 0
+        if os.path.exists(path) and os.path.getsize(path):
+            self.file = open(path, 'r+b')
+            self.length = self._read_header()
+
+            # Remove partially written record, e.g. after output truncation on --resume
+            self.file.truncate(self.header_size + self.length * pick_dtype.itemsize)
+        else:
+            self.file = open(path, 'wb')
+
+        self._write_header()
+        self.file.seek(0, os.SEEK_END)
+        self.synced = -1
+
+    def _read_header(self):
+        """
+        Returns number of complete records in the file, raises ValueError if file is not appendable.
+        """
+        magic = self.file.read(8)
+        if magic != b'\x93NUMPY\x01\x00':
+            raise ValueError(f'{self.path} is not a .npy file written by NpySink')
+
+        length, = struct.unpack('<H', self.file.read(2))
+        header = ast.literal_eval(self.file.read(length).decode('latin1'))
+
+        if 10 + length != self.header_size or np.dtype(np.lib.format.descr_to_dtype(header['descr'])) != pick_dtype:
+            raise ValueError(f'{self.path} records do not match pick records, use another output file')
+
+        size = os.path.getsize(self.path)
+        return (size - self.header_size) // pick_dtype.itemsize
+
+    def _write_header(self):
+        header = {'descr': np.lib.format.dtype_to_descr(pick_dtype), 'fortran_order': False,
+                  'shape': (self.length,)}
+        header = repr(header).encode('latin1')
+        header = header.ljust(self.header_size - 10 - 1) + b'\n'
+
+        self.file.seek(0)
+        self.file.write(b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header)
+
+    def _write(self, records):
+        self.file.seek(0, os.SEEK_END)
+        self.file.write(records.tobytes())
+        self.length += records.shape[0]
+        self._write_header()
+        self.file.seek(0, os.SEEK_END)
+        self.file.flush()
+
+    def position(self):
+        return self.header_size + (self.length + self.buffered) * pick_dtype.itemsize
+
+    def sync(self):
+        if self.length > self.synced:
+            os.fsync(self.file.fileno())
+            self.synced = self.length
+        return self.header_size + self.length * pick_dtype.itemsize
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def arrow_schema():
+    import pyarrow as pa
+
+    return pa.schema([(name, pa.string()) for name in ('network', 'station', 'location', 'channel', 'phase')] +
+                     [('probability', pa.float64()), ('time', pa.timestamp('ns', tz = 'UTC')),
+                      ('trace_start', pa.timestamp('ns', tz = 'UTC')), ('sample', pa.int64())])
+
+
+def arrow_batch(records, schema):
+    """
+    Converts pick_dtype records to pyarrow RecordBatch.
+    """
+    import pyarrow as pa
+
+    columns = []
+    for field in schema:
+        column = records[field.name]
+        if column.dtype.kind == 'U':
+            column = column.tolist()
+        elif column.dtype.kind == 'M':
+            column = column.astype(np.int64)
+        columns.append(pa.array(column, type = field.type))
+
+    return pa.RecordBatch.from_arrays(columns, schema = schema)
+
+
+class ArrowSink(ColumnarSink):
+    """
+    Parquet or Feather file, written with pyarrow.
+    """
+    def __init__(self, path, format = 'parquet', flush_size = 10000, flush_bytes = 1024**2, flush_interval = 10.,
+                 metrics = None):
+        super().__init__(path, flush_size = flush_size, flush_bytes = flush_bytes, flush_interval = flush_interval,
+                         metrics = metrics)
+
+        try:
+            import pyarrow as pa
+        except ImportError:
+            raise ValueError(f'"{format}" output requires pyarrow, install it or use "npy" output')
+
+        self.schema = arrow_schema()
+        if format == 'parquet':
+            import pyarrow.parquet as pq
+            self.writer = pq.ParquetWriter(path, self.schema)
+        else:
+            self.writer = pa.ipc.new_file(path, self.schema)
+        self.format = format
+
+    def _write(self, records):
+        batch = arrow_batch(records, self.schema)
+        if self.format == 'parquet':
+            import pyarrow as pa
+            self.writer.write_table(pa.Table.from_batches([batch]))
+        else:
+            self.writer.write_batch(batch)
+
+    def position(self):
+        return os.path.getsize(self.path)
+
+    def sync(self):
+        # Written row groups are not readable before the file is closed, output is not truncated on resume
+        return os.path.getsize(self.path)
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def open_sink(path, format = 'text', flush_size = 10000, flush_bytes = 1024**2, flush_interval = 10.,
+              metrics = None):
+    """
+    Opens result sink of the output format. Raises ValueError if format is not supported.
+    :param path: output file path
+    :param format: "text", "npy", "parquet" or "feather"
+    :param flush_size: number of buffered picks, which triggers a write
+    :param flush_bytes: size of buffered output in bytes, which triggers a write
+    :param flush_interval: max time in seconds, for which output stays buffered
+    :param metrics: utils.instrumentation.Metrics, default: None
+    """
+    thresholds = {'flush_size': flush_size, 'flush_bytes': flush_bytes, 'flush_interval': flush_interval}
+    if format == 'text':
+        return TextSink(path, metrics = metrics, **thresholds)
+    if format == 'npy':
+        return NpySink(path, metrics = metrics, **thresholds)
+    if format in ('parquet', 'feather'):
+        return ArrowSink(path, format, metrics = metrics, **thresholds)
+
+    raise ValueError(f'Unknown output format "{format}", supported formats: {", ".join(formats)}')
+
+
+def part_format(format):
+    """
+    Returns format of the worker process part files for the output format.
+    """
+    return 'text' if format == 'text' else 'npy'
@@ -1,32 +1,54 @@
 import obspy.core as oc
 from scipy.signal import find_peaks
 import numpy as np
-import matplotlib.pyplot as plt
 import os
 from time import time
+from functools import lru_cache
 from obspy.core.utcdatetime import UTCDateTime
 
+from utils.instrumentation import timer, count
 
-def pre_process_stream(stream, no_filter = False, no_detrend = False):
+
+def pre_process_stream(stream, no_filter = False, no_detrend = False, dtype = None):
     """
     Does preprocessing on the stream (changes it's frequency), does linear detrend and
-    highpass filtering with frequency of 2 Hz.
+    highpass filtering with frequency of 2 Hz. See utils.preprocessing.pre_process_streams, which preprocesses
+    channels of the archive group together.
 
     Arguments:
     stream      -- obspy.core.stream object to pre process
-    frequency   -- required frequency
+    dtype       -- data type of the preprocessed traces, default: None (float64 of obspy processing)
+    """
+    from utils.preprocessing import pre_process_streams
+
+    pre_process_streams([stream], no_filter, no_detrend, dtype = dtype)
+
+
+@lru_cache(maxsize = None)
+def highpass_sos(freq, df, corners = 4):
+    """
+    Returns second-order sections of the Butterworth highpass filter, same as obspy Trace.filter('highpass', ...)
+    applies, so the filter can be run with scipy.signal.sosfilt and its state kept between data chunks.
+
+    Arguments:
+    freq    -- filter corner frequency
+    df      -- sampling rate
+    corners -- filter corners number
     """
-    if not no_detrend:
-        stream.detrend(type="linear")
-    if not no_filter:
-        stream.filter(type="highpass", freq = 2)
+    from scipy.signal import iirfilter, zpk2sos
+
+    z, p, k = iirfilter(corners, freq / (0.5 * df), btype = 'highpass', ftype = 'butter', output = 'zpk')
+    return zpk2sos(z, p, k)
 
-    frequency = 100.
-    required_dt = 1. / frequency
-    dt = stream[0].stats.delta
 
-    if dt != required_dt:
-        stream.interpolate(frequency)
+def preprocess_dtype(dtype):
+    """
+    Returns data type of preprocessed traces for the --dtype value: float16 is used only to store normalized
+    data, raw counts may not fit into its range.
+    """
+    if np.dtype(dtype) == np.float16:
+        return np.dtype(np.float32)
+    return np.dtype(dtype)
 
 
 def trim_streams(streams, start = None, end = None):
@@ -168,7 +190,8 @@ def sliding_window(data, n_features, n_shift):
 
 def sliding_window_strided(data, n_features, n_shift, copy = False):
     """
-    Return NumPy array of sliding windows. Which is basically a view into a copy of original data array.
+    Return NumPy array of sliding windows. Which is basically a view into original data array.
+    Note, that windows view is read-only in its nature: windows share memory.
 
     Arguments:
     data       -- numpy array to make a sliding windows on. Shape (n_samples, n_channels)
@@ -184,12 +207,191 @@ def sliding_window_strided(data, n_features, n_shift, copy = False):
 
     strides = [data.strides[0]*n_shift, *data.strides]
 
-    windows = as_strided(data, stride_shape, strides)
+    windows = as_strided(data, stride_shape, strides, writeable = False)
 
     if copy:
+        return windows.copy()
+    else:
         return windows
+
+
+def window_batches(windows, batch_size, dtype = np.float32, indexes = None):
+    """
+    Yields contiguous batches of sliding windows. Only a single batch is copied out of the windows view at a time,
+    so memory usage depends only on the batch size.
+
+    Arguments:
+    windows    -- sliding windows array or view, see sliding_window_strided
+    batch_size -- number of windows in a batch
+    dtype      -- batch data type, default: float32 (model input type)
+    indexes    -- indexes of the windows to yield, default: None (all windows)
+    """
+    if indexes is None:
+        for start in range(0, windows.shape[0], batch_size):
+            yield windows[start : start + batch_size].astype(dtype)
     else:
-        return windows.copy()
+        for start in range(0, indexes.shape[0], batch_size):
+            yield windows[indexes[start : start + batch_size]].astype(dtype)
+
+
+def predict_windows(model, windows, batch_size, indexes = None):
+    """
+    Returns model scores for sliding windows, which are fed to the model (utils.backends.InferenceBackend)
+    batch by batch with window_batches.
+    :param indexes: indexes of the windows to predict, default: None (all windows)
+    """
+    scores = [model.infer_batch(batch) for batch in window_batches(windows, batch_size, indexes = indexes)]
+    if not scores:
+        # No windows: empty batch gives scores of shape (0, n_classes)
+        return model.infer_batch(windows[:0].astype(np.float32))
+    return np.concatenate(scores)
+
+
+def coarse_to_fine_indexes(coarse_scores, coarse_indexes, n_windows, trigger, trigger_labels, padding):
+    """
+    Returns indexes of the sliding windows to rescan after the coarse pass: every window between the neighbours
+    of a triggered coarse window, extended by padding windows on both sides. Coarse windows are excluded.
+
+    Arguments:
+    coarse_scores   -- coarse pass scores of shape (n_coarse, n_classes)
+    coarse_indexes  -- sorted indexes of the coarse pass windows, first is 0 and last is n_windows - 1
+    n_windows       -- number of sliding windows
+    trigger         -- coarse pass score, which triggers rescan
+    trigger_labels  -- scores indexes of the trigger labels
+    padding         -- number of windows to rescan around the triggered region
+    """
+    triggered = np.flatnonzero((coarse_scores[:, trigger_labels] >= trigger).any(axis = 1))
+
+    # Interval borders of every triggered coarse window, overlapping intervals are merged by the cumulative sum
+    last = coarse_indexes.shape[0] - 1
+    starts = np.maximum(coarse_indexes[np.maximum(triggered - 1, 0)] - padding, 0)
+    ends = np.minimum(coarse_indexes[np.minimum(triggered + 1, last)] + padding + 1, n_windows)
+
+    borders = np.zeros(n_windows + 1, dtype = int)
+    np.add.at(borders, starts, 1)
+    np.add.at(borders, ends, -1)
+
+    rescan = np.cumsum(borders[:-1]) > 0
+    rescan[coarse_indexes] = False
+
+    return np.flatnonzero(rescan)
+
+
+def predict_coarse_to_fine(model, windows, batch_size, stride, trigger, trigger_labels = None, padding = 0):
+    """
+    Two-pass prediction: windows are predicted with the coarse stride first, then regions around coarse windows
+    with any of the trigger labels scores not lower than the trigger are predicted window by window. Scores of not
+    predicted windows are linearly interpolated between the coarse windows, so they stay below the trigger and
+    can not produce positives with the thresholds not lower than the trigger.
+
+    Arguments:
+    model           -- model (utils.backends.InferenceBackend)
+    windows         -- sliding windows array or view, see sliding_window_strided
+    batch_size      -- model batch size
+    stride          -- coarse pass stride in windows
+    trigger         -- coarse pass score, which triggers rescan, should be lower than positives thresholds
+    trigger_labels  -- scores indexes of the trigger labels, e.g. P and S, None - all labels except the last
+                       (noise)
+    padding         -- number of windows to rescan around the triggered regions, default: 0
+
+    Returns tuple: (scores of all windows, number of predicted windows)
+    """
+    n_windows = windows.shape[0]
+    if not n_windows:
+        return predict_windows(model, windows, batch_size), 0
+
+    coarse_indexes = np.arange(0, n_windows, stride)
+    if coarse_indexes[-1] != n_windows - 1:
+        coarse_indexes = np.append(coarse_indexes, n_windows - 1)
+
+    coarse_scores = predict_windows(model, windows, batch_size, indexes = coarse_indexes)
+    if trigger_labels is None:
+        trigger_labels = list(range(coarse_scores.shape[1] - 1))
+
+    scores = np.empty((n_windows, coarse_scores.shape[1]), dtype = coarse_scores.dtype)
+    positions = np.arange(n_windows)
+    for j in range(coarse_scores.shape[1]):
+        scores[:, j] = np.interp(positions, coarse_indexes, coarse_scores[:, j])
+    scores[coarse_indexes] = coarse_scores
+
+    fine_indexes = coarse_to_fine_indexes(coarse_scores, coarse_indexes, n_windows,
+                                          trigger, trigger_labels, padding)
+    if fine_indexes.shape[0]:
+        scores[fine_indexes] = predict_windows(model, windows, batch_size, indexes = fine_indexes)
+
+    return scores, coarse_indexes.shape[0] + fine_indexes.shape[0]
+
+
+def energy_gate(data, n_features, shift, method = 'stalta', sta = 100, lta = 2000, threshold = 2., padding = 200):
+    """
+    Energy pre-trigger: returns boolean mask of the sliding windows, which contain or are closer than padding
+    samples to a triggered sample. Energy is the sum of squared channels, triggered samples are:
+    - "stalta": STA/LTA ratio (both trailing means) above the threshold. Samples of the first LTA of the data do not
+        have full LTA history, and are always triggered
+    - "energy": STA above threshold times the median STA of the data
+
+    Arguments:
+    data       -- data of shape (n_samples, n_channels), see prepare_traces
+    n_features -- number of samples in a single window
+    shift      -- amount of samples between windows
+    method     -- "stalta" or "energy", default: "stalta"
+    sta        -- short term average length in samples, default: 100
+    lta        -- long term average length in samples, default: 2000
+    threshold  -- trigger threshold, default: 2
+    padding    -- number of samples around triggered samples, which windows are not gated, default: 200
+    """
+    n_samples = data.shape[0]
+    n_windows = (n_samples - n_features) // shift + 1
+    if n_windows <= 0:
+        return np.zeros(0, dtype = bool)
+
+    energy = np.square(data, dtype = np.float64).sum(axis = 1)
+    cumulative = np.zeros(n_samples + 1)
+    np.cumsum(energy, out = cumulative[1:])
+
+    ends = np.arange(1, n_samples + 1)
+    sta_mean = (cumulative[ends] - cumulative[np.maximum(ends - sta, 0)]) / np.minimum(ends, sta)
+
+    if method == 'stalta':
+        lta_mean = (cumulative[ends] - cumulative[np.maximum(ends - lta, 0)]) / np.minimum(ends, lta)
+        triggered = sta_mean > threshold * lta_mean
+        triggered[:lta] = True
+    elif method == 'energy':
+        triggered = sta_mean > threshold * np.median(sta_mean)
+    else:
+        raise ValueError(f'Unknown gate method "{method}"')
+
+    # Number of triggered samples in every padded window
+    triggered_count = np.zeros(n_samples + 1, dtype = int)
+    np.cumsum(triggered, out = triggered_count[1:])
+
+    window_starts = np.arange(n_windows) * shift
+    starts = np.clip(window_starts - padding, 0, n_samples)
+    ends = np.clip(window_starts + n_features + padding, 0, n_samples)
+
+    return triggered_count[ends] > triggered_count[starts]
+
+
+def predict_gated(model, windows, batch_size, active, noise_scores):
+    """
+    Predicts only active windows, other windows get fixed noise scores.
+
+    Arguments:
+    model           -- model (utils.backends.InferenceBackend)
+    windows         -- sliding windows array or view, see sliding_window_strided
+    batch_size      -- model batch size
+    active          -- boolean mask of the windows to predict, see energy_gate
+    noise_scores    -- scores of not predicted windows, shape (n_classes,)
+
+    Returns tuple: (scores of all windows, number of predicted windows)
+    """
+    indexes = np.flatnonzero(active)
+
+    scores = np.tile(np.asarray(noise_scores, dtype = np.float32), (windows.shape[0], 1))
+    if indexes.shape[0]:
+        scores[indexes] = predict_windows(model, windows, batch_size, indexes = indexes)
+
+    return scores, indexes.shape[0]
 
 
 def normalize_windows_global(windows):
@@ -231,6 +433,7 @@ def plot_positives(scores, windows, threshold):
 
         if scores[i][1] > threshold:
 
+            import matplotlib.pyplot as plt
             fig, (ax1, ax2, ax3) = plt.subplots(3, sharex = True)
 
             ax1.set_ylabel('N', rotation = 0.)
@@ -268,6 +471,7 @@ def plot_oririnal_positives(scores, original_windows, threshold, original_scores
 
         if scores[i][1] > threshold:
 
+            import matplotlib.pyplot as plt
             fig, (ax1, ax2, ax3) = plt.subplots(3, sharex = True)
 
             ax1.set_ylabel('N', rotation = 0.)
@@ -283,90 +487,141 @@ def plot_oririnal_positives(scores, original_windows, threshold, original_scores
             plt.clf()
 
 
-def scan_traces(*_traces, model = None, args = None, n_features = 400, shift = 10, original_data = None):
+def prepare_traces(*_traces, args = None, n_features = 400, metrics = None):
     """
-    Get predictions on the group of traces.
+    Prepares model input for the group of traces: normalized data of shape (n_samples, n_channels) and its sliding
+    windows. Returns None if traces are shorter than a single window.
 
     Positional arguments:
     Any number of traces (depends on the amount of channels). Unpack * if passing a list of traces.
-    e.g. scan_traces(*trs)
+    e.g. prepare_traces(*trs)
 
     Keyword arguments
-    model            -- NN model
+    args             -- archive_scan.py arguments, args.dtype is the normalized data type
     n_features       -- number of input features in a single channel
-    shift            -- amount of samples between windows
-    global_normalize -- normalize globaly all traces if True or locally if False
-    batch_size       -- model.fit batch size
-    """
-    # Check args
-    import argparse
-    if not args and type(args) != argparse.Namespace:
-        raise AttributeError('args should have an argparse.Namespace type')
-
-    batch_size = args.batch_size
+    metrics          -- utils.instrumentation.Metrics, default: None
 
+    Returns dictionary: {'data': data, 'windows': windows, 'original_windows': original_windows}
+    """
     # Check input types
     for x in _traces:
         if type(x) != oc.trace.Trace:
             raise TypeError('traces should be a list or containing obspy.core.trace.Trace objects')
-    # plot-positives-original
-    # Cut all traces to a same timeframe
-    _traces = cut_traces(*_traces)
 
-    # normalize_traces(*traces, global_normalize = global_normalize)
+    with timer(metrics, 'windowing'):
 
-    # Get sliding window arrays
-    l_windows = []
-    try:
-        for x in _traces:
-            l_windows.append(sliding_window(x.data, n_features = n_features, n_shift = shift))
-    except ValueError:
-        return None, 0
+        # Cut all traces to a same timeframe
+        _traces = cut_traces(*_traces)
 
-        if args.plot_positives_original:
-            original_l_windows = []
-            for x in original_data:
-                original_l_windows.append(sliding_window(x.data, n_features = n_features, n_shift = args.shift))
+        min_size = min([tr.data.shape[0] for tr in _traces])
+        if min_size < n_features:
+            return None
 
-        w_length = min([x.shape[0] for x in l_windows])
+        data = np.stack([tr.data[:min_size] for tr in _traces], axis = 1)
 
-        # Prepare data
-        windows = np.zeros((w_length, n_features, len(l_windows)))
-        for _i in range(len(l_windows)):
-            windows[:, :, _i] = l_windows[_i][:w_length]
+    return prepare_data(data, args = args, n_features = n_features, metrics = metrics)
 
-        if args.plot_positives_original:
-            original_windows = np.zeros((w_length, n_features, len(original_l_windows)))
-            for _i in range(len(original_l_windows)):
-                original_windows[:, :, _i] = original_l_windows[_i][:w_length]
 
-        # Global max normalization:
-        normalize_windows_global(windows)
-        if args.plot_positives_original:
-            normalize_windows_global(original_windows)
+def prepare_data(data, args = None, n_features = 400, metrics = None):
+    """
+    Prepares model input for the channels data of shape (n_samples, n_channels), e.g. a chunk of
+    utils.segments.SegmentIndex data. Returns None if data is shorter than a single window.
 
-    else:
-        min_size = min([tr.data.shape[0] for tr in _traces])
+    Keyword arguments
+    args             -- archive_scan.py arguments, args.dtype is the normalized data type
+    n_features       -- number of input features in a single channel
+    metrics          -- utils.instrumentation.Metrics, default: None
+
+    Returns dictionary: {'data': data, 'windows': windows, 'original_windows': original_windows}
+    """
+    if data.shape[0] < n_features:
+        return None
 
-        data = np.zeros((min_size, len(_traces)))
+    with timer(metrics, 'windowing'):
 
-        for i, tr in enumerate(_traces):
-            data[:, i] = tr.data[:min_size]
+        # Global max normalization, done before conversion to args.dtype, raw counts may not fit into float16
+        m = np.max(np.abs(data))
 
-        normalize_global(data)
+        data = (data / m).astype(args.dtype, copy = False)
 
-        windows = sliding_window_strided(data, 400, args.shift, False)
+        # Windows view into data, batches are copied out of it only when fed to the model
+        windows = sliding_window_strided(data, n_features, args.shift)
 
+        original_windows = None
         if args.plot_positives_original:
-            original_windows = windows.copy()
+            original_windows = windows
+
+    return {'data': data, 'windows': windows, 'original_windows': original_windows}
+
+
+def scan_traces(*_traces, model = None, args = None, n_features = 400, shift = 10, original_data = None,
+                prepared = None, metrics = None, trigger_labels = None, noise_scores = None):
+    """
+    Get predictions on the group of traces.
+
+    Positional arguments:
+    Any number of traces (depends on the amount of channels). Unpack * if passing a list of traces.
+    e.g. scan_traces(*trs)
+
+    Keyword arguments
+    model            -- NN model
+    n_features       -- number of input features in a single channel
+    shift            -- amount of samples between windows
+    global_normalize -- normalize globaly all traces if True or locally if False
+    batch_size       -- model.fit batch size
+    prepared         -- prepare_traces (or prepare_data) output for the traces, if already prepared
+    metrics          -- utils.instrumentation.Metrics, default: None
+    trigger_labels   -- scores indexes of the labels, which trigger fine rescan with args.coarse_stride,
+                        default: None (all labels except the last, noise)
+    noise_scores     -- scores of the windows skipped by args.gate, default: None ([0, 0, 1]: P, S, noise)
+    """
+    # Check args
+    import argparse
+    if not args and type(args) != argparse.Namespace:
+        raise AttributeError('args should have an argparse.Namespace type')
+
+    batch_size = args.batch_size
+
+    if prepared is None:
+        prepared = prepare_traces(*_traces, args = args, n_features = n_features, metrics = metrics)
+    if prepared is None:
+        return None, 0
+
+    data = prepared['data']
+    windows = prepared['windows']
+    original_windows = prepared['original_windows']
+
+    active = None
+    if getattr(args, 'gate', None):
+        with timer(metrics, 'gate'):
+            active = energy_gate(data, n_features, args.shift, args.gate, args.gate_sta, args.gate_lta,
+                                 args.gate_threshold, args.gate_padding)
 
     # Predict
     start_time = time()
-    _scores = model.predict(windows, verbose = False, batch_size = batch_size)
+    with timer(metrics, 'predict'):
+        if args.shared_stft:
+            _scores = model.predict_trace(data, args.shift, batch_size = batch_size)
+            n_predicted = _scores.shape[0]
+        elif active is not None:
+            if noise_scores is None:
+                noise_scores = [0., 0., 1.]
+            _scores, n_predicted = predict_gated(model, windows, batch_size, active, noise_scores)
+        elif getattr(args, 'coarse_stride', None):
+            _scores, n_predicted = predict_coarse_to_fine(model, windows, batch_size,
+                                                          args.coarse_stride // args.shift, args.coarse_threshold,
+                                                          trigger_labels,
+                                                          padding = -(-args.coarse_padding // args.shift))
+        else:
+            _scores = predict_windows(model, windows, batch_size)
+            n_predicted = _scores.shape[0]
     performance_time = time() - start_time
+    count(metrics, 'windows', n_predicted)
+    if n_predicted < _scores.shape[0]:
+        count(metrics, 'skipped_windows', _scores.shape[0] - n_predicted)
     # TODO: create another flag for this, e.g. --culculate-original-probs or something
     if args.plot_positives_original:
-        original_scores = model.predict(original_windows, verbose = False, batch_size = batch_size)
+        original_scores = predict_windows(model, original_windows, batch_size)
 
     # Plot
     # if args and args.plot_positives:
@@ -395,59 +650,287 @@ def restore_scores(_scores, shape, shift):
     shape  -- shape of the restored scores
     shift  -- sliding windows shift
     """
-    new_scores = np.zeros(shape)
-    for i in range(1, _scores.shape[0]):
+    new_scores = np.zeros(shape, dtype = _scores.dtype)
+    if _scores.shape[0] < 2:
+        return new_scores
 
-        for j in range(_scores.shape[1]):
+    # Same values as np.linspace(_scores[i - 1], _scores[i], shift + 1)[:shift] between every pair of windows,
+    # computed for all windows in a single pass
+    dtype = _scores.dtype if np.issubdtype(_scores.dtype, np.inexact) else np.float64
+    step = np.subtract(_scores[1:], _scores[:-1], dtype = dtype) / shift
+    ramp = np.arange(shift, dtype = dtype)[np.newaxis, :, np.newaxis] * step[:, np.newaxis, :]
+    ramp += _scores[:-1, np.newaxis, :]
 
-            start_i = (i - 1) * shift
-            end_i = i * shift
-            if end_i >= shape[0]:
-                end_i = shape[0] - 1
-
-            new_scores[start_i : end_i, j] = np.linspace(_scores[i - 1, j], _scores[i, j], shift + 1)[:end_i - start_i]
+    length = min((_scores.shape[0] - 1) * shift, shape[0] - 1)
+    if length > 0:
+        new_scores[:length] = ramp.reshape(-1, _scores.shape[1])[:length]
 
     return new_scores
 
 
-def get_positives(_scores, peak_idx, other_idxs, peak_dist = 10000, avg_window_half_size = 100, threshold = 0.8):
+def score_cumsum(_scores):
+    """
+    Returns cumulative sums of scores of shape (n_samples + 1, n_classes) in float64, so the sum of
+    scores[start : end] is cumsum[end] - cumsum[start], see get_positives.
+    """
+    cumulative = np.zeros((_scores.shape[0] + 1, _scores.shape[1]), dtype = np.float64)
+    np.cumsum(_scores, axis = 0, dtype = np.float64, out = cumulative[1:])
+    return cumulative
+
+
+def peak_windows(peaks, length, avg_window_half_size = 100):
+    """
+    Returns (start, end) arrays of the get_positives averaging windows around peaks: 2 * avg_window_half_size
+    samples, shifted inside the scores at the edges. Same as slices [start_id : end_id] of the per peak
+    computation, including negative start_id (counted from the end) of scores shorter than the window.
+    """
+    window = avg_window_half_size * 2
+
+    start = np.maximum(peaks - avg_window_half_size, 0)
+    end = start + window
+
+    outside = end > length
+    end = np.where(outside, length - 1, end)
+    start = np.where(outside, end - window, start)
+
+    start = np.where(start < 0, np.maximum(start + length, 0), start)
+
+    return start, end
+
+
+def get_positives(_scores, peak_idx, other_idxs, peak_dist = 10000, avg_window_half_size = 100, threshold = 0.8,
+                  cumulative = None):
     """
     Returns positive prediction list in format: [[sample, pseudo-probability], ...]
+    Peak is positive, if its class has the highest scores mean in the window around the peak. Means of all
+    peaks are computed at once with cumulative sums, peaks where the means comparison is within rounding
+    error of the cumulative sums are checked with exact window means.
+
+    Arguments:
+    cumulative -- score_cumsum of the scores, computed if not set
+    """
+    x = _scores[:, peak_idx]
+
+    peaks, properties = find_peaks(x, distance = peak_dist, height=[threshold, 1.])
+    if not peaks.shape[0]:
+        return []
+
+    is_max = class_max_mask(_scores, peaks, peak_idx, other_idxs, avg_window_half_size, cumulative)
+    heights = properties['peak_heights']
+
+    return [[peak, height] for peak, height in zip(peaks[is_max], heights[is_max])]
+
+
+def class_max_mask(_scores, peaks, peak_idx, other_idxs, avg_window_half_size = 100, cumulative = None):
+    """
+    Returns boolean mask of peaks, which class has the highest scores mean in the window around the peak,
+    see get_positives.
+
+    Arguments:
+    cumulative -- score_cumsum of the scores, computed if not set
     """
-    _positives = []
+    if cumulative is None:
+        cumulative = score_cumsum(_scores)
 
     x = _scores[:, peak_idx]
+    start, end = peak_windows(peaks, len(x), avg_window_half_size)
+
+    # Get mean values
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        means = (cumulative[end] - cumulative[start]) / (end - start)[:, np.newaxis]
+
+    peak_means = means[:, peak_idx, np.newaxis]
+    other_means = means[:, other_idxs]
+
+    is_max = ~np.any(other_means > peak_means, axis = 1)
+
+    # Ambiguous comparisons: check with exact means
+    eps = np.finfo(_scores.dtype).eps if np.issubdtype(_scores.dtype, np.floating) else 0.
+    tolerance = max(1e-4, 16 * eps) * np.maximum(np.abs(other_means), np.abs(peak_means))
+    ambiguous = np.any(np.abs(other_means - peak_means) <= tolerance, axis = 1)
+
+    for i in np.nonzero(ambiguous)[0]:
+
+        peak_mean = x[start[i] : end[i]].mean()
+        is_max[i] = not any(_scores[:, idx][start[i] : end[i]].mean() > peak_mean for idx in other_idxs)
+
+    return is_max
+
+
+def score_knots(_scores, shift):
+    """
+    Returns knots of the piecewise linear function, which restore_scores builds from compressed scores,
+    so restored scores are: numpy.interp(sample, positions, knots[:, class], right = 0.).
+    Note, that last window score is never reached by restore_scores, scores drop to zero after the last window.
+
+    Arguments:
+    scores -- original 'compressed' scores of shape (n_windows, n_classes)
+    shift  -- sliding windows shift
+    """
+    n = _scores.shape[0]
+
+    positions = [np.arange(n - 1) * shift]
+    knots = [_scores[:-1]]
+
+    # Last interpolated sample before the last window
+    if shift > 1:
+        tail = _scores[-2] + (_scores[-1] - _scores[-2]) * (shift - 1) / shift
+        positions.append([(n - 1) * shift - 1])
+        knots.append(tail[np.newaxis])
+
+    positions.append([(n - 1) * shift])
+    knots.append(np.zeros((1, _scores.shape[1])))
+
+    return np.concatenate(positions), np.concatenate(knots)
+
+
+def peak_distance_mask(peaks, priority, distance):
+    """
+    Returns boolean mask of peaks which are kept by scipy.signal.find_peaks distance condition.
+    Same as find_peaks: peaks are processed from the highest priority to the lowest and all peaks closer
+    than distance to a kept peak are removed.
+    """
+    distance = np.ceil(distance)
+    keep = np.ones(peaks.shape[0], dtype = bool)
+
+    for j in np.argsort(priority)[::-1]:
+
+        if not keep[j]:
+            continue
+
+        near = np.abs(peaks - peaks[j]) < distance
+        near[j] = False
+        keep[near] = False
+
+    return keep
+
+
+def get_positives_sparse(_scores, shift, length, peak_idx, other_idxs,
+                         peak_dist = 10000, avg_window_half_size = 100, threshold = 0.8):
+    """
+    Same as get_positives(restore_scores(scores, (length, n_classes), shift), ...), but scores are never restored
+    to the full size: peaks are found on compressed scores knots and class means are computed only around peaks.
+    Peaks may differ only if rounding of the restored float32 scores makes a plateau, which knots do not have.
+    Returns positive prediction list in format: [[sample, pseudo-probability], ...]
+
+    Arguments:
+    scores -- original 'compressed' scores of shape (n_windows, n_classes)
+    shift  -- sliding windows shift
+    length -- length of the restored scores, should be greater than (n_windows - 1) * shift
+    """
+    if _scores.shape[0] < 2:
+        return []
+
+    positions, knots = score_knots(_scores, shift)
+
+    samples, heights = sparse_peaks(positions, knots, peak_idx, threshold)
+    if not samples.shape[0]:
+        return []
+
+    keep = peak_distance_mask(samples, heights, peak_dist)
+    samples = samples[keep]
+    heights = heights[keep]
+
+    is_max = sparse_class_max_mask(positions, knots, length, samples, peak_idx, other_idxs, avg_window_half_size)
 
-    peaks = find_peaks(x, distance = peak_dist, height=[threshold, 1.])
+    return [[sample, height] for sample, height in zip(samples[is_max], heights[is_max])]
 
-    for _i in range(len(peaks[0])):
 
-        start_id = peaks[0][_i] - avg_window_half_size
+def sparse_peaks(positions, knots, peak_idx, threshold = 0.8):
+    """
+    Returns (samples, heights) arrays of the restored scores peaks above the threshold, found on score_knots.
+    """
+    # Restored scores are linear between knots, so peaks are on knots or in the middle of plateaus
+    x = knots[:, peak_idx]
+    peaks, properties = find_peaks(x, height = [threshold, 1.], plateau_size = 1)
+
+    samples = (positions[properties['left_edges']] + positions[properties['right_edges']]) // 2
+    return samples, properties['peak_heights']
+
+
+def sparse_class_max_mask(positions, knots, length, samples, peak_idx, other_idxs, avg_window_half_size = 100):
+    """
+    Returns boolean mask of peaks, which class has the highest mean of the restored scores in the window around
+    the peak, see get_positives_sparse. Scores are restored only around the peaks.
+    """
+    is_max = np.zeros(samples.shape[0], dtype = bool)
+    for i, sample in enumerate(samples):
+
+        start_id = sample - avg_window_half_size
         if start_id < 0:
             start_id = 0
 
         end_id = start_id + avg_window_half_size*2
-        if end_id > len(x):
-            end_id = len(x) - 1
+        if end_id > length:
+            end_id = length - 1
             start_id = end_id - avg_window_half_size*2
 
-        # Get mean values
-        peak_mean = x[start_id : end_id].mean()
+        # Restore scores only around the peak, negative start is counted from the end as in get_positives slices
+        neighbourhood = range(length)[start_id : end_id]
+        neighbourhood = np.arange(neighbourhood.start, neighbourhood.stop)
+        peak_mean = np.interp(neighbourhood, positions, knots[:, peak_idx], right = 0.).mean()
 
-        means = []
+        is_max[i] = True
         for idx in other_idxs:
-            means.append(_scores[:, idx][start_id : end_id].mean())
+            if np.interp(neighbourhood, positions, knots[:, idx], right = 0.).mean() > peak_mean:
+                is_max[i] = False
+
+    return is_max
+
+
+def pick_positives_sparse(_scores, shift, length, model_labels, positive_labels, threshold_labels, **kwargs):
+    """
+    Same as pick_positives(restore_scores(scores, (length, n_classes), shift), ...), but uses get_positives_sparse.
+    Returns positive predictions for every positive label in format: {label: [[sample, pseudo-probability], ...]}
+    """
+    predicted_labels = {}
+    for label in positive_labels:
 
-        is_max = True
-        for m in means:
+        other_labels = []
+        for k in model_labels:
+            if k != label:
+                other_labels.append(model_labels[k])
 
-            if m > peak_mean:
-                is_max = False
+        predicted_labels[label] = get_positives_sparse(_scores, shift, length,
+                                                       positive_labels[label],
+                                                       other_labels,
+                                                       threshold = threshold_labels[label],
+                                                       **kwargs)
 
-        if is_max:
-            _positives.append([peaks[0][_i], peaks[1]['peak_heights'][_i]])
+    return predicted_labels
 
-    return _positives
+
+def pick_positives(restored_scores, model_labels, positive_labels, threshold_labels, **kwargs):
+    """
+    Returns positive predictions for every positive label in format: {label: [[sample, pseudo-probability], ...]}
+    :param restored_scores: scores restored to original size, see restore_scores
+    :param model_labels: dictionary of all model labels and their scores indexes, e.g. {'p': 0, 's': 1, 'n': 2}
+    :param positive_labels: dictionary of labels to pick, e.g. {'p': 0, 's': 1}
+    :param threshold_labels: dictionary of thresholds for every positive label
+    :param kwargs: get_positives keyword arguments
+    """
+    # Cumulative sums are shared by all labels, computed only if some label reaches its threshold
+    cumulative = None
+    if restored_scores.shape[0] and any(restored_scores[:, positive_labels[label]].max() >= threshold_labels[label]
+                                        for label in positive_labels):
+        cumulative = score_cumsum(restored_scores)
+
+    predicted_labels = {}
+    for label in positive_labels:
+
+        other_labels = []
+        for k in model_labels:
+            if k != label:
+                other_labels.append(model_labels[k])
+
+        predicted_labels[label] = get_positives(restored_scores,
+                                                positive_labels[label],
+                                                other_labels,
+                                                threshold = threshold_labels[label],
+                                                cumulative = cumulative,
+                                                **kwargs)
+
+    return predicted_labels
 
 
 def truncate(f, n):
@@ -458,33 +941,24 @@ def truncate(f, n):
     return math.floor(f * 10 ** n) / 10 ** n
 
 
-def print_results(_detected_peaks, filename, precision = 2, upper_case = True, station = None):
+def print_results(_detected_peaks, filename, precision = 2, upper_case = True, station = None, metrics = None):
     """
-    Prints out peaks in the file.
+    Prints out peaks in the file. Opens the file for every call, use utils.result_sink to write many picks.
     """
-    with open(filename, 'a') as f:
+    from utils.result_sink import format_pick
 
-        for record in _detected_peaks:
-
-            line = ''
-            # Print station if provided
-            if station:
-                line += f'{station} '
-
-            # Print wave type
-            tp = record['type'].upper() if upper_case else record['type']
-            line += f'{tp} '
+    with timer(metrics, 'output'), open(filename, 'a') as f:
 
-            # Print pseudo-probability
-            line += f'{truncate(record["pseudo-probability"], precision):1.{precision}f} '
+        for record in _detected_peaks:
 
-            # Print time
-            dt_str = record["datetime"].strftime("%d.%m.%Y %H:%M:%S.%f").rstrip('0')
-            line += f'{dt_str}\n'
+            line = format_pick(record, precision, upper_case, station)
 
             # Write
             f.write(line)
 
+            count(metrics, 'picks')
+            count(metrics, 'bytes_written', len(line.encode()))
+
 
 def parse_archive_csv(path):
     """
@@ -513,6 +987,8 @@ def plot_wave_scores(file_token, wave, scores,
     classes_num = scores.shape[1]
     scores_length = scores.shape[0]
 
+    import matplotlib.pyplot as plt
+
     # TODO: Make figure size dynamically chosen, based on the input length
     fig = plt.figure(figsize = (9.8, 7.), dpi = 160)
     axes = fig.subplots(channels_num + classes_num, 1, sharex = True)
@@ -591,12 +1067,12 @@ def print_scores(data, scores, predictions, file_token, window_length = 400):
 
     length = shapes.pop()
 
-    waveforms = np.zeros((length, len(data)))
+    waveforms = np.zeros((length, len(data)), dtype = data[0].data.dtype)
     for i, d in enumerate(data):
         waveforms[:, i] = d.data
 
     # Shift scores
-    shifted_scores = np.zeros((length, len(data)))
+    shifted_scores = np.zeros((length, len(data)), dtype = scores.dtype)
     shifted_scores[right_shift:] = scores[:-right_shift]
 
     plot_wave_scores(file_token, waveforms, shifted_scores, data[0].stats.starttime, predictions,
@@ -0,0 +1,84 @@
+"""
+Store of raw sliding window scores, so positives can be picked again with other thresholds without
+running the model (see archive_scan.py --save-scores and --from-scores).
+
+Scores of every archive group are saved in a single compressed .npz file, named after the group archive paths.
+File contains scores of every group trace: "scores_<trace index>" arrays of shape (n_windows, n_classes) and
+"meta" JSON string with traces SEED ids and start times, windows shift and length.
+Window k of a trace starts at sample k * shift from the trace start time.
+
+Scores are stored as float32: float16 resolution near 1. (~0.0005) is too coarse for thresholds like 0.9997.
+"""
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+from obspy import UTCDateTime
+
+
+def group_path(path, l_archives):
+    """
+    Returns scores file path for the archive group.
+    :param path: scores store directory
+    :param l_archives: list of the group archive paths
+    """
+    key = hashlib.sha1(' '.join(l_archives).encode()).hexdigest()
+    return os.path.join(path, f'{key}.npz')
+
+
+def save_group_scores(path, l_archives, traces, shift, n_features, frequency, model_labels):
+    """
+    Saves scores of the archive group.
+    :param path: scores store directory
+    :param l_archives: list of the group archive paths
+    :param traces: list of (SEED id, start time, scores) for every group trace, SEED id is
+        (network, station, location, channel), see utils.result_sink.seed_id
+    :param shift: sliding windows shift
+    :param n_features: sliding window length in samples
+    :param frequency: sampling rate
+    :param model_labels: dictionary of all model labels and their scores indexes
+    """
+    os.makedirs(path, exist_ok = True)
+
+    meta = {'archives': l_archives,
+            'shift': shift,
+            'n_features': n_features,
+            'frequency': frequency,
+            'model_labels': model_labels,
+            'traces': [{'station': ids[1], 'id': list(ids), 'starttime': starttime.ns} for ids, starttime, _ in traces]}
+
+    arrays = {f'scores_{i}': scores.astype(np.float32) for i, (_, _, scores) in enumerate(traces)}
+
+    # Write to a temporary file first, so partially written files are never loaded
+    fd, tmp_path = tempfile.mkstemp(suffix = '.npz', dir = path)
+    with os.fdopen(fd, 'wb') as f:
+        np.savez_compressed(f, meta = np.array(json.dumps(meta)), **arrays)
+
+    os.replace(tmp_path, group_path(path, l_archives))
+
+
+def load_group_scores(path, l_archives):
+    """
+    Loads scores of the archive group.
+    :param path: scores store directory
+    :param l_archives: list of the group archive paths
+    :return: tuple (meta, traces), where traces is a list of (SEED id, start time, scores),
+        or None if scores of the group are not stored. Scores saved without SEED ids have only the station code.
+    """
+    file_path = group_path(path, l_archives)
+    if not os.path.exists(file_path):
+        return None
+
+    with np.load(file_path) as f:
+
+        meta = json.loads(str(f['meta']))
+
+        traces = []
+        for i, trace_meta in enumerate(meta['traces']):
+            ids = tuple(trace_meta.get('id', ('', trace_meta['station'], '', '')))
+            traces.append((ids,
+                           UTCDateTime(ns = trace_meta['starttime']),
+                           f[f'scores_{i}']))
+
+    return meta, traces
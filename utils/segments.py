@@ -0,0 +1,183 @@
+"""
+Sample index of an archive group: channels are aligned once on the sampling grid of the first channel, and trace
+chunks are cut by slicing trace data (without obspy Trace.slice calls and without copying the group into a new
+array, so memory-mapped cached traces stay memory-mapped).
+
+Segments are ranges of samples, which are covered by a single trace of every channel, and gaps of any channel are
+masked ranges between them. Channels with different gaps or different number of traces are scanned on their
+common segments. Adjacent traces of a channel are not merged: they are preprocessed separately, so filter
+transients at their borders are not scanned as continuous data.
+
+Usage example:
+
+index = SegmentIndex(streams, start = args.start, end = args.end)
+for i, (start, end) in enumerate(index.segments):
+    t_start = index.time(start)
+    data = index.slice(start, end)  # array of shape (end - start, n_channels)
+"""
+import bisect
+import numpy as np
+from obspy import Trace
+
+from utils.result_sink import seed_id
+
+
+def channel_ranges(ranges):
+    """
+    Returns sorted list of not overlapping [start, end) ranges of the channel traces: every trace keeps its own range,
+    samples, which are already covered by an earlier trace, are cut from the later trace.
+    :param ranges: list of (start, end, trace index)
+    :return: list of (start, end, trace index)
+    """
+    result = []
+    for start, end, n in sorted(ranges):
+
+        if result:
+            start = max(start, result[-1][1])
+        if end > start:
+            result.append((start, end, n))
+
+    return result
+
+
+def intersect_ranges(a, b):
+    """
+    Returns intersection of two sorted lists of not overlapping [start, end) ranges.
+    """
+    ranges = []
+    i = j = 0
+    while i < len(a) and j < len(b):
+
+        start = max(a[i][0], b[j][0])
+        end = min(a[i][1], b[j][1])
+        if start < end:
+            ranges.append((start, end))
+
+        if a[i][1] < b[j][1]:
+            i += 1
+        else:
+            j += 1
+
+    return ranges
+
+
+class SegmentIndex:
+
+    def __init__(self, streams, start = None, end = None):
+        """
+        :param streams: list of preprocessed streams, one per channel, with the same sampling rate
+        :param start: UTCDateTime, earliest sample to index, default: None
+        :param end: UTCDateTime, latest sample to index, default: None
+        """
+        first = min(streams[0], key = lambda trace: trace.stats.starttime)
+        self.frequency = first.stats.sampling_rate
+        self.n_channels = len(streams)
+
+        # SEED ids of the channels, see utils.result_sink.seed_id
+        self.ids = seed_id([st[0] for st in streams])
+        self.headers = [{name: st[0].stats[name] for name in ('network', 'station', 'location', 'channel')}
+                        for st in streams]
+
+        # Empty traces do not cover any samples
+        streams = [[trace for trace in st if trace.stats.npts] for st in streams]
+
+        # Time span of the group, same as trim_streams: from the latest channel start to the earliest channel end
+        reference = first.stats.starttime
+        first_sample = 0
+        self.n_samples = 0
+        if all(streams):
+
+            span_start = max(min(trace.stats.starttime for trace in st) for st in streams)
+            span_end = min(max(trace.stats.endtime for trace in st) for st in streams)
+            if start is not None:
+                span_start = max(span_start, start)
+            if end is not None:
+                span_end = min(span_end, end)
+
+            first_sample = self.sample(span_start - reference)
+            self.n_samples = max(self.sample(span_end - reference) - first_sample + 1, 0)
+
+        # Sample 0 of the index
+        self.starttime = reference + first_sample / self.frequency
+
+        # Traces data and [start, end) ranges of every channel, clipped to the time span
+        self.traces_data = []
+        self.ranges = []
+        for st in streams:
+
+            data = []
+            ranges = []
+            for trace in st:
+
+                offset = self.sample(trace.stats.starttime - reference) - first_sample
+                trace_start = max(offset, 0)
+                trace_end = min(offset + trace.stats.npts, self.n_samples)
+                if trace_start >= trace_end:
+                    continue
+
+                ranges.append((trace_start, trace_end, len(data)))
+                data.append((offset, trace.data))
+
+            self.traces_data.append(data)
+            self.ranges.append(channel_ranges(ranges))
+
+        self.segments = [(start, end) for start, end, _ in self.ranges[0]]
+        for ranges in self.ranges[1:]:
+            self.segments = intersect_ranges(self.segments, ranges)
+
+    def sample(self, seconds):
+        """
+        Returns the nearest sample offset of the time difference in seconds.
+        """
+        return int(round(seconds * self.frequency))
+
+    def time(self, position):
+        """
+        Returns UTCDateTime of the sample position.
+        """
+        return self.starttime + position / self.frequency
+
+    @property
+    def gaps(self):
+        """
+        Masked ranges: list of [start, end) ranges, which are not covered by all channels.
+        """
+        gaps = []
+        position = 0
+        for start, end in self.segments:
+            if start > position:
+                gaps.append((position, start))
+            position = end
+
+        if position < self.n_samples:
+            gaps.append((position, self.n_samples))
+
+        return gaps
+
+    def channel_slice(self, channel, start, end):
+        """
+        Returns view of the channel trace data of the samples [start, end), raises IndexError if samples are not
+        covered by a single trace of the channel.
+        """
+        ranges = self.ranges[channel]
+        i = bisect.bisect_right(ranges, (start, float('inf'))) - 1
+        if i < 0 or end > ranges[i][1]:
+            raise IndexError(f'Samples [{start}, {end}) are not covered by a single trace of the channel {channel}')
+
+        offset, data = self.traces_data[channel][ranges[i][2]]
+        return data[start - offset : end - offset]
+
+    def slice(self, start, end):
+        """
+        Returns samples [start, end) of all channels, array of shape (end - start, n_channels). Samples should be
+        inside a single segment.
+        """
+        return np.stack([self.channel_slice(channel, start, end) for channel in range(self.n_channels)], axis = 1)
+
+    def traces(self, start, end):
+        """
+        Returns obspy Traces of the channels samples [start, end), e.g. for plotting.
+        """
+        return [Trace(data = np.array(self.channel_slice(channel, start, end)),
+                      header = dict(header, sampling_rate = self.frequency, starttime = self.time(start)))
+                for channel, header in enumerate(self.headers)]
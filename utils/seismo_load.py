@@ -2,10 +2,11 @@ from tensorflow import keras
 import seismo_performer as sp
 
 
-def load_performer(weights_path = None):
+def load_performer(weights_path = None, compile = True):
     """
     Loads fast-attention ST model variant.
     :param weights_path:
+    :param compile: compile model with optimizer and loss, not required for inference
     :return:
     """
     _model = sp.seismo_performer_with_spec(
@@ -26,24 +27,27 @@ def load_performer(weights_path = None):
     if weights_path is not None:
         _model.load_weights(weights_path)
 
-    _model.compile(optimizer = keras.optimizers.Adam(learning_rate = 0.001),
-                   loss = keras.losses.SparseCategoricalCrossentropy(),
-                   metrics = [keras.metrics.SparseCategoricalAccuracy()])
+    if compile:
+        _model.compile(optimizer = keras.optimizers.Adam(learning_rate = 0.001),
+                       loss = keras.losses.SparseCategoricalCrossentropy(),
+                       metrics = [keras.metrics.SparseCategoricalAccuracy()])
 
     return _model
 
 
-def load_cnn(weights_path = None):
+def load_cnn(weights_path = None, compile = True):
     """
     Loads CNN model on top of spectrogram.
     :param weights_path:
+    :param compile: compile model with optimizer and loss, not required for inference
     :return:
     """
     _model = sp.model_cnn_spec(400,64,16)
 
-    _model.compile(optimizer = keras.optimizers.Adam(learning_rate = 0.0001),
-                   loss = keras.losses.SparseCategoricalCrossentropy(),
-                   metrics = [keras.metrics.SparseCategoricalAccuracy()],)
+    if compile:
+        _model.compile(optimizer = keras.optimizers.Adam(learning_rate = 0.0001),
+                       loss = keras.losses.SparseCategoricalCrossentropy(),
+                       metrics = [keras.metrics.SparseCategoricalAccuracy()],)
 
     if weights_path is not None:
         _model.load_weights(weights_path)
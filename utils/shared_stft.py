@@ -0,0 +1,138 @@
+"""
+Shared-spectrogram sliding window inference for the spectrogram models
+(seismo_performer_with_spec and model_cnn_spec).
+
+If sliding windows shift is a multiple of the STFT hop length, then the spectrogram of every window
+is a slice of the spectrogram of the whole trace. So kapre STFT -> Magnitude -> MagnitudeToDecibel
+front-end is computed only once per trace and only the rest of the model is called on each window.
+
+Usage example:
+
+import utils.seismo_load as seismo_load
+from utils.shared_stft import SharedSTFTModel
+model = SharedSTFTModel(seismo_load.load_performer(weights_path))
+scores = model.predict_trace(data, shift = 16, batch_size = 150)  # data shape: (n_samples, n_channels)
+"""
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+from numpy.lib.stride_tricks import as_strided
+from kapre import STFT, Magnitude, MagnitudeToDecibel
+
+from utils.backends import InferenceBackend, InputSpec
+
+
+class SharedSTFTModel(InferenceBackend):
+
+    def __init__(self, model):
+        """
+        Splits spectrogram model into the STFT front-end and the model head.
+        :param model: keras model which starts with kapre STFT, Magnitude and MagnitudeToDecibel layers
+            followed by a chain of layers.
+        """
+        self.model = model
+
+        front_end = (STFT, Magnitude, MagnitudeToDecibel)
+        types = [type(layer) for layer in model.layers]
+
+        db_idx = None
+        for i in range(len(types) - len(front_end) + 1):
+            if tuple(types[i : i + len(front_end)]) == front_end:
+                db_idx = i + len(front_end) - 1
+                break
+
+        if db_idx is None:
+            raise ValueError('Model does not have kapre STFT -> Magnitude -> MagnitudeToDecibel front-end')
+
+        self.stft, self.magnitude, self.to_decibel = model.layers[db_idx - 2 : db_idx + 1]
+
+        self.hop_length = self.stft.hop_length
+        self.n_features = model.input_shape[1]
+        self.n_channels = model.input_shape[2]
+
+        # Build the model head on top of the decibel spectrogram
+        spec_shape = self.to_decibel.output_shape[1:]
+        self.n_frames = spec_shape[0]
+
+        inputs = keras.Input(shape = spec_shape)
+        x = inputs
+        for layer in model.layers[db_idx + 1:]:
+            x = layer(x)
+        self.head = keras.Model(inputs = inputs, outputs = x)
+
+        self._head_call = tf.function(lambda x: self.head(x, training = False),
+                                      input_signature = [tf.TensorSpec((None, *spec_shape), tf.float32)])
+
+        self.input_spec = InputSpec(tuple(model.input_shape), np.float32)
+
+    def infer_batch(self, x):
+        """
+        Returns scores for a batch of separate windows, using the whole model.
+        """
+        return np.asarray(self.model.predict_on_batch(x))
+
+    def warmup(self, batch_size = 1):
+        """
+        Traces STFT front-end and the model head.
+        """
+        self.predict_trace(np.zeros((self.n_features, self.n_channels), dtype = np.float32), self.hop_length,
+                           batch_size = batch_size)
+
+    def spectrogram(self, data):
+        """
+        Returns decibel spectrogram of the whole trace without the dynamic range clipping, which
+        is done per window.
+        :param data: NumPy array of shape (n_samples, n_channels)
+        :return: NumPy array of shape (n_frames, n_frequencies, n_channels)
+        """
+        x = tf.convert_to_tensor(data[np.newaxis], dtype = tf.float32)
+        x = self.magnitude(self.stft(x)).numpy()[0]
+
+        amin = self.to_decibel.amin
+        ref_value = self.to_decibel.ref_value
+
+        x = 10. * np.log10(np.maximum(x, amin))
+        x -= 10. * np.log10(np.maximum(amin, ref_value))
+
+        return x
+
+    def predict_trace(self, data, shift, batch_size = 150):
+        """
+        Returns scores for every sliding window of the trace, same as
+        model.predict(sliding_window_strided(data, n_features, shift)) would.
+        :param data: NumPy array of shape (n_samples, n_channels)
+        :param shift: sliding windows shift, should be a multiple of the STFT hop length.
+        :param batch_size: model head batch size.
+        :return: NumPy array of shape (n_windows, n_classes)
+        """
+        if shift % self.hop_length:
+            raise ValueError(f'Sliding windows shift ({shift}) should be a multiple '
+                             f'of the STFT hop length ({self.hop_length})')
+
+        n_windows = (data.shape[0] - self.n_features + shift) // shift
+        if n_windows <= 0:
+            return np.zeros((0, self.model.output_shape[-1]), dtype = np.float32)
+
+        spec = self.spectrogram(data)
+
+        # View frames of every window
+        step = shift // self.hop_length
+        frames = as_strided(spec, (n_windows, self.n_frames, *spec.shape[1:]),
+                            (spec.strides[0] * step, *spec.strides))
+
+        dynamic_range = self.to_decibel.dynamic_range
+
+        scores = []
+        for start in range(0, n_windows, batch_size):
+
+            batch = frames[start : start + batch_size]
+
+            # MagnitudeToDecibel dynamic range clipping is done relative to the window maximum
+            if dynamic_range:
+                floor = batch.max(axis = (1, 2, 3), keepdims = True) - dynamic_range
+                batch = np.maximum(batch, floor)
+
+            batch = np.ascontiguousarray(batch, dtype = np.float32)
+            scores.append(self._head_call(batch).numpy())
+
+        return np.concatenate(scores)
@@ -0,0 +1,271 @@
+"""
+Streaming peak picking for traces scanned in --trace-size chunks.
+
+ScoreStream keeps sliding window scores tail of the previous chunks, so find_peaks and class mean
+comparison of get_positives see the same neighbourhood as if the whole trace was scanned at once.
+A pick is released only when lookahead scores after it are available, so picks near chunk
+boundaries are neither lost nor duplicated.
+
+Peak distance suppression of find_peaks is not local: a peak removes lower peaks closer than peak_dist, but only
+if it is not removed itself by a higher peak, so the chain of suppressions may reach far beyond the lookahead.
+ScoreStream repeats find_peaks distance selection with already released peaks fixed, and releases a pick only when
+no chain of peaks from the not yet scanned scores can change it. Picks are the same as of the whole trace scan,
+except for peaks of exactly equal heights within peak_dist, which order find_peaks leaves to numpy.argsort.
+
+Usage example:
+
+stream = ScoreStream(shift, model_labels, positive_labels, threshold_labels)
+for chunk_scores in chunks:
+    picks = stream.push(chunk_scores)  # {label: [[sample, pseudo-probability], ...]}
+picks = stream.flush()
+
+Sample positions are counted from the first window of the stream.
+"""
+import numpy as np
+from scipy.signal import find_peaks
+
+from utils.scan_tools import restore_scores, score_cumsum, class_max_mask, score_knots, sparse_peaks, \
+    sparse_class_max_mask
+from utils.instrumentation import timer
+
+
+def select_peaks(samples, heights, distance, fixed, uncertain):
+    """
+    Peak distance selection of find_peaks (see utils.scan_tools.peak_distance_mask) of a part of the trace.
+    Returns (keep, uncertain) boolean masks of the peaks: keep - peak is kept, uncertain - peak may still be
+    kept or removed by the peaks of the not yet scanned scores.
+    :param samples: sorted peak sample positions
+    :param heights: peak heights, peaks are processed from the highest to the lowest
+    :param distance: find_peaks distance
+    :param fixed: mask of the already released peaks, which are kept
+    :param uncertain: mask of the peaks, which may be removed by the next peaks (or may not exist)
+    """
+    distance = np.ceil(distance)
+    keep = np.ones(samples.shape[0], dtype = bool)
+    uncertain = uncertain & ~fixed
+    done = fixed.copy()
+
+    # Peaks closer than distance to every peak: [first, last)
+    first = np.searchsorted(samples, samples - distance, side = 'right')
+    last = np.searchsorted(samples, samples + distance, side = 'left')
+
+    for j in np.argsort(heights)[::-1]:
+
+        if fixed[j]:
+            continue
+        done[j] = True
+
+        if not keep[j] and not uncertain[j]:
+            continue
+
+        # Lower peaks closer than distance
+        near = slice(first[j], last[j])
+        lower = ~done[near]
+
+        if keep[j]:
+            # Removed neighbours are uncertain if the peak is uncertain, unless already removed by a certain peak
+            removed_uncertain = np.where(keep[near], uncertain[j], uncertain[near] & uncertain[j])
+            uncertain[near] = np.where(lower, removed_uncertain, uncertain[near])
+            keep[near] &= ~lower
+        else:
+            # Removed by an uncertain peak: may still be kept and remove its neighbours
+            uncertain[near] |= lower & keep[near]
+
+    # Fixed peaks are kept, even if they are higher than a later peak
+    keep[fixed] = True
+
+    return keep, uncertain
+
+
+class ScoreStream:
+
+    def __init__(self, shift, model_labels, positive_labels, threshold_labels,
+                 peak_dist = 10000, avg_window_half_size = 100, sparse = False, metrics = None):
+        """
+        :param shift: sliding windows shift
+        :param model_labels: dictionary of all model labels and their scores indexes
+        :param positive_labels: dictionary of labels to pick
+        :param threshold_labels: dictionary of thresholds for every positive label
+        :param peak_dist: get_positives peak_dist
+        :param avg_window_half_size: get_positives avg_window_half_size
+        :param sparse: pick on compressed scores with pick_positives_sparse instead of restoring them
+        :param metrics: utils.instrumentation.Metrics, default: None
+        """
+        self.shift = shift
+        self.model_labels = model_labels
+        self.positive_labels = positive_labels
+        self.threshold_labels = threshold_labels
+        self.peak_dist = peak_dist
+        self.avg_window_half_size = avg_window_half_size
+        self.sparse = sparse
+        self.metrics = metrics
+
+        # Samples after a peak, which can still suppress it or change its class means
+        self.lookahead = max(peak_dist, avg_window_half_size * 2)
+        # Samples before not yet released region, which are required to pick it
+        self.context = peak_dist + avg_window_half_size * 2
+
+        self.scores = None  # buffered scores
+        self.offset = 0  # index of the first buffered window
+        self.released = 0  # every pick before this sample is already released
+
+        # Peaks kept by the distance selection in [known_from, released), for every label: (samples, heights)
+        self.known_from = 0
+        self.kept = {label: (np.zeros(0, dtype = int), np.zeros(0)) for label in positive_labels}
+
+    def seek(self, offset, released):
+        """
+        Continues a trace from the window offset, e.g. on scan resume, picks before released are already released.
+        Peaks selected before released are not known, so they are selected again on the first pushed scores.
+        """
+        self.scores = None
+        self.offset = offset
+        self.released = released
+        self.known_from = released
+        self.kept = {label: (np.zeros(0, dtype = int), np.zeros(0)) for label in self.positive_labels}
+
+    @property
+    def end(self):
+        """
+        End sample of the buffered scores.
+        """
+        if self.scores is None:
+            return self.offset * self.shift
+        return (self.offset + self.scores.shape[0]) * self.shift
+
+    def push(self, scores):
+        """
+        Adds next chunk scores to the stream and returns released picks.
+        :param scores: sliding window scores of shape (n_windows, n_classes), first window should directly follow
+            the last window of the previous chunk.
+        :return: dictionary {label: [[sample, pseudo-probability], ...]}
+        """
+        if scores is not None and scores.shape[0]:
+            if self.scores is None:
+                self.scores = scores
+            else:
+                self.scores = np.concatenate((self.scores, scores))
+
+        return self._release(self.end - self.lookahead)
+
+    def flush(self):
+        """
+        Returns all remaining picks, call after the last chunk of the trace.
+        """
+        return self._release(self.end)
+
+    def _release(self, until):
+        """
+        Picks positives on buffered scores, returns picks in [self.released, until) and drops scores
+        which are no longer needed. Picks are released only until the first peak, which distance selection
+        depends on the scores after until.
+        """
+        picks = {label: [] for label in self.positive_labels}
+
+        if until <= self.released or self.scores is None:
+            return picks
+
+        final = until >= self.end  # no scores are added after until
+        length = self.scores.shape[0] * self.shift
+        base = self.offset * self.shift
+
+        # Peaks above threshold of every label, relative to the buffered scores start
+        candidates = {}
+        if self.sparse:
+            if self.scores.shape[0] < 2:
+                return self._drop(until, picks)
+            with timer(self.metrics, 'get_positives'):
+                positions, knots = score_knots(self.scores, self.shift)
+                for label, idx in self.positive_labels.items():
+                    candidates[label] = sparse_peaks(positions, knots, idx, self.threshold_labels[label])
+        else:
+            with timer(self.metrics, 'restore_scores'):
+                restored = restore_scores(self.scores, (length, self.scores.shape[1]), self.shift)
+            with timer(self.metrics, 'get_positives'):
+                for label, idx in self.positive_labels.items():
+                    peaks, properties = find_peaks(restored[:, idx], height = [self.threshold_labels[label], 1.])
+                    candidates[label] = (peaks, properties['peak_heights'])
+
+        with timer(self.metrics, 'get_positives'):
+
+            # Distance selection with released peaks fixed
+            selected = {}
+            release_until = until
+            for label, (samples, heights) in candidates.items():
+
+                samples = samples + base
+                known_samples, known_heights = self.kept[label]
+
+                # Peaks in the known region are replaced by the kept released peaks, peaks before it are selected
+                # again only if no peaks are known (see seek)
+                new = samples >= self.released
+                if self.known_from >= self.released:
+                    new |= samples < self.known_from
+                samples = np.concatenate((samples[new], known_samples))
+                heights = np.concatenate((heights[new], known_heights))
+                fixed = np.arange(samples.shape[0]) >= new.sum()
+
+                order = np.argsort(samples, kind = 'stable')
+                samples, heights, fixed = samples[order], heights[order], fixed[order]
+
+                # Peaks after until are not final, peaks closer to them than peak_dist may be removed by them
+                uncertain = np.zeros(samples.shape[0], dtype = bool)
+                if not final:
+                    uncertain = samples > until - np.ceil(self.peak_dist)
+
+                keep, uncertain = select_peaks(samples, heights, self.peak_dist, fixed, uncertain)
+
+                pending = uncertain & (samples >= self.released)
+                if np.any(pending):
+                    release_until = min(release_until, samples[pending].min())
+
+                selected[label] = (samples, heights, keep)
+
+            if release_until <= self.released:
+                return picks
+
+            cumulative = None
+            for label, (samples, heights, keep) in selected.items():
+
+                released = keep & (samples >= self.released) & (samples < release_until)
+                samples, heights = samples[released], heights[released]
+
+                # Released kept peaks suppress the next peaks, even if they are not positive
+                known_samples, known_heights = self.kept[label]
+                self.kept[label] = (np.concatenate((known_samples, samples)), np.concatenate((known_heights, heights)))
+
+                if not samples.shape[0]:
+                    continue
+
+                idx = self.positive_labels[label]
+                other_idxs = [self.model_labels[k] for k in self.model_labels if k != label]
+                if self.sparse:
+                    is_max = sparse_class_max_mask(positions, knots, length, samples - base, idx, other_idxs,
+                                                   self.avg_window_half_size)
+                else:
+                    if cumulative is None:
+                        cumulative = score_cumsum(restored)
+                    is_max = class_max_mask(restored, samples - base, idx, other_idxs, self.avg_window_half_size,
+                                            cumulative)
+
+                picks[label] = [[sample, height] for sample, height in zip(samples[is_max], heights[is_max])]
+
+        return self._drop(release_until, picks)
+
+    def _drop(self, released, picks):
+        """
+        Marks picks before released as released and drops scores and peaks, which are no longer needed.
+        """
+        self.released = released
+
+        # Kept peaks, which can suppress the next peaks
+        self.known_from = max(self.known_from, released - int(np.ceil(self.peak_dist)))
+        for label, (samples, heights) in self.kept.items():
+            self.kept[label] = (samples[samples >= self.known_from], heights[samples >= self.known_from])
+
+        # Keep only context required for the next release
+        keep_from = max(self.offset, (released - self.context) // self.shift)
+        self.scores = self.scores[keep_from - self.offset:]
+        self.offset = keep_from
+
+        return picks
@@ -0,0 +1,148 @@
+"""
+Post-training quantized TFLite models for CPU inference (see export_model.py --tflite and archive_scan.py
+--backend tflite).
+
+Two quantization modes are supported:
+- "dynamic" - dynamic range quantization: int8 weights, activations are quantized on the fly
+- "int8" - full integer quantization of weights and activations, calibrated on a representative dataset.
+  Model input and output stay float32, so no changes are required in the scanners. Ops without int8 kernels
+  (e.g. the STFT of spectrogram models) fall back to float TFLite and TensorFlow ops.
+
+Usage example:
+
+from utils.tflite_model import convert_tflite, h5_calibration_data, TFLiteModel
+data = convert_tflite(model, 'int8', h5_calibration_data('calibration.h5', n_samples = 1000))
+with open('model.int8.tflite', 'wb') as f:
+    f.write(data)
+model = TFLiteModel('model.int8.tflite')
+scores = model.infer_batch(windows)
+"""
+import os
+import numpy as np
+
+from utils.backends import InferenceBackend, InputSpec
+
+
+modes = ['dynamic', 'int8']
+
+
+def tflite_path(weights_path, mode):
+    """
+    Returns default TFLite model path for the weights file and quantization mode.
+    """
+    return f'{os.path.splitext(weights_path)[0]}.{mode}.tflite'
+
+
+def find_tflite(weights_path):
+    """
+    Returns path of existing TFLite model of the weights file, int8 preferred, or None.
+    """
+    for mode in reversed(modes):
+        path = tflite_path(weights_path, mode)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def h5_calibration_data(path, n_samples = 1000, batch_size = 100):
+    """
+    Yields calibration windows from HDF5 dataset, read with H5Generator.
+    :param path: path to HDF5 file with "X" dataset of shape (n, n_features, n_channels)
+    :param n_samples: number of windows, evenly spread over the dataset
+    :param batch_size: H5Generator batch size
+    """
+    from h5_generator import H5Generator
+
+    generator = H5Generator(path, batch_size)
+    n_batches = len(generator)
+
+    samples_per_batch = max(1, n_samples // n_batches)
+    step = max(1, n_batches // n_samples)
+
+    yielded = 0
+    for i in range(0, n_batches, step):
+
+        X, _ = generator[i]
+        for x in X[:samples_per_batch]:
+
+            if yielded >= n_samples:
+                return
+
+            yield x
+            yielded += 1
+
+
+def convert_tflite(model, mode = 'dynamic', calibration_data = None):
+    """
+    Converts Keras model to quantized TFLite model.
+    :param model: Keras model
+    :param mode: "dynamic" or "int8"
+    :param calibration_data: iterable of single windows of shape (n_features, n_channels), required for "int8"
+    :return: TFLite model bytes
+    """
+    import tensorflow as tf
+
+    if mode not in modes:
+        raise ValueError(f'Unknown TFLite quantization mode "{mode}", supported modes: {", ".join(modes)}')
+    if mode == 'int8' and calibration_data is None:
+        raise ValueError('int8 quantization requires calibration data')
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+
+    if mode == 'int8':
+
+        def representative_dataset():
+            for x in calibration_data:
+                yield [np.asarray(x, dtype = np.float32)[np.newaxis]]
+
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8,
+                                               tf.lite.OpsSet.TFLITE_BUILTINS,
+                                               tf.lite.OpsSet.SELECT_TF_OPS]
+    else:
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS,
+                                               tf.lite.OpsSet.SELECT_TF_OPS]
+
+    return converter.convert()
+
+
+class TFLiteModel(InferenceBackend):
+
+    def __init__(self, path, num_threads = None):
+        """
+        Loads TFLite model.
+        :param path: .tflite file path
+        :param num_threads: interpreter threads number, default: None (TFLite default)
+        """
+        import tensorflow as tf
+
+        self.path = path
+        self.interpreter = tf.lite.Interpreter(model_path = path, num_threads = num_threads)
+
+        self._input = self.interpreter.get_input_details()[0]
+        self._output = self.interpreter.get_output_details()[0]
+
+        self.input_spec = InputSpec((None, *self._input['shape'][1:]), np.float32)
+        self.output_shape = (None, *self._output['shape'][1:])
+
+        self._batch_size = None
+
+    def infer_batch(self, x):
+        """
+        Returns scores for a single batch of windows of shape (batch, n_features, n_channels). Interpreter
+        tensors are reallocated only when the batch size changes.
+        """
+        # Interpreter input can not be resized to an empty batch
+        if not x.shape[0]:
+            return np.zeros((0, *self.output_shape[1:]), dtype = self._output['dtype'])
+
+        if x.shape[0] != self._batch_size:
+            self.interpreter.resize_tensor_input(self._input['index'], [x.shape[0], *self.input_spec.shape[1:]])
+            self.interpreter.allocate_tensors()
+            self._batch_size = x.shape[0]
+
+        self.interpreter.set_tensor(self._input['index'], np.ascontiguousarray(x, dtype = np.float32))
+        self.interpreter.invoke()
+
+        return self.interpreter.get_tensor(self._output['index'])
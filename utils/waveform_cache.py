@@ -0,0 +1,164 @@
+"""
+Persistent cache of preprocessed archive groups.
+
+Every archive group is stored in its own directory of the cache: one .npy file per trace and a meta.json with
+traces stats. Arrays are loaded memory-mapped, so repeated scans of the same archives skip reading and
+preprocessing and load only data which is actually scanned.
+
+Cache key combines archive paths, their sizes and modification times and preprocessing options, so any change
+of the archives or options results in a new entry. Least recently used entries are removed when total
+cache size exceeds the limit.
+
+Usage example:
+
+cache = WaveformCache('.waveform_cache', max_size = 10 * 1024**3)
+key = cache.key(l_archives, no_filter = False, no_detrend = False)
+streams = cache.load(key)
+if streams is None:
+    streams = ...  # read and preprocess
+    cache.save(key, streams)
+"""
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+from obspy import Stream, Trace, UTCDateTime
+
+
+# Increase if pre_process_stream changes, so old entries are not used
+CACHE_VERSION = 2
+
+
+class WaveformCache:
+
+    def __init__(self, path, max_size = None):
+        """
+        :param path: cache directory path
+        :param max_size: cache size limit in bytes, None - no limit
+        """
+        self.path = path
+        self.max_size = max_size
+
+        os.makedirs(self.path, exist_ok = True)
+
+    def key(self, paths, **options):
+        """
+        Returns cache key for the archive group.
+        :param paths: list of archive paths
+        :param options: preprocessing options
+        """
+        files = []
+        for path in paths:
+            stat = os.stat(path)
+            files.append([os.path.abspath(path), stat.st_size, stat.st_mtime_ns])
+
+        description = json.dumps({'version': CACHE_VERSION, 'files': files, 'options': options}, sort_keys = True)
+
+        return hashlib.sha1(description.encode()).hexdigest()
+
+    def load(self, key):
+        """
+        Returns list of memory-mapped streams, or None if there is no such entry.
+        """
+        entry = os.path.join(self.path, key)
+
+        try:
+            with open(os.path.join(entry, 'meta.json')) as f:
+                meta = json.load(f)
+
+            streams = []
+            for i, stream_meta in enumerate(meta):
+
+                traces = []
+                for j, stats in enumerate(stream_meta):
+
+                    data = np.load(os.path.join(entry, f'{i}_{j}.npy'), mmap_mode = 'r')
+                    header = dict(stats, starttime = UTCDateTime(ns = stats['starttime']))
+                    traces.append(Trace(data = data, header = header))
+
+                streams.append(Stream(traces))
+
+        except (OSError, ValueError):
+            return None
+
+        # Mark entry as recently used
+        os.utime(entry)
+
+        return streams
+
+    def save(self, key, streams):
+        """
+        Saves list of streams to the cache and removes least recently used entries if the cache is too large.
+        """
+        entry = os.path.join(self.path, key)
+        if os.path.exists(entry):
+            return
+
+        # Write to a temporary directory first, so partially written entries are never loaded
+        tmp_entry = tempfile.mkdtemp(prefix = f'.{key}.', dir = self.path)
+
+        meta = []
+        for i, stream in enumerate(streams):
+
+            stream_meta = []
+            for j, trace in enumerate(stream):
+
+                np.save(os.path.join(tmp_entry, f'{i}_{j}.npy'), trace.data)
+                stream_meta.append({'network': trace.stats.network,
+                                    'station': trace.stats.station,
+                                    'location': trace.stats.location,
+                                    'channel': trace.stats.channel,
+                                    'sampling_rate': trace.stats.sampling_rate,
+                                    'starttime': trace.stats.starttime.ns})
+
+            meta.append(stream_meta)
+
+        with open(os.path.join(tmp_entry, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            # Same entry is saved by another process
+            shutil.rmtree(tmp_entry, ignore_errors = True)
+
+        self.evict()
+
+    def entries(self):
+        """
+        Returns list of (last use time, size in bytes, path) for every cache entry.
+        """
+        entries = []
+        for name in os.listdir(self.path):
+
+            entry = os.path.join(self.path, name)
+            if name.startswith('.') or not os.path.isdir(entry):
+                continue
+
+            try:
+                size = sum(f.stat().st_size for f in os.scandir(entry))
+                entries.append((os.stat(entry).st_mtime, size, entry))
+            except OSError:
+                continue
+
+        return entries
+
+    def evict(self):
+        """
+        Removes least recently used entries until the cache fits into the size limit.
+        """
+        if self.max_size is None:
+            return
+
+        entries = sorted(self.entries())
+        total_size = sum(size for _, size, _ in entries)
+
+        for _, size, entry in entries:
+
+            if total_size <= self.max_size:
+                break
+
+            shutil.rmtree(entry, ignore_errors = True)
+            total_size -= size